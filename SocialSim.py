@@ -3,73 +3,2499 @@ SocialSim - AI社会模拟平台 v2.1
 """
 
 import os
+import sys
 import json
 import time
 import uuid
 import re
+import random
+import asyncio
+import hashlib
+import hmac
+import shutil
+import gzip
+import tempfile
+import atexit
+import weakref
+import math
+import heapq
+import bisect
+from array import array
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime
-from flask import Flask, render_template_string, request, jsonify
-from openai import OpenAI
 import threading
 import queue
+import argparse
+import copy
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-app = Flask(__name__)
+
+DATA_DIR = os.environ.get('SOCIALSIM_DATA_DIR', 'socialsim_data')
+DURABLE = os.environ.get('SOCIALSIM_DURABLE', '1') != '0'
+HISTORY_STORE = os.environ.get('SOCIALSIM_HISTORY_STORE', 'sqlite')
+ADMIN_TOKEN = os.environ.get('SOCIALSIM_ADMIN_TOKEN', '')
+
+# prompt 构建器读取的最近历史条数；分层历史存储的内存窗口据此确定
+# 未设置 token 预算时角色 prompt 取最近 AGENT_PROMPT_HISTORY 条，
+# 设置预算时在最近 AGENT_PROMPT_CANDIDATES 条中按时近性与相关性挑选
+AGENT_PROMPT_HISTORY = 20
+AGENT_PROMPT_CANDIDATES = 200
+METRIC_PROMPT_HISTORY = 10
+HOT_HISTORY_SIZE = max(AGENT_PROMPT_CANDIDATES, METRIC_PROMPT_HISTORY)
+
+# ============================================
+# 事件广播
+# ============================================
+class EventBroadcaster:
+    """带回放缓冲区的事件广播，/api/stream 通过它推送增量更新。
+    流式分片这类临时事件放在单独的小缓冲区里，不会挤掉需要回放的事件；
+    订阅者漏掉它们也不用重新同步，提交的 log_entry 会替换草稿"""
+    TRANSIENT_EVENTS = ('token',)
+
+    def __init__(self, buffer_size=1000, transient_size=200):
+        self._events = deque(maxlen=buffer_size)
+        self._transient = deque(maxlen=transient_size)
+        self._evicted_id = 0    # 最近一个被挤出回放缓冲区的事件 id
+        self._last_id = 0
+        self._cond = threading.Condition()
+        self.closed = False
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def publish(self, event_type, data):
+        with self._cond:
+            self._last_id += 1
+            event = (self._last_id, event_type, data)
+            if event_type in self.TRANSIENT_EVENTS:
+                self._transient.append(event)
+            else:
+                if len(self._events) == self._events.maxlen:
+                    self._evicted_id = self._events[0][0]
+                self._events.append(event)
+            self._cond.notify_all()
+
+    def _since(self, last_id):
+        if last_id > self._last_id or last_id < self._evicted_id:
+            return None
+        events = [e for e in self._events if e[0] > last_id]
+        transient = [e for e in self._transient if e[0] > last_id]
+        return sorted(events + transient) if transient else events
+
+    def wait(self, last_id, timeout=15):
+        """返回 last_id 之后的事件；缓冲区已无法补齐时返回 None，调用方需要重新同步"""
+        with self._cond:
+            events = self._since(last_id)
+            if events == [] and not self.closed:
+                self._cond.wait(timeout)
+                events = self._since(last_id)
+            return events
+
+    def close(self):
+        """会话被回收时调用，唤醒所有等待中的订阅者让它们结束"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+# ============================================
+# 后台指标评估
+# ============================================
+class MetricEvaluator:
+    """消费历史快照队列，在角色回合之外独立评估指标；积压时丢弃最旧的快照。
+    并发评估的快照数取 state.metric_concurrency，修改后在下一次提交时生效"""
+    def __init__(self, state, max_pending=2):
+        self.state = state
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._queue = None
+        self._workers = []
+        self._busy = set()
+
+    def submit(self, snapshot):
+        """只能在引擎事件循环中调用"""
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._resize(max(1, self.state.metric_concurrency))
+        if self._queue.full():
+            self._queue.get_nowait()
+            self._queue.task_done()
+            self.dropped += 1
+        self._queue.put_nowait(snapshot)
+
+    def _resize(self, count):
+        while len(self._workers) < count:
+            self._workers.append(asyncio.ensure_future(self._worker()))
+        # 多出的工作协程空闲的直接取消，正在评估的评估完再退出
+        for worker in self._workers[count:]:
+            if worker not in self._busy:
+                worker.cancel()
+        del self._workers[count:]
+
+    async def _worker(self):
+        me = asyncio.current_task()
+        while me in self._workers:
+            snapshot = await self._queue.get()
+            self._busy.add(me)
+            try:
+                await evaluate_metric_snapshot(self.state, snapshot)
+            finally:
+                self._busy.discard(me)
+                self._queue.task_done()
+
+    async def join(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    def close(self):
+        for worker in self._workers + list(self._busy):
+            engine.loop.call_soon_threadsafe(worker.cancel)
+        self._workers = []
+
+# ============================================
+# 后台记忆摘要
+# ============================================
+SUMMARY_CHUNK = 20          # 最近窗口之外累积多少条新历史后触发一次滚动摘要
+SUMMARY_MAX_BATCH = 100     # 单次摘要最多压缩的条数，导入长历史时分多次追上
+SUMMARY_MAX_CHARS = 300     # 要求模型输出的摘要字数上限
+SUMMARY_MAX_FAILURES = 3    # 同一区间连续失败这么多次后跳过该区间
+
+class MemorySummarizer:
+    """把滑出最近窗口的历史滚动压缩为世界级与角色级摘要，使角色 prompt 的大小不随模拟长度增长。
+    同一时刻只运行一个摘要任务；上一个仍在进行时跳过本次触发，下次触发会覆盖更大的区间"""
+    def __init__(self, state):
+        self.state = state
+        self.skipped = 0
+        self._task = None
+
+    def submit(self, snapshot):
+        """只能在引擎事件循环中调用"""
+        if self._task is not None and not self._task.done():
+            self.skipped += 1
+            return
+        self._task = asyncio.ensure_future(summarize_snapshot(self.state, snapshot))
+
+    async def join(self):
+        if self._task is not None:
+            await self._task
+
+    def close(self):
+        if self._task is not None:
+            engine.loop.call_soon_threadsafe(self._task.cancel)
+        self._task = None
+
+# ============================================
+# 持久化日志
+# ============================================
+class HistoryJournal:
+    """会话的追加写日志：每条提交的 log_entry 和指标数据点写入分段 JSONL 文件，由后台线程批量 fsync；
+    checkpoint.json 保存历史以外的配置。重启后由最近的检查点加日志回放重建内存状态。
+    历史存储自身可持久化时日志会被压缩：检查点记录历史位置与指标、摘要，之前的分段删除"""
+    SEGMENT_BYTES = 64 * 1024 * 1024
+    SEGMENT_PATTERN = re.compile(r'^journal-(\d{8})\.jsonl$')
+    # 压缩时写入检查点的字段，之后的配置检查点也保留它们
+    BASE_FIELDS = ('history_length', 'history_last_id', 'metric_data', 'summaries', 'summary_covered', 'graph')
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment = 0
+        self._first_segment = 0
+        self._segment_bytes = 0
+        self._dirty = False
+        self._base = {}
+        journal_flusher.register(self)
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f'journal-{number:08d}.jsonl')
+
+    @property
+    def history_length(self):
+        """检查点已覆盖的历史条数，日志中的 log 记录从这个位置之后开始"""
+        return self._base.get('history_length', 0)
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.directory, 'checkpoint.json')
+
+    def exists(self):
+        return os.path.exists(self.checkpoint_path)
+
+    def _open_segment(self, number):
+        os.makedirs(self.directory, exist_ok=True)
+        self._segment = number
+        self._file = open(self._segment_path(number), 'ab')
+        self._segment_bytes = self._file.tell()
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+            self._dirty = False
+
+    def append(self, record_type, data):
+        line = (json.dumps({'t': record_type, 'd': data}, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is None:
+                self._open_segment(self._segment)
+            elif self._segment_bytes >= self.SEGMENT_BYTES:
+                self._close_segment()
+                self._open_segment(self._segment + 1)
+            self._file.write(line)
+            self._segment_bytes += len(line)
+            self._dirty = True
+
+    def sync(self):
+        """把缓冲写入落盘；fsync 在锁外进行，不阻塞提交路径"""
+        with self._lock:
+            if not self._dirty or self._file is None:
+                return
+            f = self._file
+            f.flush()
+            self._dirty = False
+        try:
+            os.fsync(f.fileno())
+        except (OSError, ValueError):
+            # 分段已在轮转时 fsync 并关闭
+            pass
+
+    def checkpoint(self, data):
+        with self._lock:
+            data = {**data, **self._base, 'first_segment': self._first_segment,
+                    'saved_at': datetime.now().isoformat()}
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = self.checkpoint_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.checkpoint_path)
+
+    def reset(self, data, base=None):
+        """新日志从下一个分段开始，检查点落盘后再删除旧分段。历史被清空或整体替换时 base 为空，
+        由调用方随后重新写入全部记录；压缩时 base 给出检查点对应的历史位置与指标、摘要"""
+        with self._lock:
+            self._close_segment()
+            obsolete = range(self._first_segment, self._segment + 1)
+            self._segment += 1
+            self._first_segment = self._segment
+            self._base = {field: base[field] for field in self.BASE_FIELDS if field in base} if base else {}
+        self.checkpoint(data)
+        for number in obsolete:
+            try:
+                os.remove(self._segment_path(number))
+            except FileNotFoundError:
+                pass
+
+    def load(self):
+        """读取检查点并回放日志，返回 (checkpoint, records)。records 是惰性迭代器，需完整消费；
+        末尾因崩溃写了一半的记录会在迭代时被截掉"""
+        with open(self.checkpoint_path, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        first = checkpoint.get('first_segment', 0)
+        numbers = []
+        for name in os.listdir(self.directory):
+            # 目录里的其他文件（编辑器备份、手工拷贝等）直接忽略
+            match = self.SEGMENT_PATTERN.match(name)
+            if match and int(match.group(1)) >= first:
+                numbers.append(int(match.group(1)))
+        numbers.sort()
+        with self._lock:
+            self._first_segment = first
+            self._segment = numbers[-1] if numbers else first
+            self._base = {field: checkpoint[field] for field in self.BASE_FIELDS if field in checkpoint}
+        return checkpoint, self._replay(numbers)
+
+    def _replay(self, numbers):
+        for number in numbers:
+            path = self._segment_path(number)
+            good_bytes = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    good_bytes += len(line)
+                    yield record
+            if good_bytes < os.path.getsize(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(good_bytes)
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+class JournalFlusher:
+    """后台线程定期对所有日志执行批量 fsync"""
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self._journals = weakref.WeakSet()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def register(self, journal):
+        with self._lock:
+            self._journals.add(journal)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sync_all()
+
+    def sync_all(self):
+        with self._lock:
+            journals = list(self._journals)
+        for journal in journals:
+            journal.sync()
+
+journal_flusher = JournalFlusher()
+atexit.register(journal_flusher.sync_all)
+
+# ============================================
+# 历史存储
+# ============================================
+class HistoryStore:
+    """state.history 的存储接口：行为上类似列表（追加、len、切片、迭代），并支持按条件查询。
+    查询以 cursor（记录位置，从 1 开始）分页，返回 (entries, next_cursor)；默认实现为线性扫描。
+    durable 为 True 的存储重启后内容仍在，日志可以据此压缩"""
+    durable = False
+
+    def append(self, entry):
+        self.extend([entry])
+
+    def extend(self, entries):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def truncate(self, length):
+        """只保留前 length 条"""
+        if length:
+            raise NotImplementedError
+        self.clear()
+
+    def sync(self):
+        """把已写入的记录落盘"""
+        pass
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __getitem__(self, index):
+        raise NotImplementedError
+
+    def __iter__(self):
+        return self.iter_range()
+
+    def iter_range(self, start=0, stop=None):
+        """惰性遍历 [start, stop) 区间的记录，用于流式输出大段历史"""
+        return iter(self[start:stop])
+
+    def _scan(self, cursor, limit, predicate):
+        results = []
+        for position, entry in enumerate(self.iter_range(cursor), start=cursor + 1):
+            if predicate(entry):
+                results.append(entry)
+                if len(results) == limit:
+                    return results, position
+        return results, None
+
+    def query(self, agent_id=None, has_event=None, round_from=None, round_to=None,
+              time_from=None, time_to=None, cursor=0, limit=100):
+        def predicate(entry):
+            return ((agent_id is None or entry.get('agent_id') == agent_id)
+                    and (has_event is None or bool(entry.get('event')) == has_event)
+                    and (round_from is None or entry['round'] >= round_from)
+                    and (round_to is None or entry['round'] <= round_to)
+                    and (time_from is None or entry['timestamp'] >= time_from)
+                    and (time_to is None or entry['timestamp'] <= time_to))
+        return self._scan(cursor, limit, predicate)
+
+    def search(self, text, cursor=0, limit=100):
+        return self._scan(cursor, limit, lambda entry: text in entry.get('content', ''))
+
+    def close(self):
+        pass
+
+class MemoryHistoryStore(HistoryStore):
+    """纯内存列表实现"""
+    def __init__(self):
+        self._entries = []
+
+    def extend(self, entries):
+        self._entries.extend(entries)
+
+    def clear(self):
+        self._entries = []
+
+    def truncate(self, length):
+        del self._entries[length:]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        return self._entries[index]
+
+    def iter_range(self, start=0, stop=None):
+        return iter(self._entries[start:stop])
+
+class TieredHistoryStore(HistoryStore):
+    """内存中只保留最近的热数据窗口（不少于 prompt 构建所需的条数），较旧的记录按固定条数
+    压缩成 gzip JSONL 分段写到磁盘。读取时透明地跨两层，内存占用不随回合数增长。
+    分段只是日志回放结果的缓存：directory 为会话固定的溢写目录，打开时清空上次运行（包括崩溃）留下的分段，
+    第一次溢写时才创建；为空时在系统临时目录新建一个。清空或截断历史会换一代分段文件，
+    仍在读旧数据的迭代器读完后才删除旧分段"""
+    def __init__(self, directory=None, hot_size=None, segment_size=1000):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='history-spill-')
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+        self.directory = directory
+        self.hot_size = hot_size if hot_size is not None else HOT_HISTORY_SIZE
+        self.segment_size = segment_size
+        self._hot = deque()
+        self._spilled = 0
+        self._generation = 0
+        self._readers = {}      # 分段代数 -> 正在读取的迭代器数
+        self._stale = []        # 等读者归还后再删除的 (代数, 分段数)
+        self._cached_segment = (None, None)
+        self._lock = threading.Lock()
+
+    def _segment_path(self, generation, number):
+        return os.path.join(self.directory, f'segment-{generation:04d}-{number:08d}.jsonl.gz')
+
+    def extend(self, entries):
+        with self._lock:
+            self._hot.extend(entries)
+            while len(self._hot) >= self.hot_size + self.segment_size:
+                self._spill()
+
+    def _spill(self):
+        chunk = [self._hot.popleft() for _ in range(self.segment_size)]
+        number = self._spilled // self.segment_size
+        os.makedirs(self.directory, exist_ok=True)
+        with gzip.open(self._segment_path(self._generation, number), 'wt', encoding='utf-8') as f:
+            for entry in chunk:
+                f.write(json.dumps(entry, ensure_ascii=False))
+                f.write('\n')
+        self._spilled += self.segment_size
+
+    def _load_segment(self, generation, number):
+        key = (generation, number)
+        with self._lock:
+            cached_key, cached = self._cached_segment
+            if cached_key == key:
+                return cached
+        entries = self._read_segment(generation, number)
+        with self._lock:
+            self._cached_segment = (key, entries)
+        return entries
+
+    def _read_segment(self, generation, number):
+        with gzip.open(self._segment_path(generation, number), 'rt', encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def _remove_segments(self, generation, count):
+        for number in range(count):
+            try:
+                os.remove(self._segment_path(generation, number))
+            except FileNotFoundError:
+                pass
+
+    def _retire_generation(self):
+        """在锁内调用：换一代分段，返回需要立即删除的旧分段 (代数, 分段数)，有读者时推迟到读者归还"""
+        old = (self._generation, self._spilled // self.segment_size)
+        self._generation += 1
+        self._cached_segment = (None, None)
+        if self._readers.get(old[0]):
+            self._stale.append(old)
+            return None
+        return old
+
+    def clear(self):
+        with self._lock:
+            old = self._retire_generation()
+            self._hot.clear()
+            self._spilled = 0
+        if old:
+            self._remove_segments(*old)
+
+    def truncate(self, length):
+        with self._lock:
+            if length >= self._spilled:
+                while self._spilled + len(self._hot) > length:
+                    self._hot.pop()
+                return
+            # 截到已溢写的部分：保留的整段以硬链接（不支持时复制）放进新一代，被截断的那段剩余部分回到热数据
+            keep = length // self.segment_size
+            generation = self._generation
+            rest = length - keep * self.segment_size
+            partial = self._read_segment(generation, keep)[:rest] if rest else []
+            old = self._retire_generation()
+            for number in range(keep):
+                source = self._segment_path(generation, number)
+                target = self._segment_path(self._generation, number)
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copyfile(source, target)
+            self._hot = deque(partial)
+            self._spilled = keep * self.segment_size
+        if old:
+            self._remove_segments(*old)
+
+    def __len__(self):
+        return self._spilled + len(self._hot)
+
+    def iter_range(self, start=0, stop=None):
+        """区间、热数据与分段代数在调用时于锁内确定，之后追加或清空历史都不影响返回的迭代器"""
+        with self._lock:
+            generation = self._generation
+            spilled = self._spilled
+            total = spilled + len(self._hot)
+            hot = list(self._hot) if stop is None or stop > spilled else []
+            self._readers[generation] = self._readers.get(generation, 0) + 1
+        start, stop, _ = slice(start, stop).indices(total)
+        entries = self._iter_snapshot(generation, spilled, hot, start, stop)
+        # 先走到 try 里面，迭代器没读完就被关闭或回收时也会归还读引用
+        next(entries)
+        return entries
+
+    def _iter_snapshot(self, generation, spilled, hot, start, stop):
+        try:
+            yield
+            position = start
+            while position < min(stop, spilled):
+                number = position // self.segment_size
+                base = number * self.segment_size
+                entries = self._load_segment(generation, number)
+                for offset in range(position - base, min(self.segment_size, stop - base)):
+                    yield entries[offset]
+                position = base + self.segment_size
+            for offset in range(max(position, spilled) - spilled, stop - spilled):
+                yield hot[offset]
+        finally:
+            self._release_reader(generation)
+
+    def _release_reader(self, generation):
+        with self._lock:
+            self._readers[generation] -= 1
+            if self._readers[generation]:
+                return
+            del self._readers[generation]
+            stale = [item for item in self._stale if item[0] == generation]
+            self._stale = [item for item in self._stale if item[0] != generation]
+        for item in stale:
+            self._remove_segments(*item)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self.iter_range())[index]
+            return list(self.iter_range(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('history index out of range')
+        return next(self.iter_range(index, index + 1))
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+# trigram 分词索引不了少于 3 个字符的查询（中文词多为两个字），另建一个按单字与相邻两字切分的索引
+SHORT_GRAM_PATTERN = re.compile(r'[^\W_]+')
+
+def short_grams(text):
+    """每段连续的字母数字或汉字切成单字与相邻两字，空格分隔，交给 unicode61 分词"""
+    grams = []
+    for run in SHORT_GRAM_PATTERN.findall(text.lower()):
+        grams.extend(run)
+        grams.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return ' '.join(grams)
+
+class SQLiteHistoryStore(HistoryStore):
+    """SQLite 实现：按 round、agent_id、event、timestamp 建索引，content 建 FTS5 全文索引（trigram 分词以支持中文子串）。
+    seq 为记录位置（从 1 开始），/api/history?since=N 与游标分页都直接走主键"""
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.durable = path != ':memory:'
+        self._conn = None
+        self._lock = threading.Lock()
+        self.fts = None
+        self.grams = False
+        self._count = 0
+        self._generation = 0    # 每次清空加一，读到一半的迭代器发现变化后停止，不会混入清空后写入的记录
+        # 磁盘上还没有数据库时推迟到第一次写入才创建，只读访问的会话不在磁盘上留下文件
+        if not self.durable or os.path.exists(path):
+            self._open()
+
+    def _open(self):
+        import sqlite3
+        if self.durable:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE IF NOT EXISTS history (
+                seq INTEGER PRIMARY KEY,
+                round INTEGER,
+                agent_id TEXT,
+                event TEXT,
+                timestamp TEXT,
+                content TEXT,
+                body TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS history_round ON history(round);
+            CREATE INDEX IF NOT EXISTS history_agent ON history(agent_id, seq);
+            CREATE INDEX IF NOT EXISTS history_event ON history(seq) WHERE event IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS history_timestamp ON history(timestamp);
+        ''')
+        self.fts = self._create_fts()
+        self.grams = self.fts == 'trigram' and self._create_grams()
+        self._count = self._conn.execute('SELECT COUNT(*) FROM history').fetchone()[0]
+
+    def _create_fts(self):
+        import sqlite3
+        for tokenizer in ('trigram', 'unicode61'):
+            try:
+                self._conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5("
+                    f"content, content='history', content_rowid='seq', tokenize='{tokenizer}')"
+                )
+                return tokenizer
+            except sqlite3.OperationalError:
+                continue
+        return None
+
+    def _create_grams(self):
+        """短查询索引，无内容表（只存倒排）；旧数据库第一次打开时补建"""
+        exists = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'history_grams'"
+        ).fetchone()
+        self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS history_grams USING fts5("
+                           "grams, content='', tokenize='unicode61')")
+        if not exists:
+            with self._conn:
+                rows = self._conn.execute('SELECT seq, content FROM history').fetchall()
+                self._conn.executemany('INSERT INTO history_grams (rowid, grams) VALUES (?, ?)',
+                                       [(seq, short_grams(content or '')) for seq, content in rows])
+        return True
+
+    def extend(self, entries):
+        with self._lock:
+            if self._conn is None:
+                self._open()
+            rows = []
+            for offset, entry in enumerate(entries):
+                rows.append((
+                    self._count + offset + 1,
+                    entry.get('round'),
+                    entry.get('agent_id'),
+                    entry.get('event') or None,
+                    entry.get('timestamp'),
+                    entry.get('content', ''),
+                    json.dumps(entry, ensure_ascii=False)
+                ))
+            with self._conn:
+                self._conn.executemany(
+                    'INSERT INTO history (seq, round, agent_id, event, timestamp, content, body) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+                )
+                if self.fts:
+                    self._conn.executemany(
+                        'INSERT INTO history_fts (rowid, content) VALUES (?, ?)',
+                        [(row[0], row[5]) for row in rows]
+                    )
+                if self.grams:
+                    self._conn.executemany(
+                        'INSERT INTO history_grams (rowid, grams) VALUES (?, ?)',
+                        [(row[0], short_grams(row[5] or '')) for row in rows]
+                    )
+            self._count += len(rows)
+
+    def clear(self):
+        with self._lock:
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute('DELETE FROM history')
+                    if self.fts:
+                        self._conn.execute("INSERT INTO history_fts (history_fts) VALUES ('delete-all')")
+                    if self.grams:
+                        self._conn.execute("INSERT INTO history_grams (history_grams) VALUES ('delete-all')")
+            self._count = 0
+            self._generation += 1
+
+    def truncate(self, length):
+        with self._lock:
+            if self._conn is not None:
+                with self._conn:
+                    if self.fts:
+                        self._conn.execute(
+                            "INSERT INTO history_fts (history_fts, rowid, content) "
+                            "SELECT 'delete', seq, content FROM history WHERE seq > ?", (length,)
+                        )
+                    if self.grams:
+                        # 无内容表删除时须给出原来写入的内容
+                        self._conn.executemany(
+                            "INSERT INTO history_grams (history_grams, rowid, grams) VALUES ('delete', ?, ?)",
+                            [(seq, short_grams(content or '')) for seq, content in self._conn.execute(
+                                'SELECT seq, content FROM history WHERE seq > ?', (length,)
+                            ).fetchall()]
+                        )
+                    self._conn.execute('DELETE FROM history WHERE seq > ?', (length,))
+            self._count = min(self._count, length)
+            self._generation += 1
+
+    def sync(self):
+        # synchronous = OFF 时 SQLite 自己不 fsync，压缩日志前手动把数据库与 WAL 文件落盘
+        if not self.durable:
+            return
+        with self._lock:
+            for path in (self.path, self.path + '-wal'):
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except FileNotFoundError:
+                    continue
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def __len__(self):
+        return self._count
+
+    def _rows(self, sql, params):
+        with self._lock:
+            if self._conn is None:
+                return []
+            return [json.loads(row[0]) for row in self._conn.execute(sql, params)]
+
+    def iter_range(self, start=0, stop=None, batch=1000):
+        """区间在调用时于锁内确定；历史在读取途中被清空时迭代提前结束"""
+        with self._lock:
+            generation = self._generation
+            start, stop, _ = slice(start, stop).indices(self._count)
+        return self._iter_batches(generation, start, stop, batch)
+
+    def _iter_batches(self, generation, start, stop, batch):
+        while start < stop:
+            with self._lock:
+                if self._generation != generation:
+                    return
+                chunk = [json.loads(row[0]) for row in self._conn.execute(
+                    'SELECT body FROM history WHERE seq > ? AND seq <= ? ORDER BY seq',
+                    (start, min(stop, start + batch))
+                )]
+            if not chunk:
+                return
+            yield from chunk
+            start += len(chunk)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._count)
+            if step != 1:
+                return self[:][index]
+            if stop <= start:
+                return []
+            return self._rows(
+                'SELECT body FROM history WHERE seq > ? AND seq <= ? ORDER BY seq', (start, stop)
+            )
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('history index out of range')
+        return self._rows('SELECT body FROM history WHERE seq = ?', (index + 1,))[0]
+
+    def _page(self, sql, params, limit):
+        with self._lock:
+            if self._conn is None:
+                return [], None
+            rows = self._conn.execute(sql, params + [limit]).fetchall()
+        entries = [json.loads(row[1]) for row in rows]
+        next_cursor = rows[-1][0] if len(rows) == limit else None
+        return entries, next_cursor
+
+    def query(self, agent_id=None, has_event=None, round_from=None, round_to=None,
+              time_from=None, time_to=None, cursor=0, limit=100):
+        conditions, params = ['seq > ?'], [cursor]
+        if agent_id is not None:
+            conditions.append('agent_id = ?')
+            params.append(agent_id)
+        if has_event is not None:
+            conditions.append('event IS NOT NULL' if has_event else 'event IS NULL')
+        if round_from is not None:
+            conditions.append('round >= ?')
+            params.append(round_from)
+        if round_to is not None:
+            conditions.append('round <= ?')
+            params.append(round_to)
+        if time_from is not None:
+            conditions.append('timestamp >= ?')
+            params.append(time_from)
+        if time_to is not None:
+            conditions.append('timestamp <= ?')
+            params.append(time_to)
+        sql = f"SELECT seq, body FROM history WHERE {' AND '.join(conditions)} ORDER BY seq LIMIT ?"
+        return self._page(sql, params, limit)
+
+    def search(self, text, cursor=0, limit=100):
+        if self.fts and (self.fts != 'trigram' or len(text) >= 3):
+            # 整体作为短语匹配，避免用户输入被解析为 FTS 查询语法
+            phrase = '"' + text.replace('"', '""') + '"'
+            sql = ('SELECT h.seq, h.body FROM history_fts f JOIN history h ON h.seq = f.rowid '
+                   'WHERE history_fts MATCH ? AND f.rowid > ? ORDER BY f.rowid LIMIT ?')
+            return self._page(sql, [phrase, cursor], limit)
+        if self.grams and SHORT_GRAM_PATTERN.fullmatch(text.lower()):
+            sql = ('SELECT h.seq, h.body FROM history_grams g JOIN history h ON h.seq = g.rowid '
+                   'WHERE history_grams MATCH ? AND g.rowid > ? ORDER BY g.rowid LIMIT ?')
+            return self._page(sql, [f'"{text.lower()}"', cursor], limit)
+        # 含标点的短查询没有索引，退化为扫描
+        escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        sql = "SELECT seq, body FROM history WHERE content LIKE ? ESCAPE '\\' AND seq > ? ORDER BY seq LIMIT ?"
+        return self._page(sql, [f'%{escaped}%', cursor], limit)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+
+def create_history_store(directory=None):
+    """按 SOCIALSIM_HISTORY_STORE（sqlite / tiered / memory）创建历史存储；
+    directory 为空（未开启持久化）时 SQLite 存储放在内存中，分层存储溢写到系统临时目录"""
+    if HISTORY_STORE == 'sqlite':
+        return SQLiteHistoryStore(os.path.join(directory, 'history.db') if directory else ':memory:')
+    if HISTORY_STORE == 'tiered':
+        return TieredHistoryStore(os.path.join(directory, 'history-spill') if directory else None)
+    return MemoryHistoryStore()
 
 # ============================================
 # 全局状态管理
 # ============================================
 class SimulationState:
-    def __init__(self):
+    def __init__(self, session_id='default', journal=None, history=None):
+        self.session_id = session_id
+        self.journal = journal
+        self.last_active = time.time()
         self.world = {}
         self.agents = []
-        self.history = []
+        self.history = history if history is not None else MemoryHistoryStore()
         self.running = False
         self.speed = 3
         self.round = 0
         self.event_queue = queue.Queue()
         self.api_key = os.environ.get('DASHSCOPE_API_KEY', '')
         self.model = 'qwen-plus'
+        self.backend = os.environ.get('SOCIALSIM_BACKEND', 'dashscope')
         self.lock = threading.Lock()
         self.custom_templates = {}
         self.metrics = []
         self.metric_data = {}
-        
-state = SimulationState()
+        self.runner = None
+        self.events = EventBroadcaster()
+        self.metric_evaluator = MetricEvaluator(self)
+        self.metric_concurrency = 1         # 同时评估的指标快照数，每次评估是一次 LLM 调用
+        self.summarizer = MemorySummarizer(self)
+        self.history_generation = 0         # 历史被清空、导入或恢复时递增，后台任务据此丢弃过期结果
+        self.memory_summary = False         # 滚动摘要：每 SUMMARY_CHUNK 条历史额外调用 1 + 角色数次 LLM
+        self.summaries = {}                 # 'world' 或角色 id -> 滚动摘要记录
+        self.summary_covered = 0            # 已压缩进摘要的历史条数
+        self.summary_failures = 0           # 当前摘要区间连续失败的次数
+        self.memory_index = MemoryIndex()   # 与 history 按位置对应的检索索引
+        self.memory_recall_k = 0            # 每个角色 prompt 检索的相关往事条数，0 表示关闭
+        self.graph = RelationshipGraph()
+        self.relevant_others = 0            # 大于 0 时“其他角色”只列出关系最强的这么多人
+        self.stream_tokens = True           # 角色回合以流式调用，分片通过 'token' 事件推送
+        self.prompts = PromptCache()
+        self.schedule_mode = 'round_robin'  # round_robin: 轮流行动；simultaneous: 同一快照上并发行动
+        self.batch_size = 0                 # 同时模式每步行动的角色数，0 表示全部角色
+        self.max_workers = 8                # 同时模式下并发 LLM 调用上限
+        self.prompt_token_budget = 0        # 角色 prompt 输入 token 预算（含系统提示），0 表示固定取最近 20 条
+        self.max_output_tokens = 2000       # 角色回合的输出 token 上限，与 call_qwen_api 的默认值一致
+        self.temperature = 0.85             # 角色回合的采样温度
+        self.max_consecutive_errors = 5     # 连续这么多步失败（重试用尽后）才停止模拟
+        self.call_timeout = 60.0            # 单次 LLM 调用尝试的时限（秒），0 表示不限
+        self.hedge_requests = False         # 调用超过 p95 延迟仍无产出时发起一次对冲请求
+        self.token_usage = {'calls': 0, 'input_tokens': 0, 'output_tokens': 0}
+
+    def is_blank(self):
+        """从没写过检查点、也没有任何内容的会话（例如只读请求带来的新会话），淘汰它不会丢失数据"""
+        return (not (self.world or self.agents or self.metrics or self.custom_templates or len(self.history))
+                and self.api_key == os.environ.get('DASHSCOPE_API_KEY', '')
+                and (self.journal is None or not self.journal.exists()))
+
+    def close(self):
+        self.running = False
+        self.events.close()
+        if self.runner is not None:
+            self.runner.cancel()
+        self.metric_evaluator.close()
+        self.summarizer.close()
+        if self.journal is not None:
+            self.journal.close()
+        self.history.close()
+
+CHECKPOINT_FIELDS = (
+    'world', 'agents', 'metrics', 'custom_templates', 'model', 'backend',
+    'speed', 'schedule_mode', 'batch_size', 'max_workers', 'round',
+    'prompt_token_budget', 'max_output_tokens', 'memory_recall_k', 'relevant_others',
+    'stream_tokens', 'temperature', 'max_consecutive_errors', 'call_timeout', 'hedge_requests',
+    'memory_summary', 'metric_concurrency'
+)
+
+def save_checkpoint(state):
+    """保存历史以外的配置（不包含 API Key），在配置变更后调用"""
+    if state.journal is not None:
+        state.journal.checkpoint({field: getattr(state, field) for field in CHECKPOINT_FIELDS})
+
+def reset_journal(state):
+    """在持有 state.lock 时调用：历史被清空或替换后重新开始日志，并写入当前历史与指标数据"""
+    if state.journal is None:
+        return
+    state.journal.reset({field: getattr(state, field) for field in CHECKPOINT_FIELDS})
+    for entry in state.history:
+        state.journal.append('log', entry)
+    for metric_id, points in state.metric_data.items():
+        for point in points:
+            state.journal.append('metric', {'metric_id': metric_id, **point})
+    for record in state.summaries.values():
+        state.journal.append('summary', record)
+
+JOURNAL_COMPACT_EVERY = 10000   # 历史存储可持久化时，每新增这么多条历史压缩一次日志
+
+def maybe_compact_journal(state):
+    """在持有 state.lock 时调用：历史存储自身已持久化时，把历史位置、指标数据与摘要写入检查点，
+    之前的日志分段随之删除，重启时只需回放检查点之后的日志"""
+    journal = state.journal
+    if journal is None or not state.history.durable:
+        return
+    if len(state.history) - journal.history_length < JOURNAL_COMPACT_EVERY:
+        return
+    state.history.sync()
+    journal.reset({field: getattr(state, field) for field in CHECKPOINT_FIELDS}, {
+        'history_length': len(state.history),
+        'history_last_id': state.history[-1].get('id'),
+        'metric_data': state.metric_data,
+        'summaries': state.summaries,
+        'summary_covered': state.summary_covered,
+        'graph': state.graph.snapshot()
+    })
+
+RESTORE_CHUNK = 10000
+
+def restore_state(state):
+    """由检查点和日志回放重建会话状态。日志压缩过时，检查点之前的历史直接复用磁盘上的存储，
+    指标数据、摘要与关系图从检查点读取，只回放之后的日志"""
+    state.history_generation += 1
+    checkpoint, records = state.journal.load()
+    for field in CHECKPOINT_FIELDS:
+        if field in checkpoint:
+            setattr(state, field, checkpoint[field])
+    state.metric_data = {m['id']: [] for m in state.metrics}
+    base = checkpoint.get('history_length', 0)
+    lost = False
+    if base:
+        for metric_id, points in checkpoint.get('metric_data', {}).items():
+            if metric_id in state.metric_data:
+                state.metric_data[metric_id] = points
+        state.summaries = checkpoint.get('summaries', {})
+        state.summary_covered = checkpoint.get('summary_covered', 0)
+        if len(state.history) < base or state.history[base - 1].get('id') != checkpoint.get('history_last_id'):
+            print(f"会话 {state.session_id} 的历史存储与检查点不一致，检查点之前的 {base} 条历史无法恢复")
+            state.history.clear()
+            state.summaries = {}
+            state.summary_covered = 0
+            base = 0
+            lost = True
+    # 磁盘上的历史存储在检查点之后还有内容时先只回放计数，最后确认与日志一致则直接复用
+    stored = len(state.history) - base
+    count, last_id, chunk = 0, None, []
+    for record in records:
+        data = record['d']
+        if record['t'] == 'log':
+            count += 1
+            last_id = data.get('id')
+            state.round = max(state.round, data.get('round', 0))
+            if not stored:
+                chunk.append(data)
+                if len(chunk) >= RESTORE_CHUNK:
+                    state.history.extend(chunk)
+                    chunk = []
+        elif record['t'] == 'metric' and data['metric_id'] in state.metric_data:
+            # 已删除指标的数据点不再恢复
+            state.metric_data[data['metric_id']].append({
+                'round': data['round'],
+                'value': data['value']
+            })
+        elif record['t'] == 'summary':
+            state.summaries[data['key']] = data
+            state.summary_covered = data['covered']
+        elif record['t'] == 'summary_skip':
+            state.summary_covered = data['covered']
+    if chunk:
+        state.history.extend(chunk)
+    if stored and (stored != count or state.history[-1]['id'] != last_id):
+        state.history.truncate(base)
+        _, records = state.journal.load()
+        chunk = []
+        for record in records:
+            if record['t'] == 'log':
+                chunk.append(record['d'])
+                if len(chunk) >= RESTORE_CHUNK:
+                    state.history.extend(chunk)
+                    chunk = []
+        state.history.extend(chunk)
+    if lost:
+        # 检查点里的历史位置已不成立，按现有内容重写日志
+        reset_journal(state)
+    rebuild_memory_index(state)
+    if base and checkpoint.get('graph'):
+        state.graph.load(checkpoint['graph'])
+        state.graph.rebuild(state.history.iter_range(base), state.agents, clear=False)
+    else:
+        state.graph.rebuild(state.history, state.agents)
+    state.prompts.reset(state)
+
+def load_state_data(state, data):
+    """在持有 state.lock 时调用：用 /api/export 格式（或模板格式）的数据替换会话内容，并重建派生索引"""
+    if 'world' in data:
+        state.world = data['world']
+    if 'agents' in data:
+        state.agents = data['agents']
+    if 'history' in data:
+        state.history_generation += 1
+        state.history.clear()
+        state.history.extend(data['history'])
+        state.round = len(data['history'])
+        state.summaries = data.get('summaries', {})
+        state.summary_covered = data.get('summary_covered', 0)
+    if 'metrics' in data:
+        state.metrics = data['metrics']
+    if 'metric_data' in data:
+        state.metric_data = data['metric_data']
+    if 'custom_templates' in data:
+        state.custom_templates = data['custom_templates']
+    rebuild_memory_index(state)
+    state.graph.rebuild(state.history, state.agents)
+    state.prompts.reset(state)
+
+def status_snapshot(state):
+    return {
+        'running': state.running,
+        'round': state.round,
+        'speed': state.speed,
+        'agent_count': len(state.agents),
+        'history_length': len(state.history),
+        'schedule_mode': state.schedule_mode,
+        'batch_size': state.batch_size,
+        'token_usage': dict(state.token_usage)
+    }
+
+def publish_status(state):
+    state.events.publish('status', status_snapshot(state))
+
+# ============================================
+# 异步模拟引擎
+# ============================================
+class SimulationEngine:
+    """在独立线程中运行 asyncio 事件循环，所有模拟任务和 LLM 调用都在这里调度"""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self._thread.start()
+
+    def submit(self, coro):
+        """提交协程，返回 concurrent.futures.Future"""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """在同步代码（如 Flask 路由）中等待协程结果"""
+        return self.submit(coro).result(timeout)
+
+engine = SimulationEngine()
+
+# ============================================
+# 会话管理
+# ============================================
+DEFAULT_SESSION = 'default'
+
+class SessionLimitError(Exception):
+    pass
+
+class SessionManager:
+    """按会话 ID 管理互相隔离的 SimulationState；限制同时运行的模拟数量，回收长时间不活跃的会话。
+    恢复会话（日志回放可能要几秒）与关闭会话都在注册表锁之外进行，不阻塞其他会话的请求"""
+    def __init__(self, max_sessions=100, max_running=8, idle_timeout=3600, sweep_interval=60, evict_after=300):
+        self.max_sessions = max_sessions
+        self.max_running = max_running
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.evict_after = evict_after  # 会话数满时，只淘汰空闲超过这么久且能从磁盘恢复的会话
+        self._sessions = {}
+        self._loading = {}      # 正在恢复的会话 ID -> 完成事件，同一 ID 的其他请求等它完成
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+    def get(self, session_id):
+        while True:
+            closing = []
+            with self._lock:
+                now = time.time()
+                if now - self._last_sweep > self.sweep_interval:
+                    closing += self._evict_idle(now)
+                sim = self._sessions.get(session_id)
+                if sim is not None:
+                    sim.last_active = now
+                    return sim
+                loading = self._loading.get(session_id)
+                if loading is None:
+                    if len(self._sessions) + len(self._loading) >= self.max_sessions:
+                        closing += self._evict_idle(now, force=True)
+                    full = len(self._sessions) + len(self._loading) >= self.max_sessions
+                    if not full:
+                        loading = self._loading[session_id] = threading.Event()
+                        break
+            self._close(closing)
+            if loading is None:
+                raise SessionLimitError('会话数量已达上限')
+            loading.wait()
+        self._close(closing)
+        try:
+            sim = self._load(session_id)
+        finally:
+            with self._lock:
+                del self._loading[session_id]
+            loading.set()
+        with self._lock:
+            sim.last_active = time.time()
+            self._sessions[session_id] = sim
+        return sim
+
+    def _load(self, session_id):
+        """创建会话；开启持久化时若磁盘上已有该会话的日志则从中恢复"""
+        if not DURABLE:
+            return SimulationState(session_id, history=create_history_store())
+        directory = os.path.join(DATA_DIR, 'sessions', session_id)
+        journal = HistoryJournal(directory)
+        sim = SimulationState(session_id, journal, create_history_store(directory))
+        if journal.exists():
+            restore_state(sim)
+        return sim
+
+    def _evict_idle(self, now, force=False):
+        """在锁内调用：移出不在运行的空闲会话，返回待关闭的会话。force 时再淘汰一个最久未活跃的以腾出位置：
+        空白会话随时可以淘汰，其他会话只在能从磁盘恢复（开启持久化）且已空闲 evict_after 秒以上时"""
+        self._last_sweep = now
+        idle = sorted(
+            (sim for sid, sim in self._sessions.items() if sid != DEFAULT_SESSION and not sim.running),
+            key=lambda sim: sim.last_active
+        )
+        removed = [sim for sim in idle if now - sim.last_active > self.idle_timeout]
+        if force and len(self._sessions) - len(removed) + len(self._loading) >= self.max_sessions:
+            spare = [sim for sim in idle if sim not in removed and (
+                sim.is_blank() or (DURABLE and now - sim.last_active > self.evict_after)
+            )]
+            removed += spare[:1]
+        for sim in removed:
+            del self._sessions[sim.session_id]
+        return removed
+
+    def _close(self, sims):
+        """在锁外关闭已移出注册表的会话；从没写过检查点的会话无法恢复，磁盘上留下的空目录一并删除"""
+        for sim in sims:
+            sim.close()
+            if sim.journal is not None and not sim.journal.exists():
+                shutil.rmtree(sim.journal.directory, ignore_errors=True)
+
+    def key_in_use(self, api_key, exclude=None):
+        """是否还有其他会话在用这个 API Key（共享同一个池化客户端）"""
+        with self._lock:
+            return any(sim.api_key == api_key for sim in self._sessions.values() if sim is not exclude)
+
+    def remove(self, session_id):
+        with self._lock:
+            sim = self._sessions.pop(session_id, None)
+        directory = os.path.join(DATA_DIR, 'sessions', session_id)
+        if sim is not None:
+            self._close([sim])
+        elif not (DURABLE and os.path.isdir(directory)):
+            return False
+        shutil.rmtree(directory, ignore_errors=True)
+        return True
+
+    def try_start(self, sim):
+        """原子地检查全局运行上限并把会话标记为运行中"""
+        with self._lock:
+            if sim.running:
+                return False
+            running = sum(1 for s in self._sessions.values() if s.running)
+            if running >= self.max_running:
+                raise SessionLimitError('同时运行的模拟数量已达上限')
+            sim.running = True
+            return True
+
+    def list(self):
+        with self._lock:
+            return [{
+                'session_id': sim.session_id,
+                'running': sim.running,
+                'round': sim.round,
+                'agent_count': len(sim.agents),
+                'history_length': len(sim.history),
+                'last_active': datetime.fromtimestamp(sim.last_active).isoformat()
+            } for sim in self._sessions.values()]
+
+sessions = SessionManager()
+
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def current_state():
+    """按请求头 X-Session-Id 或查询参数 session 解析当前会话，未指定时使用默认会话"""
+    session_id = request.headers.get('X-Session-Id') or request.args.get('session') or DEFAULT_SESSION
+    if not SESSION_ID_PATTERN.match(session_id):
+        abort(400, description='无效的会话ID')
+    try:
+        return sessions.get(session_id)
+    except SessionLimitError as e:
+        abort(503, description=str(e))
+
+# ============================================
+# LLM 客户端连接池
+# ============================================
+DASHSCOPE_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+
+class LLMClientPool:
+    """按 (api_key, base_url) 复用 AsyncOpenAI 客户端，底层 HTTP 连接保持长连接。
+    客户端按租用计数：被丢弃或重建时仍有调用在用的客户端，等最后一个调用归还后才关闭"""
+    def __init__(self, pool_size=10, idle_timeout=60.0):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._clients = {}
+        self._leases = {}       # 客户端 -> 在用的调用数
+        self._retired = set()   # 已移出池、等待归还后关闭的客户端
+        self._lock = threading.Lock()
+
+    def _build_client(self, api_key, base_url):
+        # 延迟导入：openai 占了模块导入时间的大头，离线后端与无界面批量运行用不到它
+        import httpx
+        from openai import AsyncOpenAI
+        
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+                keepalive_expiry=self.idle_timeout
+            )
+        )
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+    @asynccontextmanager
+    async def lease(self, api_key, base_url=DASHSCOPE_BASE_URL):
+        """在一次调用期间租用客户端"""
+        key = (api_key, base_url)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = self._build_client(api_key, base_url)
+            self._leases[client] = self._leases.get(client, 0) + 1
+        try:
+            yield client
+        finally:
+            with self._lock:
+                self._leases[client] -= 1
+                idle = not self._leases[client]
+                if idle:
+                    del self._leases[client]
+                close = idle and client in self._retired
+                if close:
+                    self._retired.discard(client)
+            if close:
+                await client.close()
+
+    def _retire(self, clients):
+        """在持有 self._lock 时调用：没有调用在用的客户端立即关闭，其余等归还时关闭"""
+        for client in clients:
+            if self._leases.get(client):
+                self._retired.add(client)
+            else:
+                engine.submit(client.close())
+
+    def discard(self, api_key, base_url=DASHSCOPE_BASE_URL):
+        with self._lock:
+            client = self._clients.pop((api_key, base_url), None)
+            if client is not None:
+                self._retire([client])
+
+    def configure(self, pool_size=None, idle_timeout=None):
+        """修改连接池参数，已有客户端会在下次调用时按新参数重建"""
+        if pool_size is not None:
+            self.pool_size = max(1, int(pool_size))
+        if idle_timeout is not None:
+            self.idle_timeout = max(0.0, float(idle_timeout))
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._retire(clients)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'idle_timeout': self.idle_timeout,
+                'clients': len(self._clients),
+                'leased_calls': sum(self._leases.values()),
+                'retiring_clients': len(self._retired)
+            }
+
+llm_pool = LLMClientPool()
+
+# ============================================
+# LLM 响应缓存
+# ============================================
+class ResponseCache:
+    """call_qwen_api 的响应缓存：内存 LRU 层 + SQLite 磁盘层（按总大小淘汰最久未用）。
+    mode: off 关闭；auto 只缓存 temperature 为 0 的确定性调用；replay 强制缓存所有调用，用于回放对比实验。
+    事件循环上只访问内存层：磁盘读取放到线程池（lookup），写入由后台线程批量提交"""
+    MODES = ('off', 'auto', 'replay')
+
+    def __init__(self, path, memory_entries=512, max_disk_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.mode = 'off'
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._memory = OrderedDict()
+        self._conn = None
+        self._lock = threading.Lock()       # 只保护内存层与计数
+        self._db_lock = threading.Lock()    # 保护 SQLite 连接与磁盘用量的运行总数
+        self._disk_entries = 0
+        self._disk_bytes = 0
+        self._pending = queue.Queue()   # 待写入磁盘的 (操作, key, 值)
+        self._writer = None
+
+    @staticmethod
+    def make_key(model, messages, temperature, max_tokens):
+        payload = json.dumps([model, messages, temperature, max_tokens], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def applies(self, temperature):
+        if self.mode == 'replay':
+            return True
+        if self.mode == 'auto' and temperature == 0:
+            return True
+        if self.mode != 'off':
+            self.bypassed += 1
+        return False
+
+    def _db(self):
+        """调用方须持有 _db_lock"""
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            import sqlite3
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, response TEXT NOT NULL, '
+                'size INTEGER NOT NULL, last_used REAL NOT NULL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS cache_last_used ON cache(last_used)')
+            self._conn.commit()
+            self._recount()
+        return self._conn
+
+    def _recount(self):
+        self._disk_entries, self._disk_bytes = self._conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache'
+        ).fetchone()
+
+    def _remember(self, key, response):
+        self._memory[key] = response
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _get_memory(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+        return None
+
+    def get(self, key):
+        """同步查询，磁盘层的读取会阻塞调用线程"""
+        cached = self._get_memory(key)
+        if cached is not None:
+            return cached
+        with self._db_lock:
+            row = self._db().execute('SELECT response FROM cache WHERE key = ?', (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, row[0])
+        self._enqueue('touch', key, time.time())
+        return row[0]
+
+    async def lookup(self, key):
+        """在事件循环上查询：内存层直接返回，磁盘层放到线程池读取"""
+        cached = self._get_memory(key)
+        if cached is not None:
+            return cached
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    def put(self, key, response):
+        """内存层立即生效，磁盘写入交给后台线程；没有内容的回复不缓存"""
+        if response is None:
+            return
+        with self._lock:
+            self._remember(key, response)
+        self._enqueue('put', key, response)
+
+    def _enqueue(self, op, key, value):
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, daemon=True)
+                self._writer.start()
+        self._pending.put((op, key, value))
+
+    def _write_loop(self):
+        # 延迟导入：只用内存层或关闭缓存时用不到 sqlite3
+        import sqlite3
+        while True:
+            batch = [self._pending.get()]
+            while True:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            evicted = []
+            try:
+                # 只持有连接锁，事件循环上的内存层查询不会等磁盘写入
+                with self._db_lock:
+                    db = self._db()
+                    try:
+                        for op, key, value in batch:
+                            if op == 'put':
+                                self._write(db, key, value)
+                            elif op == 'touch':
+                                db.execute('UPDATE cache SET last_used = ? WHERE key = ?', (value, key))
+                            elif op == 'clear':
+                                db.execute('DELETE FROM cache')
+                                self._disk_entries = self._disk_bytes = 0
+                        evicted = self._evict(db)
+                        db.commit()
+                    except sqlite3.Error:
+                        db.rollback()
+                        self._recount()
+                        raise
+            except sqlite3.Error as e:
+                print(f"响应缓存写入失败: {e}")
+            finally:
+                if evicted:
+                    with self._lock:
+                        for key in evicted:
+                            self._memory.pop(key, None)
+                for _ in batch:
+                    self._pending.task_done()
+
+    def _write(self, db, key, value):
+        size = len(value.encode('utf-8'))
+        row = db.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+        db.execute(
+            'INSERT OR REPLACE INTO cache (key, response, size, last_used) VALUES (?, ?, ?, ?)',
+            (key, value, size, time.time())
+        )
+        if row is None:
+            self._disk_entries += 1
+        self._disk_bytes += size - (row[0] if row else 0)
+
+    def flush(self):
+        """等待排队的磁盘写入完成"""
+        if self._writer is not None:
+            self._pending.join()
+
+    def _evict(self, db):
+        """按运行中的总大小判断是否超限，超限时才按最久未用删除；返回被删除的 key"""
+        evicted = []
+        if self._disk_bytes <= self.max_disk_bytes:
+            return evicted
+        for key, size in db.execute('SELECT key, size FROM cache ORDER BY last_used'):
+            evicted.append((key, size))
+            self._disk_bytes -= size
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+        db.executemany('DELETE FROM cache WHERE key = ?', [(key,) for key, _ in evicted])
+        self._disk_entries -= len(evicted)
+        return [key for key, _ in evicted]
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        # 排在已有写入之后执行，之前排队的响应不会在清空后又写回磁盘
+        self._enqueue('clear', None, None)
+        self.flush()
+
+    def stats(self):
+        with self._db_lock:
+            disk_entries, disk_bytes = (0, 0)
+            if self._conn is not None or os.path.exists(self.path):
+                self._db()
+                disk_entries, disk_bytes = self._disk_entries, self._disk_bytes
+        with self._lock:
+            memory_entries = len(self._memory)
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'mode': self.mode,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_entries': memory_entries,
+            'disk_entries': disk_entries,
+            'disk_bytes': disk_bytes,
+            'max_disk_bytes': self.max_disk_bytes
+        }
+
+response_cache = ResponseCache(os.path.join(DATA_DIR, 'llm_cache.db'))
+atexit.register(response_cache.flush)
+
+# ============================================
+# LLM 限流与重试
+# ============================================
+class LLMServiceError(Exception):
+    """带 HTTP 状态码的服务端错误，模拟后端注入的故障也用它表示"""
+    def __init__(self, message, status_code=503, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+def retryable_status(error):
+    """可重试错误返回状态码（网络错误与超时记为 0），不可重试返回 None"""
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status if status in RETRYABLE_STATUS else None
+    # 3.11 之前 asyncio.TimeoutError 不是内置 TimeoutError 的子类
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return 0
+    # openai 的连接错误与超时不带状态码，按类名识别，免得为此在模块加载时导入 openai
+    if type(error).__name__ in ('APIConnectionError', 'APITimeoutError'):
+        return 0
+    return None
+
+def retry_after_seconds(error):
+    """服务端建议的等待秒数：LLMServiceError.retry_after 或响应头 Retry-After"""
+    seconds = getattr(error, 'retry_after', None)
+    response = getattr(error, 'response', None)
+    if seconds is None and response is not None:
+        try:
+            seconds = float(response.headers.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+    return seconds
+
+class TokenBucket:
+    """每分钟补充 rate 个令牌、容量也为 rate 的令牌桶，rate 为 0 表示不限。
+    取令牌时立即扣除并返回需要等待的秒数，余额可以透支，后来者排在透支之后，总速率不超过 rate"""
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / 60.0)
+        self.updated = now
+
+    def reserve(self, amount):
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        self.tokens -= min(amount, self.rate)
+        return max(0.0, -self.tokens * 60.0 / self.rate)
+
+    def refund(self, amount):
+        """按实际用量结算预扣的令牌，amount 为负时补扣"""
+        if self.rate > 0:
+            self._refill()
+            self.tokens = min(self.rate, self.tokens + amount)
+
+    def try_take(self, amount):
+        """余额足够时扣除并返回 True，不透支也不等待"""
+        if self.rate <= 0:
+            return True
+        self._refill()
+        amount = min(amount, self.rate)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def drain(self):
+        if self.rate > 0:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+    def set_rate(self, rate):
+        self._refill()
+        # 从不限速切换过来时桶是满的
+        self.tokens = min(self.tokens if self.rate > 0 else rate, rate) if rate > 0 else 0.0
+        self.rate = rate
+
+class LLMRateLimiter:
+    """进程内所有会话共享的 LLM 调用调度：每分钟请求数与 token 数两个令牌桶、在途调用上限，
+    可重试错误按带抖动的指数退避重试。收到 429 时有效速率与在途上限减半并让所有调用一起暂停，
+    之后每次成功调用逐步恢复（加性增、乘性减），从而贴着配额跑而不反复触发限流"""
+    MIN_FACTOR = 0.05
+    RECOVERY_STEP = 0.02
+
+    def __init__(self, requests_per_min=0, tokens_per_min=0, max_in_flight=32,
+                 max_retries=4, base_delay=1.0, max_delay=30.0):
+        self.requests_per_min = requests_per_min
+        self.tokens_per_min = tokens_per_min
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = 1.0
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.waited = 0.0
+        self.requests = TokenBucket(requests_per_min)
+        self.tokens = TokenBucket(tokens_per_min)
+        self._cond = None   # 首次使用时在引擎事件循环中创建，3.8/3.9 的 asyncio 原语会绑定创建时的事件循环
+        self._cut_until = 0.0
+        self.rng = random.Random()
+
+    def configure(self, requests_per_min=None, tokens_per_min=None, max_in_flight=None,
+                  max_retries=None, base_delay=None, max_delay=None):
+        if requests_per_min is not None:
+            self.requests_per_min = max(0, int(requests_per_min))
+        if tokens_per_min is not None:
+            self.tokens_per_min = max(0, int(tokens_per_min))
+        if max_in_flight is not None:
+            self.max_in_flight = max(0, int(max_in_flight))
+        if max_retries is not None:
+            self.max_retries = max(0, int(max_retries))
+        if base_delay is not None:
+            self.base_delay = max(0.0, float(base_delay))
+        if max_delay is not None:
+            self.max_delay = max(0.0, float(max_delay))
+        self.factor = 1.0
+        self._apply_factor()
+
+    def _apply_factor(self):
+        self.requests.set_rate(self.requests_per_min * self.factor)
+        self.tokens.set_rate(self.tokens_per_min * self.factor)
+
+    def _in_flight_limit(self):
+        if not self.max_in_flight:
+            return 0
+        return max(1, int(self.max_in_flight * self.factor))
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def _acquire(self, tokens):
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(
+                lambda: not self._in_flight_limit() or self.in_flight < self._in_flight_limit()
+            )
+            self.in_flight += 1
+        try:
+            wait = max(self.requests.reserve(1), self.tokens.reserve(tokens),
+                       self.paused_until - time.monotonic())
+            if wait > 0:
+                self.waited += wait
+                await asyncio.sleep(wait)
+        except BaseException:
+            await self._release()
+            raise
+
+    async def _release(self):
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            cond.notify_all()
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """第 attempt 次重试前的等待：上限按指数增长，在 [0, 上限] 内均匀抖动，不早于服务端建议的时间"""
+        delay = self.rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        return max(delay, retry_after or 0.0)
+
+    def _on_success(self):
+        self.calls += 1
+        if self.factor < 1.0:
+            self.factor = min(1.0, self.factor + self.RECOVERY_STEP)
+            self._apply_factor()
+
+    def _on_rate_limited(self, retry_after):
+        self.rate_limited += 1
+        now = time.monotonic()
+        pause = retry_after if retry_after is not None else self.base_delay
+        self.paused_until = max(self.paused_until, now + pause)
+        self.requests.drain()
+        self.tokens.drain()
+        # 同一波并发调用陆续收到的 429 只减速一次
+        if now >= self._cut_until:
+            self._cut_until = now + max(pause, self.base_delay)
+            self.factor = max(self.MIN_FACTOR, self.factor / 2)
+            self._apply_factor()
+
+    async def call(self, request, tokens, can_retry=None):
+        """在限流下执行 request()，可重试错误自动退避重试；can_retry() 返回 False 时
+        （例如流式回复已经推送了部分内容）不再重试。tokens 为预扣的 token 数，调用后用 settle 结算"""
+        attempt = 0
+        while True:
+            await self._acquire(tokens)
+            try:
+                result = await request()
+            except Exception as e:
+                status = retryable_status(e)
+                retry_after = retry_after_seconds(e)
+                if status == 429:
+                    self._on_rate_limited(retry_after)
+                if status is None or attempt >= self.max_retries or (can_retry and not can_retry()):
+                    self.failures += 1
+                    raise
+                attempt += 1
+                self.retries += 1
+                delay = self.backoff_delay(attempt, retry_after)
+            else:
+                self._on_success()
+                return result
+            finally:
+                await self._release()
+            await asyncio.sleep(delay)
+
+    def try_reserve(self, tokens):
+        """额外的对冲请求不排队：只在没有降速、没有暂停、在途调用未满且两个桶都有余量时
+        占用配额并计入在途调用，结束后必须用 release_reserved 归还"""
+        if self.factor < 1.0 or time.monotonic() < self.paused_until:
+            return False
+        limit = self._in_flight_limit()
+        if limit and self.in_flight >= limit:
+            return False
+        if not self.requests.try_take(1):
+            return False
+        if not self.tokens.try_take(tokens):
+            self.requests.refund(1)
+            return False
+        self.in_flight += 1
+        return True
+
+    async def release_reserved(self, reserved, used):
+        """结束 try_reserve 占用的调用：结算 token 配额并让出在途名额"""
+        self.settle(reserved, used)
+        await self._release()
+
+    def settle(self, reserved, used):
+        self.tokens.refund(reserved - used)
+
+    def stats(self):
+        return {
+            'requests_per_min': self.requests_per_min,
+            'tokens_per_min': self.tokens_per_min,
+            'max_in_flight': self.max_in_flight,
+            'max_retries': self.max_retries,
+            'base_delay': self.base_delay,
+            'max_delay': self.max_delay,
+            'factor': round(self.factor, 3),
+            'effective_requests_per_min': round(self.requests.rate, 1),
+            'effective_tokens_per_min': round(self.tokens.rate, 1),
+            'effective_max_in_flight': self._in_flight_limit(),
+            'in_flight': self.in_flight,
+            'paused_for': round(max(0.0, self.paused_until - time.monotonic()), 2),
+            'calls': self.calls,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'failures': self.failures,
+            'waited_s': round(self.waited, 2)
+        }
+
+rate_limiter = LLMRateLimiter(
+    requests_per_min=int(os.environ.get('SOCIALSIM_RPM', 0)),
+    tokens_per_min=int(os.environ.get('SOCIALSIM_TPM', 0))
+)
+
+# ============================================
+# LLM 熔断与对冲请求
+# ============================================
+class CircuitOpenError(Exception):
+    """熔断期间直接拒绝调用，不重试"""
+    pass
+
+class CircuitBreaker:
+    """按后端统计最近 window 秒内的调用结果，服务端错误率超过 threshold（且至少 min_calls 次）时熔断，
+    cooldown 秒内的调用直接失败；之后放行一个探测调用，成功则恢复，失败则继续熔断"""
+    def __init__(self, threshold=0.5, min_calls=10, window=30.0, cooldown=15.0):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probe_started = None
+        self.rejected = 0
+        self.trips = 0
+        self._outcomes = deque()    # (时间, 是否失败)
+
+    def check(self):
+        if self.state == 'closed':
+            return
+        now = time.monotonic()
+        if self.state == 'open' and now - self.opened_at >= self.cooldown:
+            self.state = 'half_open'
+            self.probe_started = None
+        # 半开时只放行一个探测调用；探测调用被取消而没有结果时，超过 cooldown 再放行下一个
+        if self.state == 'half_open' and (self.probe_started is None or now - self.probe_started >= self.cooldown):
+            self.probe_started = now
+            return
+        self.rejected += 1
+        raise CircuitOpenError('LLM 服务错误率过高，已暂时熔断，请稍后再试')
+
+    def record(self, failed):
+        now = time.monotonic()
+        if self.state == 'open':
+            # 熔断前已经发出的调用陆续返回，结果不再计入
+            return
+        if self.state == 'half_open':
+            if failed:
+                self._trip(now)
+            else:
+                self.state = 'closed'
+                self._outcomes.clear()
+            return
+        self._outcomes.append((now, failed))
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            self._outcomes.popleft()
+        failures = sum(1 for _, f in self._outcomes if f)
+        if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.threshold:
+            self._trip(now)
+
+    def _trip(self, now):
+        self.state = 'open'
+        self.opened_at = now
+        self.trips += 1
+        self._outcomes.clear()
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'recent_calls': len(self._outcomes),
+            'recent_failures': sum(1 for _, f in self._outcomes if f),
+            'trips': self.trips,
+            'rejected': self.rejected
+        }
+
+class LatencyTracker:
+    """最近 size 次成功调用的首个产出延迟（流式为首个分片，非流式为完整回复），样本不足时不给出分位数"""
+    def __init__(self, size=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def quantile(self, q):
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def hedged_call(attempt, hedge_after=None, on_token=None, latency=None, can_hedge=None, hedge_done=None):
+    """attempt(emit) 发起一次调用，流式回复的每段文本交给 emit。hedge_after 秒内还没有任何产出、
+    且 can_hedge() 允许时再发起一次相同的调用，先产出的一方胜出：只转发它的分片、返回它的结果，
+    另一方被取消。对冲调用结束（完成、失败或被取消）时 await hedge_done(结果或 None)，
+    用来归还 can_hedge 占用的资源。latency 给出时记录从首次调用发起到胜出方首个产出的延迟。
+    返回 (结果, 是否发起了对冲)"""
+    started = []
+    winner = []
+    first_output = asyncio.Event()
+    
+    def claim(index):
+        if not winner:
+            winner.append(index)
+            first_output.set()
+            if latency is not None:
+                latency.add(time.monotonic() - started[0])
+    
+    def launch():
+        index = len(started)
+        started.append(time.monotonic())
+        
+        def emit(delta):
+            claim(index)
+            if winner[0] == index and on_token is not None:
+                on_token(delta)
+        
+        async def run():
+            result = None
+            try:
+                result = await attempt(emit)
+                claim(index)
+                return result
+            finally:
+                if index and hedge_done is not None:
+                    await hedge_done(result)
+        return asyncio.ensure_future(run())
+    
+    tasks = [launch()]
+    waiter = asyncio.ensure_future(first_output.wait())
+    try:
+        if hedge_after is not None:
+            await asyncio.wait([tasks[0], waiter], timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+            if not winner and not tasks[0].done() and (can_hedge is None or can_hedge()):
+                tasks.append(launch())
+        while not winner:
+            pending = [t for t in tasks if not t.done()]
+            if not pending:
+                # 所有调用都在产出前失败，抛出第一个调用的错误交给重试逻辑
+                return tasks[0].result(), len(tasks) > 1
+            await asyncio.wait(pending + [waiter], return_when=asyncio.FIRST_COMPLETED)
+        for index, task in enumerate(tasks):
+            if index != winner[0]:
+                task.cancel()
+        return await tasks[winner[0]], len(tasks) > 1
+    finally:
+        waiter.cancel()
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()    # 取走落败方的异常，避免未读取的警告
+
+# ============================================
+# LLM 后端
+# ============================================
+class LLMBackend:
+    """call_qwen_api 通过当前选中的后端完成一次对话补全"""
+    name = ''
+    requires_key = True
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        # 流式调用记录首个分片的延迟，非流式记录完整回复的延迟，分开统计
+        self.latencies = {True: LatencyTracker(), False: LatencyTracker()}
+        self.hedged = 0
+
+    def health(self):
+        return {
+            **self.breaker.stats(),
+            'hedged': self.hedged,
+            'p95_first_output_s': self.latencies[False].quantile(0.95),
+            'p95_first_token_s': self.latencies[True].quantile(0.95)
+        }
+
+    async def complete(self, messages, model, temperature, max_tokens, api_key):
+        """返回 (content, usage)；usage 为 {'input_tokens', 'output_tokens'}，后端无法提供时为 None"""
+        raise NotImplementedError
+
+    async def stream(self, messages, model, temperature, max_tokens, api_key, usage):
+        """逐段产出回复文本，后端报告用量时填入 usage；默认退化为一次性产出完整回复"""
+        content, reported = await self.complete(messages, model, temperature, max_tokens, api_key)
+        if reported is not None:
+            usage.update(reported)
+        yield content
+
+class DashScopeBackend(LLMBackend):
+    name = 'dashscope'
+
+    async def complete(self, messages, model, temperature, max_tokens, api_key):
+        async with llm_pool.lease(api_key) as client:
+            completion = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                top_p=0.9,
+            )
+        
+        usage = None
+        if getattr(completion, 'usage', None) is not None:
+            usage = {
+                'input_tokens': completion.usage.prompt_tokens,
+                'output_tokens': completion.usage.completion_tokens
+            }
+        return completion.choices[0].message.content, usage
+
+    async def stream(self, messages, model, temperature, max_tokens, api_key, usage):
+        async with llm_pool.lease(api_key) as client:
+            chunks = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                top_p=0.9,
+                stream=True,
+                stream_options={'include_usage': True},
+            )
+            async for chunk in chunks:
+                # 最后一个分片只携带用量，没有 choices
+                if getattr(chunk, 'usage', None) is not None:
+                    usage['input_tokens'] = chunk.usage.prompt_tokens
+                    usage['output_tokens'] = chunk.usage.completion_tokens
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+class MockBackend(LLMBackend):
+    """离线模拟后端：不访问网络，按 prompt 类型返回格式正确的响应，
+    可配置合成延迟、抖动、长尾（tail_rate 的调用额外慢 tail_latency 秒）、错误率和每分钟请求配额
+    （超出时返回 429），用于压测引擎本身的吞吐上限"""
+    name = 'mock'
+    requires_key = False
+    STREAM_CHUNKS = 8
+
+    def __init__(self, latency=0.5, jitter=0.0, error_rate=0.0, rate_limit=0, tail_rate=0.0, tail_latency=5.0,
+                 seed=None):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rng = random.Random(seed)
+        self._admitted = deque()
+
+    def configure(self, latency=None, jitter=None, error_rate=None, rate_limit=None, tail_rate=None,
+                  tail_latency=None, seed=None):
+        if latency is not None:
+            self.latency = max(0.0, float(latency))
+        if jitter is not None:
+            self.jitter = max(0.0, float(jitter))
+        if error_rate is not None:
+            self.error_rate = min(1.0, max(0.0, float(error_rate)))
+        if rate_limit is not None:
+            self.rate_limit = max(0, int(rate_limit))
+            self._admitted.clear()
+        if tail_rate is not None:
+            self.tail_rate = min(1.0, max(0.0, float(tail_rate)))
+        if tail_latency is not None:
+            self.tail_latency = max(0.0, float(tail_latency))
+        if seed is not None:
+            self.rng.seed(seed)
+
+    def stats(self):
+        return {'latency': self.latency, 'jitter': self.jitter, 'error_rate': self.error_rate,
+                'rate_limit': self.rate_limit, 'tail_rate': self.tail_rate, 'tail_latency': self.tail_latency}
+
+    def _delay(self):
+        delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+        if self.rng.random() < self.tail_rate:
+            delay += self.tail_latency
+        return delay
+
+    def _admit(self):
+        """按 60 秒滑动窗口检查请求配额"""
+        if not self.rate_limit:
+            return
+        now = time.monotonic()
+        while self._admitted and now - self._admitted[0] >= 60.0:
+            self._admitted.popleft()
+        if len(self._admitted) >= self.rate_limit:
+            raise LLMServiceError('模拟后端超出每分钟请求配额', status_code=429,
+                                  retry_after=60.0 - (now - self._admitted[0]))
+        self._admitted.append(now)
+
+    async def complete(self, messages, model, temperature, max_tokens, api_key):
+        self._admit()
+        delay = self._delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self._respond(messages)
+
+    async def stream(self, messages, model, temperature, max_tokens, api_key, usage):
+        """把合成延迟均摊到各个分片上，首个分片在 1/STREAM_CHUNKS 的延迟后到达"""
+        self._admit()
+        delay = self._delay()
+        content, _ = self._respond(messages)
+        size = max(1, -(-len(content) // self.STREAM_CHUNKS))
+        for start in range(0, len(content), size):
+            if delay > 0:
+                await asyncio.sleep(delay / self.STREAM_CHUNKS)
+            yield content[start:start + size]
+
+    def _respond(self, messages):
+        if self.rng.random() < self.error_rate:
+            raise LLMServiceError('模拟后端注入的错误')
+        
+        prompt = messages[-1]['content']
+        if '## 需要评估的指标' in prompt:
+            return self._metric_values(prompt), None
+        if '请根据以下世界设定，生成' in prompt:
+            return self._agents(prompt), None
+        if '请帮助生成这个指标的配置' in prompt:
+            return self._metric_config(prompt), None
+        if '## 需要压缩的新事件' in prompt:
+            return self._summary(prompt), None
+        return self._agent_turn(prompt), None
+
+    def _metric_values(self, prompt):
+        values = {}
+        for name, low, high in re.findall(r'^- (.+?): .*\(范围: (-?[\d.]+)-(-?[\d.]+)\)$', prompt, re.M):
+            values[name] = round(self.rng.uniform(float(low), float(high)), 1)
+        return json.dumps(values, ensure_ascii=False)
+
+    def _agents(self, prompt):
+        match = re.search(r'生成(\d+)个', prompt)
+        count = int(match.group(1)) if match else 4
+        traits = ['谨慎', '热情', '多疑', '务实', '理想主义', '圆滑', '固执', '乐观']
+        return json.dumps([{
+            'name': f"模拟角色{self.rng.randrange(1000000):06d}",
+            'personality': f"{self.rng.choice(traits)}而{self.rng.choice(traits)}的人，说话直接，做事讲究效率。",
+            'goal': '在这个世界中站稳脚跟，争取更多资源',
+            'memory': '刚来到这里不久，对周围的人还不太了解。'
+        } for _ in range(count)], ensure_ascii=False)
+
+    def _metric_config(self, prompt):
+        match = re.search(r'"([^"]+)"', prompt)
+        name = (match.group(1) if match else '模拟指标')[:6]
+        return json.dumps({
+            'name': name,
+            'description': f'衡量{name}的程度',
+            'min': 0,
+            'max': 100,
+            'unit': '分'
+        }, ensure_ascii=False)
+
+    def _summary(self, prompt):
+        rounds = [int(r) for r in re.findall(r'^\[回合(\d+)\]', prompt, re.M)]
+        names = list(dict.fromkeys(re.findall(r'^\[回合\d+\] (.+?): ', prompt, re.M)))[:4]
+        moods = ['逐渐缓和', '愈发紧张', '僵持不下', '出现转机']
+        span = f"第{min(rounds)}至{max(rounds)}回合" if rounds else '近来'
+        return f"{span}，{'、'.join(names) or '众人'}围绕资源与彼此的关系反复交涉，局势{self.rng.choice(moods)}。"
+
+    def _agent_turn(self, prompt):
+        match = re.search(r'请以 (.+?) 的身份', prompt)
+        name = match.group(1) if match else '我'
+        others = re.findall(r'^• (.+?): ', prompt, re.M)
+        target = self.rng.choice(others) if others else '大家'
+        actions = ['环顾四周', '皱了皱眉', '点了点头', '放下手中的活计', '叹了口气']
+        lines = ['这件事我们得好好商量一下。', '我觉得现在还不是时候。', '你说的有道理，我同意。', '这样下去可不行。']
+        return (f"*{self.rng.choice(actions)}，看向{target}* "
+                f"\"{target}，{self.rng.choice(lines)}\" "
+                f"({name}心里盘算着下一步该怎么做)")
+
+LLM_BACKENDS = {
+    'dashscope': DashScopeBackend(),
+    'mock': MockBackend()
+}
+
+def llm_ready(state):
+    """当前后端是否可以发起调用（DashScope 需要 API Key，模拟后端不需要）"""
+    backend = LLM_BACKENDS.get(state.backend)
+    return backend is not None and (bool(state.api_key) or not backend.requires_key)
 
 # ============================================
 # Qwen API 调用
 # ============================================
-def call_qwen_api(messages, temperature=0.85):
-    if not state.api_key:
+# 跨进程共享的在途 LLM 调用上限（multiprocessing 信号量），由参数扫描的工作进程在启动时设置
+llm_call_slots = None
+
+async def acquire_llm_slot():
+    if llm_call_slots is None:
+        return
+    # 跨进程信号量的 acquire 会阻塞，放到线程里等待，不阻塞事件循环
+    waiter = asyncio.get_running_loop().run_in_executor(None, llm_call_slots.acquire)
+    try:
+        await asyncio.shield(waiter)
+    except asyncio.CancelledError:
+        # 调用被取消时线程仍可能随后拿到名额，拿到后立即归还
+        waiter.add_done_callback(lambda _: llm_call_slots.release())
+        raise
+
+def try_acquire_llm_slot():
+    """不等待地占用一个名额，拿不到时返回 False"""
+    return llm_call_slots is None or llm_call_slots.acquire(block=False)
+
+def release_llm_slot():
+    if llm_call_slots is not None:
+        llm_call_slots.release()
+
+async def call_qwen_api(state, messages, temperature=0.85, max_tokens=2000, usage=None, on_token=None, on_retry=None):
+    """usage 传入字典时填入本次调用的 input_tokens / output_tokens；
+    后端未返回用量时用本地估算（estimated），命中缓存时不计入会话累计用量（cached）。
+    传入 on_token 时以流式方式调用，每收到一段文本回调一次，返回值仍是完整回复。
+    调用经过全局限流器：429、5xx 与网络错误自动退避重试，流式回复已推送过内容后不再重试，
+    除非传入的 on_retry() 返回 True（调用方已丢弃收到的部分内容，可以从头再来）。
+    每次尝试受 state.call_timeout 限时（从拿到跨进程名额开始计），后端熔断时直接失败；
+    开启 state.hedge_requests 时，超过该后端 p95 首个产出延迟仍无产出的调用会再发起一次相同调用，
+    取先返回者；对冲调用只在能立即拿到名额与限流余量时发起"""
+    backend = LLM_BACKENDS.get(state.backend)
+    if backend is None:
+        raise ValueError(f"未知的LLM后端: {state.backend}")
+    if backend.requires_key and not state.api_key:
         raise ValueError("请先设置API Key")
     
-    client = OpenAI(
-        api_key=state.api_key,
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-    )
+    cache_key = None
+    if response_cache.applies(temperature):
+        cache_key = response_cache.make_key(f"{backend.name}:{state.model}", messages, temperature, max_tokens)
+        cached = await response_cache.lookup(cache_key)
+        if cached is not None:
+            if usage is not None:
+                usage.update(estimate_usage(messages, cached), cached=True)
+            if on_token is not None:
+                on_token(cached)
+            return cached
     
-    completion = client.chat.completions.create(
-        model=state.model,
-        messages=messages,
-        temperature=temperature,
-        max_tokens=2000,
-        top_p=0.9,
-    )
+    streaming = on_token is not None
+    emitted = []
+    
+    def forward(delta):
+        emitted.append(delta)
+        on_token(delta)
+    
+    async def attempt(emit):
+        if streaming:
+            reported = {}
+            parts = []
+            async for delta in backend.stream(messages, state.model, temperature, max_tokens, state.api_key, reported):
+                parts.append(delta)
+                emit(delta)
+            return ''.join(parts), reported or None
+        return await backend.complete(messages, state.model, temperature, max_tokens, state.api_key)
+    
+    # 按输入估算加输出上限预扣 token 配额，返回后按实际用量结算
+    reserved = estimate_usage(messages, '')['input_tokens'] + max_tokens
+    latency = backend.latencies[streaming]
+    
+    def can_hedge():
+        if not try_acquire_llm_slot():
+            return False
+        if rate_limiter.try_reserve(reserved):
+            return True
+        release_llm_slot()
+        return False
+    
+    async def hedge_done(result):
+        # 落败或失败的对冲调用按已发送的输入计费，其余预扣配额退回
+        release_llm_slot()
+        counted = (result and result[1]) or estimate_usage(messages, result[0] if result else '')
+        await rate_limiter.release_reserved(reserved, counted['input_tokens'] + counted['output_tokens'])
     
-    return completion.choices[0].message.content
+    async def request():
+        backend.breaker.check()
+        hedge_after = latency.quantile(0.95) if state.hedge_requests else None
+        # 等待跨进程名额不计入时限，也不算作后端的失败
+        await acquire_llm_slot()
+        try:
+            try:
+                result, hedged = await asyncio.wait_for(
+                    hedged_call(attempt, hedge_after, forward if streaming else None, latency,
+                                can_hedge=can_hedge, hedge_done=hedge_done),
+                    state.call_timeout or None
+                )
+            except asyncio.TimeoutError:
+                raise LLMServiceError(f'LLM 调用超过 {state.call_timeout:g} 秒未完成', status_code=408) from None
+        except Exception as e:
+            if retryable_status(e) not in (None, 429):
+                backend.breaker.record(failed=True)
+            raise
+        finally:
+            release_llm_slot()
+        backend.breaker.record(failed=False)
+        if hedged:
+            backend.hedged += 1
+        return result
+    
+    def can_retry():
+        if emitted and (on_retry is None or not on_retry()):
+            return False
+        emitted.clear()
+        return True
+    
+    content, reported = await rate_limiter.call(request, reserved, can_retry=can_retry)
+    counted = reported or estimate_usage(messages, content)
+    rate_limiter.settle(reserved, counted['input_tokens'] + counted['output_tokens'])
+    state.token_usage['calls'] += 1
+    state.token_usage['input_tokens'] += counted['input_tokens']
+    state.token_usage['output_tokens'] += counted['output_tokens']
+    if usage is not None:
+        usage.update(counted)
+        if reported is None:
+            usage['estimated'] = True
+    if cache_key is not None and content is not None:
+        response_cache.put(cache_key, content)
+    return content
+
+# ============================================
+# 结构化输出解析
+# ============================================
+class JSONObjectStream:
+    """增量 JSON 解析：逐段喂入流式回复，顶层对象或顶层数组里的元素对象一闭合就解析出来，
+    嵌套在元素内部的对象随元素一起返回。对象之外的说明文字被忽略：说明文字里的花括号
+    （后面不是引号）不当作对象起点，解析失败或括号不配对时从该起点之后的下一个花括号重新找，
+    回复结束时用 finish() 对还没闭合的起点做同样的处理；回复被截断时已经完整的对象照常可用"""
+    STRUCTURE = re.compile(r'[{}\[\]"\\]')
+    NEXT_CHAR = re.compile(r'\s*(\S)')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """丢弃已喂入的内容与解析结果，重试调用前使用"""
+        self.objects = []
+        self._buf = ''
+        self._pos = 0           # 下一个待扫描的位置，转义符在分段末尾时可能越过缓冲区末尾一位
+        self._start = None      # 当前元素对象在缓冲区中的起点
+        self._stack = []
+        self._in_string = False
+
+    def _resync(self):
+        """当前起点不是一个完整对象，回到它之后重新扫描"""
+        self._pos = self._start + 1
+        self._start = None
+        self._stack.clear()
+        self._in_string = False
+
+    def feed(self, text):
+        """喂入一段文本，返回其中新闭合的对象"""
+        buf = self._buf + text
+        found = []
+        while True:
+            match = self.STRUCTURE.search(buf, self._pos)
+            if match is None:
+                self._pos = max(self._pos, len(buf))
+                break
+            ch = match.group()
+            self._pos = match.end()
+            if self._in_string:
+                if ch == '\\':
+                    self._pos += 1
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                # 容器外的引号属于说明文字
+                self._in_string = bool(self._stack)
+            elif ch in '{[':
+                if ch == '{' and self._stack in ([], ['[']):
+                    following = self.NEXT_CHAR.match(buf, self._pos)
+                    if following is None:
+                        # 还看不出后面是不是键名，等下一段再判断
+                        self._pos = match.start()
+                        break
+                    if following.group(1) not in '"}':
+                        continue
+                    self._start = match.start()
+                self._stack.append(ch)
+            elif ch in '}]' and self._stack:
+                if self._stack.pop() + ch not in ('{}', '[]'):
+                    # 括号不配对，说明前面混进了说明文字
+                    if self._start is not None:
+                        self._resync()
+                    else:
+                        self._stack.clear()
+                elif ch == '}' and self._start is not None and self._stack in ([], ['[']):
+                    try:
+                        obj = json.loads(buf[self._start:self._pos])
+                    except ValueError:
+                        obj = None
+                    if isinstance(obj, dict):
+                        found.append(obj)
+                        self._start = None
+                    else:
+                        self._resync()
+        
+        # 只保留还没闭合的元素对象，已扫描过的文字丢掉
+        keep = self._start if self._start is not None else min(self._pos, len(buf))
+        self._buf = buf[keep:]
+        self._pos -= keep
+        if self._start is not None:
+            self._start = 0
+        self.objects.extend(found)
+        return found
+
+    def parse(self, text):
+        """一次性解析完整回复，返回其中的对象"""
+        self.feed(text or '')
+        self.finish()
+        return self.objects
+
+    def finish(self):
+        """回复结束时调用，返回重新扫描还没闭合的起点之后找到的对象"""
+        found = []
+        while self._start is not None:
+            self._buf = self._buf[self._start:]
+            self._start = 0
+            self._resync()
+            found.extend(self.feed(''))
+        return found
 
 # ============================================
 # AI 生成角色
 # ============================================
-def generate_agents_for_world(world, count=4):
-    """根据世界设定生成匹配的角色"""
-    prompt = f"""你是一个社会模拟实验设计专家。请根据以下世界设定，生成{count}个适合这个世界的角色。
+AGENT_BATCH_SIZE = 8         # 每次调用生成的角色数，更多角色拆成多个批次并发生成
+AGENT_OUTPUT_TOKENS = 300    # 每个角色预留的输出 token
+AGENT_FILL_ROUNDS = 3        # 去重或截断后数量不足时补生成的最多轮数
+MAX_GENERATED_AGENTS = 500   # 单次请求最多生成的角色数
+# 多批次并发生成时每批轮流侧重一类人物，避免各批拿到相同的 prompt 生成雷同甚至重名的角色
+AGENT_BATCH_FOCUS = [
+    '掌握权力或资源的人物', '普通劳动者与平民', '外来者与边缘人物', '年轻一代',
+    '年长者与传统的守护者', '商人与中间人', '对现状不满的挑战者', '掌握专门技艺的人（医者、工匠、学者等）'
+]
+NAME_INITIALS = '王李张刘陈杨赵黄周吴徐孙胡朱高林何郭马罗梁宋郑谢韩唐冯于董萧程曹袁邓许傅沈曾彭吕苏卢蒋蔡贾丁魏薛叶阎余潘杜戴夏钟汪田任姜范方石姚谭廖邹熊金陆郝孔白崔康毛邱秦江史顾侯邵孟龙万段'
+
+def agent_batch_focus(index, total):
+    """第 index 个批次（共 total 个）的区分提示：人物类型轮换，姓氏首字按批次错开"""
+    focus = AGENT_BATCH_FOCUS[index % len(AGENT_BATCH_FOCUS)]
+    step = max(1, len(NAME_INITIALS) // max(total, 1))
+    initials = '、'.join(NAME_INITIALS[(index * step + i) % len(NAME_INITIALS)] for i in range(min(step, 6)))
+    return f"这是第{index + 1}/{total}批，其他批次会同时生成别的角色。本批角色侧重于{focus}；" \
+           f"如果世界设定中人物使用中文姓名，本批角色的姓氏优先从 {initials} 中选取"
+
+def build_agent_generation_prompt(world, count, existing_names=(), focus=None):
+    avoid = ''
+    if existing_names:
+        avoid = f"\n\n## 已有角色\n以下角色已经存在，新角色不要重名，身份和立场也尽量与他们错开：{'、'.join(existing_names)}"
+    if focus:
+        avoid += f"\n\n## 本批侧重\n{focus}"
+    return f"""你是一个社会模拟实验设计专家。请根据以下世界设定，生成{count}个适合这个世界的角色。
 
 ## 世界设定
 【名称】{world.get('name', '未命名世界')}
 【背景】{world.get('background', '')}
 【规则】{world.get('rules', '')}
-【资源】{world.get('resources', '')}
+【资源】{world.get('resources', '')}{avoid}
 
 ## 要求
 生成{count}个角色，每个角色应该：
@@ -89,20 +2515,456 @@ def generate_agents_for_world(world, count=4):
   ...
 ]"""
 
-    try:
-        messages = [{"role": "user", "content": prompt}]
-        response = call_qwen_api(messages, temperature=0.8)
-        
-        json_match = re.search(r'\[[\s\S]*\]', response)
-        if json_match:
-            agents = json.loads(json_match.group())
-            for agent in agents:
-                agent['id'] = str(uuid.uuid4())
-            return agents
-    except Exception as e:
-        print(f"生成角色失败: {e}")
+async def generate_agent_batch(state, world, count, existing_names, accept, focus=None):
+    """流式生成一个批次，每个角色对象一闭合就交给 accept，调用中途失败时已交出的角色仍然有效；
+    还没解析出任何角色时失败的调用照常重试"""
+    parser = JSONObjectStream()
     
-    return []
+    def deliver(agents):
+        for agent in agents:
+            if str(agent.get('name') or '').strip():
+                accept({
+                    'name': str(agent['name']).strip(),
+                    'personality': str(agent.get('personality', '')),
+                    'goal': str(agent.get('goal', '')),
+                    'memory': str(agent.get('memory', ''))
+                })
+    
+    def on_retry():
+        if parser.objects:
+            return False
+        parser.reset()
+        return True
+    
+    messages = [{"role": "user", "content": build_agent_generation_prompt(world, count, existing_names, focus)}]
+    await call_qwen_api(
+        state, messages, temperature=0.8, max_tokens=count * AGENT_OUTPUT_TOKENS + 200,
+        on_token=lambda delta: deliver(parser.feed(delta)), on_retry=on_retry
+    )
+    deliver(parser.finish())
+
+async def generate_agents_for_world(state, world, count=4, existing_names=(), on_agent=None):
+    """根据世界设定生成匹配的角色。超过 AGENT_BATCH_SIZE 个时拆成多个批次并发流式调用，各批次侧重不同类型的人物，
+    每个角色解析出来后立即按名字跨批次去重，并回调 on_agent(agent)；重名或截断造成的缺额
+    带上已有名字再补生成，最多 AGENT_FILL_ROUNDS 轮"""
+    agents = []
+    seen = {name.strip().casefold() for name in existing_names}
+    
+    def accept(agent):
+        key = agent['name'].casefold()
+        if key in seen or len(agents) >= count:
+            return
+        seen.add(key)
+        agent['id'] = str(uuid.uuid4())
+        agents.append(agent)
+        if on_agent is not None:
+            on_agent(agent)
+    
+    batches = 0
+    for _ in range(AGENT_FILL_ROUNDS):
+        missing = count - len(agents)
+        if missing <= 0:
+            break
+        sizes = [min(AGENT_BATCH_SIZE, missing - start) for start in range(0, missing, AGENT_BATCH_SIZE)]
+        # 第一轮只提示调用方给出的已有角色；补生成时名单可能很长，只带最近的一部分
+        names = (list(existing_names) + [a['name'] for a in agents])[-100:]
+        # 只有一个批次时不加区分提示；补生成的批次接着之前的序号轮换侧重
+        total = batches + len(sizes)
+        focuses = [agent_batch_focus(batches + i, total) if total > 1 else None for i in range(len(sizes))]
+        batches = total
+        before = len(agents)
+        results = await asyncio.gather(
+            *(generate_agent_batch(state, world, size, names, accept, focus) for size, focus in zip(sizes, focuses)),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"生成角色失败: {result}")
+        if len(agents) == before:
+            # 整轮都没有新角色（调用全部失败或全部重名），不再补生成
+            break
+    return agents
+
+# ============================================
+# Token 估算与上下文打包
+# ============================================
+# 本地近似分词：CJK 字符与全角标点各计 1 个 token，连续字母按约 4 字符 1 个 token，
+# 连续数字按约 3 位 1 个 token，其余非空白符号各计 1 个；对中文为主的 prompt 略偏保守
+TOKEN_PATTERN = re.compile(r'([\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef])|([A-Za-z]+)|(\d+)|\S')
+
+def estimate_tokens(text):
+    tokens = 0
+    for cjk, word, digits in TOKEN_PATTERN.findall(text):
+        if word:
+            tokens += (len(word) + 3) // 4
+        elif digits:
+            tokens += (len(digits) + 2) // 3
+        else:
+            tokens += 1
+    return tokens
+
+def estimate_usage(messages, content):
+    return {
+        # 每条消息约有 4 个 token 的角色与分隔开销
+        'input_tokens': sum(estimate_tokens(m['content']) + 4 for m in messages),
+        'output_tokens': estimate_tokens(content or '')
+    }
+
+def history_candidate(h):
+    """pack_history 的候选项：(agent_id, content, 是否事件, 格式化后的行, token 数)"""
+    line = format_history_line(h)
+    return (h.get('agent_id'), h.get('content', ''), bool(h.get('event')), line, estimate_tokens(line) + 1)
+
+def pack_history(agent, candidates, budget):
+    """在 budget 个 token 内从候选历史（按时间顺序）中挑选条目，按时间顺序返回格式化后的行。
+    越近的条目优先；角色自己的行动、提到该角色的发言和突发事件视为相关，优先级翻倍"""
+    ranked = []
+    count = len(candidates)
+    for index, (agent_id, content, is_event, line, tokens) in enumerate(candidates):
+        age = count - index
+        relevance = (agent_id == agent['id']) + (agent['name'] in content) + is_event
+        ranked.append((age / (1 + relevance), index, tokens))
+    ranked.sort()
+    
+    chosen = []
+    for _, index, tokens in ranked:
+        if tokens <= budget:
+            chosen.append(index)
+            budget -= tokens
+    chosen.sort()
+    return [candidates[i][3] for i in chosen]
+
+# ============================================
+# 记忆检索
+# ============================================
+# 本地 TF-IDF 倒排索引：中文按单字与相邻两字、英文数字按小写单词取特征，按文档频率加权后做余弦相似度。
+# 检索时按特征由稀到常累加倒排项，出现在过多条目中的特征直接跳过，并限制单次查询累加的倒排项总数，
+# 因此查询耗时取决于查询特征的稀有程度而不是历史总长度
+MEMORY_RECALL_MIN_SCORE = 0.1
+MEMORY_MAX_DF = 0.05        # 出现在超过该比例条目中的特征视为停用特征
+MEMORY_MIN_DF_LIMIT = 200   # 条目较少时停用特征阈值的下限
+MEMORY_SCAN_BUDGET = 1000   # 单次查询最多累加的倒排项数；更长的倒排表永远不会被扫描，超过后即丢弃只留文档频率
+MEMORY_WEIGHT_BITS = 16     # 归一化权重量化为 16 位，与条目下标打包进一个 64 位整数
+MEMORY_WEIGHT_SCALE = (1 << MEMORY_WEIGHT_BITS) - 1
+EMBED_TOKEN_PATTERN = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]+|[a-z0-9]+')
+
+def text_features(text):
+    """返回 {特征: 词频}；单字召回同一话题的不同说法，二元组区分具体词语，单字按半个词频计"""
+    features = {}
+    for run in EMBED_TOKEN_PATTERN.findall(text.lower()):
+        if run.isascii():
+            features[run] = features.get(run, 0.0) + 1.0
+            continue
+        for i in range(len(run)):
+            features[run[i]] = features.get(run[i], 0.0) + 0.5
+            if i + 1 < len(run):
+                gram = run[i:i + 2]
+                features[gram] = features.get(gram, 0.0) + 1.0
+    return features
+
+def memory_text(h):
+    """用于建立索引的条目文本；失败记录不参与检索"""
+    if h.get('error'):
+        return ''
+    return f"{h.get('agent', '')} {h.get('content', '')} {h.get('event') or ''}"
+
+class MemoryIndex:
+    """与历史按位置一一对应的检索索引：每次提交增量追加，检索返回 [(历史下标, 相似度)]。
+    文档频率随追加增量更新，已入库条目沿用写入时的权重。索引覆盖全部历史，内存靠压缩倒排表控制：
+    每个倒排项是 (下标 << 16 | 量化权重) 一个 64 位整数；文档频率超过 MEMORY_SCAN_BUDGET 的特征
+    检索时不会被扫描，倒排表直接丢弃只记文档频率，因此每个特征至多占 MEMORY_SCAN_BUDGET 个倒排项"""
+    def __init__(self, ready=True):
+        self.ready = threading.Event()   # 后台重建中的占位索引在重建完成前不可用
+        if ready:
+            self.ready.set()
+        self.clear()
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        self._count = 0
+        self._postings = {}   # 特征 -> array('Q')，按下标递增；文档频率即其长度
+        self._stopped = {}    # 倒排表已丢弃的特征 -> 文档频率
+
+    def df(self, feature):
+        postings = self._postings.get(feature)
+        return len(postings) if postings is not None else self._stopped.get(feature, 0)
+
+    def weigh(self, features):
+        """{特征: 词频} -> 按当前文档频率加权并归一化的 {特征: 权重}"""
+        weights = {}
+        log_total = math.log(self._count + 1) + 1
+        for feature, tf in features.items():
+            weights[feature] = tf * (log_total - math.log(self.df(feature) + 1))
+        norm = sum(w * w for w in weights.values()) ** 0.5
+        if not norm:
+            return {}
+        return {feature: w / norm for feature, w in weights.items()}
+
+    def add(self, entries):
+        # 与 weigh 相同的加权，内联以省去中间字典；建索引是检索开启与恢复时的主要开销
+        postings_of = self._postings
+        stopped = self._stopped
+        log = math.log
+        for h in entries:
+            doc = self._count
+            log_total = log(doc + 1) + 1
+            weights = []
+            for feature, tf in text_features(memory_text(h)).items():
+                postings = postings_of.get(feature)
+                df = len(postings) if postings is not None else stopped.get(feature, 0)
+                weights.append((feature, postings, df, tf * (log_total - log(df + 1))))
+            norm = sum(w[3] * w[3] for w in weights) ** 0.5
+            self._count = doc + 1
+            if not norm:
+                continue
+            scale = MEMORY_WEIGHT_SCALE / norm
+            packed_doc = doc << MEMORY_WEIGHT_BITS
+            for feature, postings, df, weight in weights:
+                if df >= MEMORY_SCAN_BUDGET:
+                    if postings is not None:
+                        del postings_of[feature]
+                    stopped[feature] = df + 1
+                    continue
+                if postings is None:
+                    postings = postings_of[feature] = array('Q')
+                postings.append(packed_doc | int(weight * scale + 0.5))
+
+    def stats(self):
+        postings = sum(len(p) for p in self._postings.values())
+        return {
+            'entries': self._count,
+            'features': len(self._postings) + len(self._stopped),
+            'postings': postings,
+            # 每个倒排项 8 字节；每个特征约 150 字节的字典项与数组对象开销，已丢弃倒排表的约 100 字节
+            'approx_bytes': postings * 8 + len(self._postings) * 150 + len(self._stopped) * 100
+        }
+
+    def search_many(self, queries, k, stop=None, min_score=MEMORY_RECALL_MIN_SCORE):
+        """对每个查询（weigh 的结果）在下标 [0, stop) 范围内取相似度最高的 k 条，按相似度降序"""
+        stop = self._count if stop is None else max(0, min(stop, self._count))
+        if not stop or k <= 0:
+            return [[] for _ in queries]
+        
+        bits = MEMORY_WEIGHT_BITS
+        mask = MEMORY_WEIGHT_SCALE
+        df_limit = max(MEMORY_MIN_DF_LIMIT, self._count * MEMORY_MAX_DF)
+        results = []
+        for query in queries:
+            terms = []
+            for feature, weight in query.items():
+                postings = self._postings.get(feature)
+                if postings is not None and len(postings) <= df_limit:
+                    terms.append((len(postings), weight / MEMORY_WEIGHT_SCALE, postings))
+            terms.sort(key=lambda term: term[0])
+            
+            scores = {}
+            get = scores.get
+            budget = MEMORY_SCAN_BUDGET
+            for df, weight, postings in terms:
+                if df > budget:
+                    break
+                budget -= df
+                end = df if postings[-1] >> bits < stop else bisect.bisect_left(postings, stop << bits)
+                for packed in itertools.islice(postings, end):
+                    doc = packed >> bits
+                    scores[doc] = get(doc, 0.0) + weight * (packed & mask)
+            
+            top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            results.append([(doc, score) for doc, score in top if score >= min_score])
+        return results
+
+def situation_query(index, recent):
+    """眼下正在发生的事（最近几条发言）的检索条件，同一步里所有角色共用"""
+    return index.weigh(text_features(' '.join(h.get('content', '') for h in recent)))
+
+def recall_query(index, agent, situation, event_context=''):
+    """以角色自身（姓名、目标、背景记忆）为主、眼下正在发生的事（situation_query 的结果）为辅组合检索条件。
+    两部分分别归一化后加权，避免近几条发言把检索拉向与最近窗口重复的内容"""
+    query = index.weigh(text_features(
+        ' '.join([agent['name'], agent.get('goal', ''), agent.get('memory', ''), event_context])
+    ))
+    for feature, weight in situation.items():
+        query[feature] = query.get(feature, 0.0) + 0.5 * weight
+    norm = sum(w * w for w in query.values()) ** 0.5
+    return {feature: w / norm for feature, w in query.items()} if norm else {}
+
+def rebuild_memory_index(state):
+    """在持有 state.lock 时调用：检索关闭时换上空索引；开启时换上占位索引，由后台线程在锁外按当前历史重建
+    （每条约 0.15 毫秒，十万条要十几秒），建好后补上期间提交的条目再替换。占位期间 recall_memories 跳过检索"""
+    if not state.memory_recall_k:
+        state.memory_index = MemoryIndex()
+        return
+    placeholder = state.memory_index = MemoryIndex(ready=False)
+    threading.Thread(target=build_memory_index, args=(state, placeholder), daemon=True).start()
+
+def build_memory_index(state, placeholder):
+    try:
+        with state.lock:
+            if state.memory_index is not placeholder:
+                return
+            generation = state.history_generation
+            length = len(state.history)
+            entries = state.history.iter_range(0, length)
+        index = MemoryIndex()
+        index.add(entries)
+        with state.lock:
+            # 期间历史被替换或又触发了重建时放弃这次结果
+            if state.memory_index is placeholder and state.history_generation == generation:
+                index.add(state.history.iter_range(length, len(state.history)))
+                state.memory_index = index
+    finally:
+        placeholder.ready.set()
+
+def wait_memory_index(state, timeout=None):
+    """等待后台重建完成（不能在持有 state.lock 时调用），无界面运行开始前用，使检索结果可复现"""
+    while True:
+        index = state.memory_index
+        if not index.ready.wait(timeout) or state.memory_index is index:
+            return index.ready.is_set()
+
+def recall_memories(state, agents, k, event_context=''):
+    """在持有 state.lock 时调用：为每个角色从 prompt 可能原样引用的窗口之前的历史中取回最相关的 k 条，
+    返回 {角色 id: [格式化后的行]}"""
+    stop = len(state.history) - raw_history_window(state)
+    if k <= 0 or stop <= 0 or not state.memory_index.ready.is_set():
+        return {}
+    recent = list(state.history.iter_range(max(0, len(state.history) - 3), len(state.history)))
+    situation = situation_query(state.memory_index, recent)
+    queries = [recall_query(state.memory_index, agent, situation, event_context) for agent in agents]
+    hits = state.memory_index.search_many(queries, k, stop)
+    return {
+        agent['id']: [format_history_line(state.history[i]) for i, _ in sorted(found)]
+        for agent, found in zip(agents, hits) if found
+    }
+
+# ============================================
+# 关系图谱
+# ============================================
+# 本地情感词表：按条目中出现的正负面词数估计这次互动的情感倾向
+POSITIVE_WORDS = (
+    '谢谢', '感谢', '同意', '喜欢', '帮忙', '帮助', '支持', '信任', '朋友', '高兴',
+    '佩服', '合作', '欢迎', '安慰', '微笑', '关心', '放心', '道歉', '有道理'
+)
+NEGATIVE_WORDS = (
+    '讨厌', '愤怒', '生气', '欺骗', '骗子', '偷', '威胁', '可恶', '怀疑', '嘲笑',
+    '反对', '敌人', '仇', '报复', '冷笑', '不满', '不行', '警告', '滚', '瞪'
+)
+SENTIMENT_SMOOTHING = 0.2   # 边情感的指数滑动平均系数
+RELATION_DECAY_ROUNDS = 50  # 关系强度随未互动回合数衰减的尺度
+
+def entry_sentiment(content):
+    """返回 [-1, 1] 的情感得分，没有情感词时为 0"""
+    positive = sum(content.count(word) for word in POSITIVE_WORDS)
+    negative = sum(content.count(word) for word in NEGATIVE_WORDS)
+    if not positive and not negative:
+        return 0.0
+    return (positive - negative) / (positive + negative)
+
+class RelationshipGraph:
+    """由提交的历史增量维护的角色关系图：发言者提到另一个角色即记一条有向边，
+    边上记录提及次数、最近互动回合与情感滑动平均。每条边带版本号，/api/graph 据此返回增量"""
+    def __init__(self):
+        self.version = 0
+        self.clear()
+
+    def clear(self):
+        self.edges = {}            # (source_id, target_id) -> 边
+        self.reset_version = self.version
+        self._incident = {}        # 角色 id -> 与其相连的边（两个方向）
+        self._roster = None
+        self._pattern = None
+        self._ids = set()
+        self._ids_by_name = {}
+
+    def _match(self, agents):
+        roster = tuple((a['id'], a['name']) for a in agents)
+        if roster != self._roster:
+            self._roster = roster
+            self._ids = {agent_id for agent_id, _ in roster}
+            self._ids_by_name = {name: agent_id for agent_id, name in roster if name}
+            names = sorted(self._ids_by_name, key=len, reverse=True)
+            self._pattern = re.compile('|'.join(map(re.escape, names))) if names else None
+        return self._pattern
+
+    def update(self, entries, agents):
+        """在持有 state.lock 时调用"""
+        pattern = self._match(agents)
+        if pattern is None:
+            return
+        for h in entries:
+            source = h.get('agent_id')
+            if h.get('error') or source not in self._ids:
+                continue
+            mentions = {}
+            for name in pattern.findall(h.get('content', '')):
+                target = self._ids_by_name[name]
+                if target != source:
+                    mentions[target] = mentions.get(target, 0) + 1
+            if not mentions:
+                continue
+            sentiment = entry_sentiment(h['content'])
+            self.version += 1
+            for target, count in mentions.items():
+                edge = self.edges.get((source, target))
+                if edge is None:
+                    edge = self.edges[(source, target)] = {
+                        'source': source, 'target': target, 'mentions': 0, 'sentiment': sentiment
+                    }
+                    self._incident.setdefault(source, []).append(edge)
+                    self._incident.setdefault(target, []).append(edge)
+                else:
+                    edge['sentiment'] += SENTIMENT_SMOOTHING * (sentiment - edge['sentiment'])
+                edge['mentions'] += count
+                edge['last_round'] = h.get('round', 0)
+                edge['version'] = self.version
+
+    def rebuild(self, history, agents, clear=True):
+        """clear 为 False 时只把 history 增量计入现有的边"""
+        if clear:
+            self.clear()
+        chunk = []
+        for h in history:
+            chunk.append(h)
+            if len(chunk) >= RESTORE_CHUNK:
+                self.update(chunk, agents)
+                chunk = []
+        self.update(chunk, agents)
+
+    def snapshot(self):
+        """压缩日志时写入检查点的内容"""
+        return {'version': self.version, 'edges': [dict(e) for e in self.edges.values()]}
+
+    def load(self, data):
+        self.clear()
+        self.version = self.reset_version = data['version']
+        for edge in data['edges']:
+            self.edges[(edge['source'], edge['target'])] = edge
+            self._incident.setdefault(edge['source'], []).append(edge)
+            self._incident.setdefault(edge['target'], []).append(edge)
+
+    def changes(self, since=0):
+        """返回版本号大于 since 的边；since 早于上次清空时返回全部边并标记 full"""
+        full = since < self.reset_version or since > self.version
+        return {
+            'version': self.version,
+            'full': full,
+            'edges': [dict(e) for e in self.edges.values() if full or e['version'] > since]
+        }
+
+    def strength(self, edge, round_num):
+        return math.log1p(edge['mentions']) / (1 + (round_num - edge['last_round']) / RELATION_DECAY_ROUNDS)
+
+    def relevant_others(self, agent, agents, limit, round_num):
+        """与 agent 关系最强的至多 limit 个其他角色（双向边强度相加），不足时按名单顺序补齐"""
+        scores = {}
+        for edge in self._incident.get(agent['id'], ()):
+            other = edge['target'] if edge['source'] == agent['id'] else edge['source']
+            scores[other] = scores.get(other, 0.0) + self.strength(edge, round_num)
+        others = [a for a in agents if a['id'] != agent['id']]
+        ranked = sorted(others, key=lambda a: -scores.get(a['id'], 0.0))
+        return ranked[:limit]
 
 # ============================================
 # Prompt 构建器
@@ -123,30 +2985,61 @@ def build_system_prompt(world):
 4. 朝着角色目标努力，但要符合逻辑和情境
 5. 记住之前发生的事，保持记忆连续性"""
 
-def build_agent_prompt(agent, all_agents, history, event_context=''):
+def format_agent_profile(agent):
+    return f"""【姓名】{agent['name']}
+【性格特征】{agent.get('personality', '未设定')}
+【核心目标】{agent.get('goal', '未设定')}
+【背景记忆】{agent.get('memory', '未设定')}"""
+
+def format_other_agents(agent, all_agents):
     other_agents = [a for a in all_agents if a['id'] != agent['id']]
-    recent_history = history[-20:] if len(history) > 20 else history
-    
-    history_text = '\n'.join([
-        f"[回合{h['round']}] {h['agent']}: {h['content']}" 
-        for h in recent_history
-    ]) if recent_history else "（这是模拟的开始，还没有发生任何事情）"
-    
-    other_agents_text = '\n'.join([
+    return '\n'.join([
         f"• {a['name']}: {a.get('personality', '未知')[:60]}..."
         for a in other_agents
     ]) if other_agents else "（目前没有其他角色）"
-    
-    prompt = f"""## 你的角色档案
-【姓名】{agent['name']}
-【性格特征】{agent.get('personality', '未设定')}
-【核心目标】{agent.get('goal', '未设定')}
-【背景记忆】{agent.get('memory', '未设定')}
+
+def trim_other_agents(others, budget):
+    """从末尾删减“其他角色”列表（关系最强的排在前面）直到不超过 budget 个 token，注明省略的人数"""
+    if estimate_tokens(others) <= budget:
+        return others
+    lines = others.split('\n')
+    costs = [estimate_tokens(line) for line in lines]
+    total = sum(costs)
+    kept = len(lines)
+    # 省略说明本身约占 12 个 token
+    while kept and total + 12 > budget:
+        kept -= 1
+        total -= costs[kept]
+    return '\n'.join(lines[:kept] + [f"…（另有 {len(lines) - kept} 位角色从略）"])
+
+def format_history_line(h):
+    return f"[回合{h['round']}] {h['agent']}: {h['content']}"
+
+def format_history_text(lines, has_history=False):
+    """has_history 为 True 表示历史不为空，只是这里没有列出（例如已压缩进摘要）"""
+    if lines:
+        return '\n'.join(lines)
+    return "（最近没有新的动态）" if has_history else "（这是模拟的开始，还没有发生任何事情）"
+
+def format_summary_text(summaries, agent, recalled=None):
+    """世界级摘要、该角色的个人摘要与检索到的相关往事，都没有时返回空串"""
+    parts = []
+    if 'world' in summaries:
+        parts.append(f"【此前的局势】{summaries['world']['text']}")
+    if agent['id'] in summaries:
+        parts.append(f"【你的经历】{summaries[agent['id']]['text']}")
+    if recalled:
+        parts.append("【你想起的往事】\n" + '\n'.join(recalled))
+    return '\n'.join(parts)
+
+def assemble_agent_prompt(agent, profile_text, other_agents_text, history_text, event_context='', summary_text=''):
+    return f"""## 你的角色档案
+{profile_text}
 
 ## 世界中的其他角色
 {other_agents_text}
 
-## 最近发生的事（按时间顺序）
+{f"## 往事回顾{chr(10)}{summary_text}{chr(10)}{chr(10)}" if summary_text else ""}## 最近发生的事（按时间顺序）
 {history_text}
 
 {f"## ⚡ 突发事件{chr(10)}{event_context}{chr(10)}" if event_context else ""}
@@ -167,10 +3060,96 @@ def build_agent_prompt(agent, all_agents, history, event_context=''):
 4. 保持真实感，像真人一样有情绪波动
 5. 回复长度适中（50-150字），不要太短也不要太长"""
 
-    return prompt
+def fit_agent_prompt(agent, profile, others, candidates, budget, event_context='', summary_text='',
+                     has_history=False):
+    """在 budget 个 token 内（已扣除系统提示）组装角色 prompt。固定部分放不下时先删减“其他角色”列表；
+    预算再紧也至少保留最近一条历史"""
+    latest = candidates[-1][4] if candidates else 0
+    fixed = estimate_tokens(assemble_agent_prompt(agent, profile, '', '', event_context, summary_text))
+    others = trim_other_agents(others, budget - fixed - latest)
+    fixed += estimate_tokens(others)
+    lines = pack_history(agent, candidates, budget - fixed)
+    if candidates and not lines:
+        lines = [candidates[-1][3]]
+    history_text = format_history_text(lines, has_history)
+    return assemble_agent_prompt(agent, profile, others, history_text, event_context, summary_text)
+
+def build_agent_prompt(agent, all_agents, history, event_context='', token_budget=0, summary_text='',
+                       system_prompt=''):
+    """token_budget 为整个输入（系统提示 + 本条 prompt）的 token 预算，与 PromptCache.agent_prompt 相同；
+    system_prompt 为随同发送的系统提示。0 表示固定取最近 AGENT_PROMPT_HISTORY 条"""
+    profile = format_agent_profile(agent)
+    others = format_other_agents(agent, all_agents)
+    if token_budget:
+        candidates = [history_candidate(h) for h in history[-AGENT_PROMPT_CANDIDATES:]]
+        return fit_agent_prompt(agent, profile, others, candidates, token_budget - estimate_tokens(system_prompt),
+                                event_context, summary_text)
+    lines = [format_history_line(h) for h in history[-AGENT_PROMPT_HISTORY:]]
+    return assemble_agent_prompt(agent, profile, others, format_history_text(lines), event_context, summary_text)
+
+class PromptCache:
+    """预编译的 prompt 片段：世界设定块只在 /api/world 变更时失效，角色档案与“其他角色”块在角色编辑时失效，
+    最近历史候选窗口随每次提交追加（行文本与 token 数只计算一次）。引擎构建 prompt 时不再重复切片历史、格式化全部角色"""
+    def __init__(self):
+        self._system = None
+        self._system_tokens = 0
+        self._profiles = {}
+        self._others = {}
+        self._history = deque(maxlen=AGENT_PROMPT_CANDIDATES)
+
+    def invalidate_world(self):
+        self._system = None
+
+    def invalidate_agents(self):
+        self._profiles = {}
+        self._others = {}
+
+    def reset_history(self, history):
+        self._history.clear()
+        self._history.extend(history_candidate(h) for h in history[-AGENT_PROMPT_CANDIDATES:])
+
+    def append_history(self, entries):
+        self._history.extend(history_candidate(h) for h in entries)
+
+    def reset(self, state):
+        """world、agents、history 被整体替换（导入、恢复）后调用"""
+        self.invalidate_world()
+        self.invalidate_agents()
+        self.reset_history(state.history)
+
+    def system_prompt(self, world):
+        if self._system is None:
+            self._system = build_system_prompt(world)
+            self._system_tokens = estimate_tokens(self._system)
+        return self._system
+
+    def agent_prompt(self, agent, all_agents, event_context='', token_budget=0, summary_text='', relevant=None,
+                     max_entries=None):
+        """token_budget 为整个输入（系统提示 + 本条 prompt）的 token 预算，须先调用 system_prompt；
+        relevant 给出时“其他角色”只列出这些角色，随关系图变化，不缓存；
+        max_entries 限制只从最近这么多条里取（更早的已经压缩进摘要）"""
+        agent_id = agent['id']
+        profile = self._profiles.get(agent_id)
+        if profile is None:
+            profile = self._profiles[agent_id] = format_agent_profile(agent)
+        if relevant is not None:
+            others = format_other_agents(agent, relevant)
+        else:
+            others = self._others.get(agent_id)
+            if others is None:
+                others = self._others[agent_id] = format_other_agents(agent, all_agents)
+        candidates = self._history
+        if max_entries is not None and max_entries < len(candidates):
+            candidates = list(candidates)[len(candidates) - max(0, max_entries):]
+        if token_budget:
+            return fit_agent_prompt(agent, profile, others, list(candidates), token_budget - self._system_tokens,
+                                    event_context, summary_text, has_history=bool(self._history))
+        lines = [c[3] for c in list(candidates)[-AGENT_PROMPT_HISTORY:]]
+        history_text = format_history_text(lines, has_history=bool(self._history))
+        return assemble_agent_prompt(agent, profile, others, history_text, event_context, summary_text)
 
 def build_metric_analysis_prompt(metrics, history, round_num):
-    recent_history = history[-10:] if len(history) > 10 else history
+    recent_history = history[-METRIC_PROMPT_HISTORY:]
     history_text = '\n'.join([
         f"[{h['agent']}]: {h['content']}" 
         for h in recent_history
@@ -201,48 +3180,250 @@ def build_metric_analysis_prompt(metrics, history, round_num):
 # ============================================
 # 指标分析
 # ============================================
-def analyze_metrics():
-    if not state.metrics or not state.history:
-        return
-    
+def take_metric_snapshot(state):
+    """在持有 state.lock 时调用，返回指标评估所需的快照"""
+    metrics = [m.copy() for m in state.metrics]
+    return {
+        'round': state.round,
+        'generation': state.history_generation,
+        'metrics': metrics,
+        'prompt': build_metric_analysis_prompt(metrics, state.history, state.round)
+    }
+
+async def evaluate_metric_snapshot(state, snapshot):
+    round_num = snapshot['round']
     try:
-        messages = [
-            {"role": "user", "content": build_metric_analysis_prompt(
-                state.metrics, state.history, state.round
-            )}
-        ]
+        messages = [{"role": "user", "content": snapshot['prompt']}]
         
-        response = call_qwen_api(messages, temperature=0.3)
+        objects = JSONObjectStream().parse(await call_qwen_api(state, messages, temperature=0.3))
         
-        json_match = re.search(r'\{[^{}]+\}', response)
-        if json_match:
-            values = json.loads(json_match.group())
+        if objects:
+            values = objects[0]
             
-            for metric in state.metrics:
-                metric_name = metric['name']
-                if metric_name in values:
-                    value = float(values[metric_name])
-                    value = max(metric.get('min', 0), min(metric.get('max', 100), value))
-                    
-                    if metric['id'] not in state.metric_data:
-                        state.metric_data[metric['id']] = []
-                    
-                    state.metric_data[metric['id']].append({
-                        'round': state.round,
-                        'value': value
-                    })
+            with state.lock:
+                # 评估期间历史被清空、导入或恢复，结果已过期
+                if state.history_generation != snapshot['generation']:
+                    return
+                for metric in snapshot['metrics']:
+                    metric_name = metric['name']
+                    if metric_name in values:
+                        value = float(values[metric_name])
+                        value = max(metric.get('min', 0), min(metric.get('max', 100), value))
+                        
+                        if metric['id'] not in state.metric_data:
+                            state.metric_data[metric['id']] = []
+                        
+                        state.metric_data[metric['id']].append({
+                            'round': round_num,
+                            'value': value
+                        })
+                        point = {
+                            'metric_id': metric['id'],
+                            'round': round_num,
+                            'value': value
+                        }
+                        state.events.publish('metric_data', point)
+                        if state.journal is not None:
+                            state.journal.append('metric', point)
     except Exception as e:
         print(f"指标分析失败: {e}")
 
+async def analyze_metrics(state):
+    with state.lock:
+        if not state.metrics or not state.history:
+            return
+        snapshot = take_metric_snapshot(state)
+    
+    await evaluate_metric_snapshot(state, snapshot)
+
+# ============================================
+# 记忆摘要
+# ============================================
+def build_summary_prompt(previous, entries, agent=None):
+    subject = f"角色「{agent['name']}」的个人经历" if agent else "整个世界的局势"
+    events_text = '\n'.join(format_history_line(h) for h in entries)
+    
+    return f"""你是一个社会模拟实验的记录员，负责把较早的事件压缩成简洁的摘要，供角色回忆往事。
+
+## 已有摘要
+{previous['text'] if previous else '（暂无）'}
+
+## 需要压缩的新事件
+{events_text}
+
+## 任务
+把已有摘要与新事件合并为一段新的{subject}摘要：
+1. 保留关键的人物关系、承诺、冲突和目标进展
+2. 省略寒暄和重复内容
+3. 不超过{SUMMARY_MAX_CHARS}字，直接输出摘要正文，不要解释"""
+
+def raw_history_window(state):
+    """角色 prompt 可能原样引用的最近历史条数：设置 token 预算时为打包候选窗口，否则为固定窗口。
+    摘要与往事检索只处理这个窗口之前的历史，避免同一条事件在 prompt 里出现两次"""
+    return AGENT_PROMPT_CANDIDATES if state.prompt_token_budget else AGENT_PROMPT_HISTORY
+
+def needs_summary(state):
+    """在持有 state.lock 时调用"""
+    if not state.memory_summary:
+        return False
+    return len(state.history) - raw_history_window(state) - state.summary_covered >= SUMMARY_CHUNK
+
+def take_summary_snapshot(state):
+    """在持有 state.lock 时调用，返回摘要所需的快照：最近窗口之前、尚未压缩的历史区间"""
+    start = state.summary_covered
+    stop = min(len(state.history) - raw_history_window(state), start + SUMMARY_MAX_BATCH)
+    return {
+        'generation': state.history_generation,
+        'start': start,
+        'stop': stop,
+        'entries': [h for h in state.history.iter_range(start, stop) if not h.get('error')],
+        'agents': [a.copy() for a in state.agents],
+        'summaries': dict(state.summaries),
+        'max_workers': state.max_workers
+    }
+
+async def summarize_snapshot(state, snapshot):
+    entries = snapshot['entries']
+    summaries = snapshot['summaries']
+    jobs = [('world', None, entries)]
+    for agent in snapshot['agents']:
+        related = [h for h in entries if h.get('agent_id') == agent['id'] or agent['name'] in h['content']]
+        if related:
+            jobs.append((agent['id'], agent, related))
+    
+    semaphore = asyncio.Semaphore(max(1, snapshot['max_workers']))
+    
+    async def summarize(key, agent, related):
+        messages = [{"role": "user", "content": build_summary_prompt(summaries.get(key), related, agent)}]
+        async with semaphore:
+            text = await call_qwen_api(state, messages, temperature=0.3, max_tokens=SUMMARY_MAX_CHARS * 2)
+        # 模型偶尔超出字数要求，截断以保证 prompt 大小有上界
+        return (text or '').strip()[:SUMMARY_MAX_CHARS * 2]
+    
+    def stale():
+        # 摘要期间历史被清空、导入或恢复，结果已过期
+        return state.history_generation != snapshot['generation'] or state.summary_covered != snapshot['start']
+    
+    try:
+        texts = await asyncio.gather(*(summarize(*job) for job in jobs)) if entries else []
+    except Exception as e:
+        print(f"记忆摘要失败: {e}")
+        with state.lock:
+            if stale():
+                return
+            # 不推进 summary_covered，下次触发时重试同一区间；反复失败则跳过，免得每步都重试
+            state.summary_failures += 1
+            if state.summary_failures >= SUMMARY_MAX_FAILURES:
+                print(f"记忆摘要连续失败 {state.summary_failures} 次，跳过历史 {snapshot['start']}-{snapshot['stop']}")
+                state.summary_failures = 0
+                state.summary_covered = snapshot['stop']
+                if state.journal is not None:
+                    state.journal.append('summary_skip', {'covered': snapshot['stop']})
+        return
+    
+    with state.lock:
+        if stale():
+            return
+        state.summary_failures = 0
+        for (key, agent, related), text in zip(jobs, texts):
+            if not text:
+                # 空回复不覆盖已有摘要
+                continue
+            previous = summaries.get(key)
+            record = {
+                'key': key,
+                'text': text,
+                'round_from': previous['round_from'] if previous else related[0]['round'],
+                'round_to': related[-1]['round'],
+                'version': previous['version'] + 1 if previous else 1,
+                'covered': snapshot['stop']
+            }
+            state.summaries[key] = record
+            state.events.publish('summary', record)
+            if state.journal is not None:
+                state.journal.append('summary', record)
+        state.summary_covered = snapshot['stop']
+
 # ============================================
 # 模拟引擎
 # ============================================
-def run_simulation_step():
+TOKEN_PUBLISH_INTERVAL = 0.05  # 流式分片合并推送的最小间隔（秒）
+
+def token_publisher(state, entry_id, agent, round_num):
+    """返回 on_token 回调：首个分片立即以 'token' 事件推送，之后合并到每 TOKEN_PUBLISH_INTERVAL 秒推送一次。
+    最后不足一个间隔的分片不必补发，提交的 log_entry 携带完整内容"""
+    pending = []
+    last_publish = [0.0]
+    
+    def on_token(delta):
+        pending.append(delta)
+        now = time.monotonic()
+        if now - last_publish[0] >= TOKEN_PUBLISH_INTERVAL:
+            last_publish[0] = now
+            state.events.publish('token', {
+                'id': entry_id,
+                'round': round_num,
+                'agent': agent['name'],
+                'agent_id': agent['id'],
+                'delta': ''.join(pending)
+            })
+            pending.clear()
+    
+    return on_token
+
+async def run_agent_turn(state, agent, messages, round_num, event_context=''):
+    # 流式分片与最终提交的记录使用同一个 id，前端据此替换正在生成的气泡
+    entry_id = str(uuid.uuid4())
+    try:
+        usage = {}
+        on_token = token_publisher(state, entry_id, agent, round_num) if state.stream_tokens else None
+        response = await call_qwen_api(
+            state, messages, temperature=state.temperature, max_tokens=state.max_output_tokens,
+            usage=usage, on_token=on_token
+        )
+        
+        return {
+            'id': entry_id,
+            'round': round_num,
+            'agent': agent['name'],
+            'agent_id': agent['id'],
+            'content': response,
+            'timestamp': datetime.now().isoformat(),
+            'event': event_context if event_context else None,
+            'usage': usage
+        }
+    except Exception as e:
+        return {
+            'id': entry_id,
+            'round': round_num,
+            'agent': 'System',
+            'agent_id': 'system',
+            'content': f'❌ API调用失败: {str(e)}',
+            'timestamp': datetime.now().isoformat(),
+            'error': True
+        }
+
+def step_batch_size(state):
+    """下一步行动的角色数，即这一步产生的回合数"""
+    if state.schedule_mode == 'simultaneous':
+        return min(state.batch_size or len(state.agents), len(state.agents))
+    return min(1, len(state.agents))
+
+async def run_simulation_step(state, max_batch=None):
+    """执行一步：轮流模式下一个角色行动；同时模式下一批角色基于同一历史快照并发行动，
+    结果按角色顺序提交。max_batch 限制这一步最多行动的角色数（无界面运行的最后一步）。
+    返回最后一条记录，若有失败则返回失败记录。"""
+    # 快照：在锁内取出本回合所需的角色、历史与世界设定并构建 prompt
     with state.lock:
         if not state.agents:
             return None
         
-        state.round += 1
+        base_round = state.round
+        generation = state.history_generation
+        
+        batch = step_batch_size(state)
+        if max_batch is not None:
+            batch = max(1, min(batch, max_batch))
         
         event_context = ''
         try:
@@ -250,97 +3431,342 @@ def run_simulation_step():
         except queue.Empty:
             pass
         
-        agent_index = (state.round - 1) % len(state.agents)
-        current_agent = state.agents[agent_index]
-        
-        messages = [
-            {"role": "system", "content": build_system_prompt(state.world)},
-            {"role": "user", "content": build_agent_prompt(
-                current_agent, 
-                state.agents, 
-                state.history,
-                event_context
-            )}
-        ]
-        
-        try:
-            response = call_qwen_api(messages)
-            
-            log_entry = {
-                'id': str(uuid.uuid4()),
-                'round': state.round,
-                'agent': current_agent['name'],
-                'agent_id': current_agent['id'],
-                'content': response,
-                'timestamp': datetime.now().isoformat(),
-                'event': event_context if event_context else None
-            }
-            state.history.append(log_entry)
-            
-            if state.metrics and state.round % 5 == 0:
-                analyze_metrics()
-            
-            return log_entry
-            
-        except Exception as e:
-            error_entry = {
-                'id': str(uuid.uuid4()),
-                'round': state.round,
-                'agent': 'System',
-                'agent_id': 'system',
-                'content': f'❌ API调用失败: {str(e)}',
-                'timestamp': datetime.now().isoformat(),
-                'error': True
-            }
-            state.history.append(error_entry)
-            return error_entry
+        system_prompt = state.prompts.system_prompt(state.world)
+        summaries = state.summaries
+        speakers = [state.agents[(base_round + offset) % len(state.agents)].copy() for offset in range(batch)]
+        recalled = recall_memories(state, speakers, state.memory_recall_k, event_context)
+        turns = []
+        for agent in speakers:
+            relevant = None
+            if state.relevant_others:
+                relevant = state.graph.relevant_others(agent, state.agents, state.relevant_others, base_round)
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": state.prompts.agent_prompt(
+                    agent, 
+                    state.agents, 
+                    event_context,
+                    state.prompt_token_budget,
+                    format_summary_text(summaries, agent, recalled.get(agent['id'])),
+                    relevant,
+                    len(state.history) - state.summary_covered
+                )}
+            ]
+            turns.append((agent, messages))
+        
+        semaphore = asyncio.Semaphore(max(1, state.max_workers))
+    
+    # LLM 调用期间不持有锁，编辑、注入事件、查询状态都不会被阻塞
+    async def bounded_turn(offset, agent, messages):
+        async with semaphore:
+            return await run_agent_turn(state, agent, messages, base_round + offset + 1, event_context)
+    
+    entries = await asyncio.gather(*(
+        bounded_turn(offset, agent, messages)
+        for offset, (agent, messages) in enumerate(turns)
+    ))
+    
+    # 提交：回合号在调用期间被改变（其他回合已提交、历史被清空或导入）则放弃本次结果
+    errors = [e for e in entries if e.get('error')]
+    rounds = range(base_round + 1, base_round + len(entries) + 1)
+    metric_snapshot = None
+    summary_snapshot = None
+    
+    with state.lock:
+        if state.round != base_round or state.history_generation != generation:
+            if event_context:
+                state.event_queue.put(event_context)
+            if state.stream_tokens:
+                state.events.publish('token_cancel', {'ids': [e['id'] for e in entries]})
+            return None
+        state.round = base_round + len(entries)
+        for entry in entries:
+            state.events.publish('log_entry', {'index': len(state.history), 'entry': entry})
+            state.history.append(entry)
+            if state.journal is not None:
+                state.journal.append('log', entry)
+        maybe_compact_journal(state)
+        state.prompts.append_history(entries)
+        if state.memory_recall_k and state.memory_index.ready.is_set():
+            state.memory_index.add(entries)
+        state.graph.update(entries, state.agents)
+        publish_status(state)
+        
+        if not errors and state.metrics and any(r % 5 == 0 for r in rounds):
+            metric_snapshot = take_metric_snapshot(state)
+        if needs_summary(state):
+            summary_snapshot = take_summary_snapshot(state)
+    
+    # 指标评估与记忆摘要交给后台任务，不阻塞下一个角色行动
+    if metric_snapshot is not None:
+        state.metric_evaluator.submit(metric_snapshot)
+    if summary_snapshot is not None:
+        state.summarizer.submit(summary_snapshot)
+    
+    return errors[0] if errors else entries[-1]
 
-def simulation_loop():
+async def simulation_loop(state):
+    failures = 0
     while state.running:
-        result = run_simulation_step()
+        started = time.monotonic()
+        result = await run_simulation_step(state)
         if result and result.get('error'):
-            state.running = False
-            break
-        time.sleep(state.speed)
+            # 单次调用的瞬时错误已在 call_qwen_api 中重试过，这里只在持续失败时停止
+            failures += 1
+            if failures >= state.max_consecutive_errors:
+                state.running = False
+                publish_status(state)
+                break
+            await asyncio.sleep(rate_limiter.backoff_delay(failures))
+            continue
+        failures = 0
+        # 回合间隔扣除本回合 LLM 调用已耗费的时间
+        delay = state.speed - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
 
 # ============================================
 # API 路由
 # ============================================
-@app.route('/')
+# 路由先登记在这里，create_app() 时才导入 Flask 并注册；无界面运行与参数扫描不需要 Flask
+ROUTES = []
+ERROR_HANDLERS = []
+_app = None
+
+def route(rule, **options):
+    def decorator(view):
+        ROUTES.append((rule, options, view))
+        return view
+    return decorator
+
+def errorhandler(exception):
+    def decorator(handler):
+        ERROR_HANDLERS.append((exception, handler))
+        return handler
+    return decorator
+
+def create_app():
+    """导入 Flask 并注册全部路由，重复调用返回同一个应用"""
+    global _app, Response, abort, render_template_string, request, jsonify
+    if _app is None:
+        from flask import Flask, Response, abort, render_template_string, request, jsonify
+        app = Flask(__name__)
+        for exception, handler in ERROR_HANDLERS:
+            app.register_error_handler(exception, handler)
+        for rule, options, view in ROUTES:
+            app.add_url_rule(rule, view_func=view, **options)
+        _app = app
+    return _app
+
+def __getattr__(name):
+    # 兼容 WSGI 服务器的 SocialSim:app 写法
+    if name == 'app':
+        return create_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class InvalidParameter(ValueError):
+    """请求参数格式错误，由 API 路由以 400 返回"""
+    pass
+
+@errorhandler(InvalidParameter)
+def invalid_parameter(e):
+    return jsonify({'success': False, 'message': str(e)}), 400
+
+def number_param(data, key, cast=int, low=None, high=None):
+    """读取 data[key] 并转换为数值、截断到 [low, high]；格式错误时抛出 InvalidParameter"""
+    try:
+        value = cast(data[key])
+    except (TypeError, ValueError, OverflowError):
+        raise InvalidParameter(f'参数 {key} 必须是数值') from None
+    if not math.isfinite(value):
+        raise InvalidParameter(f'参数 {key} 必须是有限数值')
+    if low is not None:
+        value = max(low, value)
+    if high is not None:
+        value = min(high, value)
+    return value
+
+@route('/')
 def index():
     return render_template_string(HTML_TEMPLATE)
 
-@app.route('/api/config', methods=['GET', 'POST'])
+@route('/api/sessions', methods=['GET'])
+def list_sessions():
+    return jsonify({
+        'sessions': sessions.list(),
+        'max_sessions': sessions.max_sessions,
+        'max_running': sessions.max_running,
+        'idle_timeout': sessions.idle_timeout
+    })
+
+@route('/api/sessions/delete', methods=['POST'])
+def delete_session():
+    session_id = (request.json or {}).get('id') or ''
+    if not SESSION_ID_PATTERN.match(session_id):
+        return jsonify({'success': False, 'message': '无效的会话ID'}), 400
+    if session_id == DEFAULT_SESSION:
+        return jsonify({'success': False, 'message': '默认会话不能删除'}), 400
+    if sessions.remove(session_id):
+        return jsonify({'success': True, 'message': '会话已删除'})
+    return jsonify({'success': False, 'message': '会话不存在'}), 404
+
+# /api/config 的会话设置：数值字段 -> (类型, 下限, 上限)、开关字段与文本字段
+CONFIG_NUMBERS = {
+    'prompt_token_budget': (int, 0, None),
+    'max_output_tokens': (int, 1, None),
+    'memory_recall_k': (int, 0, None),
+    'relevant_others': (int, 0, None),
+    'temperature': (float, 0.0, 2.0),
+    'max_consecutive_errors': (int, 1, None),
+    'call_timeout': (float, 0.0, None),
+    'metric_concurrency': (int, 1, 16),
+}
+CONFIG_FLAGS = ('stream_tokens', 'memory_summary', 'hedge_requests')
+CONFIG_TEXT = ('api_key', 'model')
+# /api/llm 可以设置的模拟后端参数
+MOCK_SETTINGS = {
+    'latency': float, 'jitter': float, 'error_rate': float, 'rate_limit': int,
+    'tail_rate': float, 'tail_latency': float, 'seed': int
+}
+
+@route('/api/config', methods=['GET', 'POST'])
 def config():
+    state = current_state()
     if request.method == 'POST':
-        data = request.json
-        if 'api_key' in data:
-            state.api_key = data['api_key']
-        if 'model' in data:
-            state.model = data['model']
+        data = request.json or {}
+        # 先校验整个请求，任何一项不合法都不修改会话
+        if 'backend' in data and data['backend'] not in LLM_BACKENDS:
+            return jsonify({'success': False, 'message': '未知的LLM后端'}), 400
+        for key in CONFIG_TEXT:
+            if key in data and not isinstance(data[key], str):
+                raise InvalidParameter(f'参数 {key} 必须是字符串')
+        updates = {key: number_param(data, key, *spec) for key, spec in CONFIG_NUMBERS.items() if key in data}
+        updates.update({key: bool(data[key]) for key in CONFIG_FLAGS if key in data})
+        updates.update({key: data[key] for key in CONFIG_TEXT + ('backend',) if key in data})
+        
+        old_key = state.api_key
+        recall_enabled = bool(state.memory_recall_k)
+        for key, value in updates.items():
+            setattr(state, key, value)
+        if recall_enabled != bool(state.memory_recall_k):
+            with state.lock:
+                rebuild_memory_index(state)
+        if old_key != state.api_key and not sessions.key_in_use(old_key, exclude=state):
+            # 没有其他会话再用旧 Key 时丢弃其客户端；仍在途的调用归还后才关闭
+            llm_pool.discard(old_key)
+        save_checkpoint(state)
         return jsonify({'success': True})
     else:
         return jsonify({
             'has_key': bool(state.api_key),
-            'model': state.model
+            'ready': llm_ready(state),
+            'model': state.model,
+            'backend': state.backend,
+            'prompt_token_budget': state.prompt_token_budget,
+            'max_output_tokens': state.max_output_tokens,
+            'memory_recall_k': state.memory_recall_k,
+            'relevant_others': state.relevant_others,
+            'stream_tokens': state.stream_tokens,
+            'temperature': state.temperature,
+            'memory_summary': state.memory_summary,
+            'max_consecutive_errors': state.max_consecutive_errors,
+            'call_timeout': state.call_timeout,
+            'hedge_requests': state.hedge_requests,
+            'metric_concurrency': state.metric_concurrency,
+            'token_usage': dict(state.token_usage)
+        })
+
+def require_admin():
+    """进程级设置影响所有会话：配置了 SOCIALSIM_ADMIN_TOKEN 时要求请求头 X-Admin-Token 与之相同，否则只接受本机请求"""
+    if ADMIN_TOKEN:
+        allowed = hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+    else:
+        allowed = request.remote_addr in ('127.0.0.1', '::1')
+    if not allowed:
+        abort(403, description='修改进程级设置需要管理员权限')
+
+@route('/api/llm', methods=['GET', 'POST'])
+def llm_settings():
+    """进程级 LLM 设置，对所有会话生效：连接池 pool_size / idle_timeout 与离线 mock 后端参数"""
+    if request.method == 'POST':
+        require_admin()
+        data = request.json or {}
+        # 先校验整个请求再生效
+        mock = data.get('mock', {})
+        if not isinstance(mock, dict):
+            raise InvalidParameter('参数 mock 必须是对象')
+        unknown = sorted(set(mock) - set(MOCK_SETTINGS))
+        if unknown:
+            raise InvalidParameter(f"未知的模拟后端参数: {', '.join(unknown)}")
+        mock = {key: number_param(mock, key, MOCK_SETTINGS[key]) for key in mock}
+        pool = {
+            'pool_size': number_param(data, 'pool_size', low=1) if 'pool_size' in data else None,
+            'idle_timeout': number_param(data, 'idle_timeout', float, 0.0) if 'idle_timeout' in data else None
+        }
+        if mock:
+            LLM_BACKENDS['mock'].configure(**mock)
+        if 'pool_size' in data or 'idle_timeout' in data:
+            llm_pool.configure(**pool)
+        return jsonify({'success': True, 'mock': LLM_BACKENDS['mock'].stats(), **llm_pool.stats()})
+    else:
+        return jsonify({'mock': LLM_BACKENDS['mock'].stats(), **llm_pool.stats()})
+
+@route('/api/cache', methods=['GET', 'POST'])
+def cache():
+    """进程级响应缓存设置，所有会话共用同一个缓存"""
+    if request.method == 'POST':
+        require_admin()
+        data = request.json or {}
+        if 'mode' in data and data['mode'] not in ResponseCache.MODES:
+            return jsonify({'success': False, 'message': '无效的缓存模式'}), 400
+        if 'max_disk_bytes' in data:
+            response_cache.max_disk_bytes = number_param(data, 'max_disk_bytes', low=0)
+        if 'mode' in data:
+            response_cache.mode = data['mode']
+        if data.get('clear'):
+            response_cache.clear()
+        return jsonify({'success': True, **response_cache.stats()})
+    else:
+        return jsonify(response_cache.stats())
+
+@route('/api/rate-limit', methods=['GET', 'POST'])
+def rate_limit():
+    """进程级 LLM 限流设置，所有会话共用：requests_per_min / tokens_per_min 为 0 表示不限，max_in_flight 为在途调用上限"""
+    if request.method == 'POST':
+        require_admin()
+        data = request.json or {}
+        rate_limiter.configure(**{k: number_param(data, k, float) for k in (
+            'requests_per_min', 'tokens_per_min', 'max_in_flight', 'max_retries', 'base_delay', 'max_delay'
+        ) if k in data})
+        return jsonify({'success': True, **rate_limiter.stats()})
+    else:
+        return jsonify({
+            **rate_limiter.stats(),
+            'backends': {name: backend.health() for name, backend in LLM_BACKENDS.items()}
         })
 
-@app.route('/api/world', methods=['GET', 'POST'])
+@route('/api/world', methods=['GET', 'POST'])
 def world():
+    state = current_state()
     if request.method == 'POST':
-        state.world = request.json
+        with state.lock:
+            state.world = request.json
+            state.prompts.invalidate_world()
+        save_checkpoint(state)
         return jsonify({'success': True, 'message': '世界设定已保存'})
     else:
         return jsonify(state.world)
 
-@app.route('/api/templates', methods=['GET'])
+@route('/api/templates', methods=['GET'])
 def get_templates():
+    state = current_state()
     all_templates = {**TEMPLATES, **state.custom_templates}
     return jsonify(all_templates)
 
-@app.route('/api/templates/save', methods=['POST'])
+@route('/api/templates/save', methods=['POST'])
 def save_template():
     """保存当前设定为新模板"""
+    state = current_state()
     data = request.json
     template_name = data.get('name', '').strip()
     template_id = data.get('id')  
@@ -355,13 +3781,15 @@ def save_template():
     agents_to_save = [a.copy() for a in state.agents]
     
     if auto_generate and len(agents_to_save) == 0:
-        if not state.api_key:
+        if not llm_ready(state):
             return jsonify({'success': False, 'message': '自动生成角色需要先配置API Key'}), 400
         
-        generated_agents = generate_agents_for_world(state.world, 4)
+        generated_agents = engine.run(generate_agents_for_world(state, state.world, 4))
         if generated_agents:
             agents_to_save = generated_agents
-            state.agents = [a.copy() for a in generated_agents]
+            with state.lock:
+                state.agents = [a.copy() for a in generated_agents]
+                state.prompts.invalidate_agents()
     
     if not template_id:
         template_id = f"custom_{uuid.uuid4().hex[:8]}"
@@ -373,6 +3801,7 @@ def save_template():
         'agents': agents_to_save,
         'custom': True
     }
+    save_checkpoint(state)
     
     return jsonify({
         'success': True, 
@@ -381,8 +3810,9 @@ def save_template():
         'agents_generated': len(agents_to_save) if auto_generate else 0
     })
 
-@app.route('/api/templates/update', methods=['POST'])
+@route('/api/templates/update', methods=['POST'])
 def update_template():
+    state = current_state()
     data = request.json
     template_id = data.get('id')
     
@@ -399,67 +3829,90 @@ def update_template():
         template['world'] = data['world']
     if 'agents' in data:
         template['agents'] = data['agents']
+    save_checkpoint(state)
     
     return jsonify({'success': True, 'message': '模板已更新'})
 
-@app.route('/api/templates/get/<template_id>')
+@route('/api/templates/get/<template_id>')
 def get_template(template_id):
+    state = current_state()
     all_templates = {**TEMPLATES, **state.custom_templates}
     if template_id in all_templates:
         return jsonify(all_templates[template_id])
     return jsonify({'error': '模板不存在'}), 404
 
-@app.route('/api/templates/delete', methods=['POST'])
+@route('/api/templates/delete', methods=['POST'])
 def delete_template():
+    state = current_state()
     template_id = request.json.get('id')
     if template_id in state.custom_templates:
         del state.custom_templates[template_id]
+        save_checkpoint(state)
         return jsonify({'success': True, 'message': '模板已删除'})
     return jsonify({'success': False, 'message': '模板不存在'}), 404
 
-@app.route('/api/agents', methods=['GET', 'POST', 'DELETE'])
+@route('/api/agents', methods=['GET', 'POST', 'DELETE'])
 def agents():
+    state = current_state()
     if request.method == 'POST':
         agent = request.json
         if 'id' not in agent:
             agent['id'] = str(uuid.uuid4())
         
-        existing = next((i for i, a in enumerate(state.agents) if a['id'] == agent['id']), None)
-        if existing is not None:
-            state.agents[existing] = agent
-        else:
-            state.agents.append(agent)
+        with state.lock:
+            existing = next((i for i, a in enumerate(state.agents) if a['id'] == agent['id']), None)
+            if existing is not None:
+                state.agents[existing] = agent
+            else:
+                state.agents.append(agent)
+            state.prompts.invalidate_agents()
+        save_checkpoint(state)
         
         return jsonify({'success': True, 'agent': agent, 'message': '角色已保存'})
     
     elif request.method == 'DELETE':
         agent_id = request.json.get('id')
-        state.agents = [a for a in state.agents if a['id'] != agent_id]
+        with state.lock:
+            state.agents = [a for a in state.agents if a['id'] != agent_id]
+            state.prompts.invalidate_agents()
+        save_checkpoint(state)
         return jsonify({'success': True, 'message': '角色已删除'})
     
     else:
         return jsonify(state.agents)
 
-@app.route('/api/agents/clear', methods=['POST'])
+@route('/api/agents/clear', methods=['POST'])
 def clear_agents():
-    state.agents = []
+    state = current_state()
+    with state.lock:
+        state.agents = []
+        state.prompts.invalidate_agents()
+    save_checkpoint(state)
     return jsonify({'success': True, 'message': '已清空所有角色'})
 
-@app.route('/api/agents/generate', methods=['POST'])
+@route('/api/agents/generate', methods=['POST'])
 def generate_agents():
-    if not state.api_key:
+    state = current_state()
+    if not llm_ready(state):
         return jsonify({'success': False, 'message': '请先配置API Key'}), 400
     
     if not state.world.get('background'):
         return jsonify({'success': False, 'message': '请先设置世界背景'}), 400
     
-    count = request.json.get('count', 4)
+    count = number_param({'count': 4, **(request.json or {})}, 'count', low=1, high=MAX_GENERATED_AGENTS)
     
     try:
-        agents = generate_agents_for_world(state.world, count)
+        # 每个角色解析出来就推送进度，大批量生成时前端不必干等整个请求
+        agents = engine.run(generate_agents_for_world(
+            state, state.world, count,
+            on_agent=lambda agent: state.events.publish('agent_generated', {'agent': agent, 'total': count})
+        ))
         if agents:
             # 替换当前角色
-            state.agents = agents
+            with state.lock:
+                state.agents = agents
+                state.prompts.invalidate_agents()
+            save_checkpoint(state)
             return jsonify({
                 'success': True, 
                 'message': f'已生成{len(agents)}个角色',
@@ -470,44 +3923,51 @@ def generate_agents():
     except Exception as e:
         return jsonify({'success': False, 'message': f'生成失败: {str(e)}'}), 500
 
-@app.route('/api/metrics', methods=['GET', 'POST', 'DELETE'])
+@route('/api/metrics', methods=['GET', 'POST', 'DELETE'])
 def metrics():
+    state = current_state()
     if request.method == 'POST':
         metric = request.json
         if 'id' not in metric:
             metric['id'] = str(uuid.uuid4())
         
-        existing = next((i for i, m in enumerate(state.metrics) if m['id'] == metric['id']), None)
-        if existing is not None:
-            state.metrics[existing] = metric
-        else:
-            state.metrics.append(metric)
-            state.metric_data[metric['id']] = []
+        with state.lock:
+            existing = next((i for i, m in enumerate(state.metrics) if m['id'] == metric['id']), None)
+            if existing is not None:
+                state.metrics[existing] = metric
+            else:
+                state.metrics.append(metric)
+                state.metric_data[metric['id']] = []
+        save_checkpoint(state)
         
         return jsonify({'success': True, 'metric': metric, 'message': '指标已保存'})
     
     elif request.method == 'DELETE':
         metric_id = request.json.get('id')
-        state.metrics = [m for m in state.metrics if m['id'] != metric_id]
-        if metric_id in state.metric_data:
-            del state.metric_data[metric_id]
+        with state.lock:
+            state.metrics = [m for m in state.metrics if m['id'] != metric_id]
+            if metric_id in state.metric_data:
+                del state.metric_data[metric_id]
+        save_checkpoint(state)
         return jsonify({'success': True, 'message': '指标已删除'})
     
     else:
         return jsonify(state.metrics)
 
-@app.route('/api/metrics/data')
+@route('/api/metrics/data')
 def get_metric_data():
+    state = current_state()
     return jsonify(state.metric_data)
 
-@app.route('/api/metrics/generate', methods=['POST'])
+@route('/api/metrics/generate', methods=['POST'])
 def generate_metric():
+    state = current_state()
     description = request.json.get('description', '')
     
     if not description:
         return jsonify({'success': False, 'message': '请描述你想观察的指标'}), 400
     
-    if not state.api_key:
+    if not llm_ready(state):
         return jsonify({'success': False, 'message': '请先配置API Key'}), 400
     
     try:
@@ -524,11 +3984,10 @@ def generate_metric():
 }}"""
         
         messages = [{"role": "user", "content": prompt}]
-        response = call_qwen_api(messages, temperature=0.3)
+        objects = JSONObjectStream().parse(engine.run(call_qwen_api(state, messages, temperature=0.3)))
         
-        json_match = re.search(r'\{[^{}]+\}', response)
-        if json_match:
-            metric_config = json.loads(json_match.group())
+        if objects:
+            metric_config = objects[0]
             metric_config['id'] = str(uuid.uuid4())
             return jsonify({'success': True, 'metric': metric_config})
         else:
@@ -537,97 +3996,239 @@ def generate_metric():
     except Exception as e:
         return jsonify({'success': False, 'message': f'生成失败: {str(e)}'}), 500
 
-@app.route('/api/simulation/start', methods=['POST'])
+def apply_schedule_settings(state, data):
+    if data.get('schedule_mode') in ('round_robin', 'simultaneous'):
+        state.schedule_mode = data['schedule_mode']
+    if 'batch_size' in data:
+        state.batch_size = number_param(data, 'batch_size', low=0)
+    if 'max_workers' in data:
+        state.max_workers = number_param(data, 'max_workers', low=1)
+
+@route('/api/simulation/start', methods=['POST'])
 def start_simulation():
+    state = current_state()
     if state.running:
         return jsonify({'error': '模拟已在运行中'}), 400
     
+    if state.runner is not None and not state.runner.done():
+        return jsonify({'error': '模拟正在停止，请稍候'}), 400
+    
     if not state.agents:
         return jsonify({'error': '请先添加角色'}), 400
     
-    if not state.api_key:
+    if not llm_ready(state):
         return jsonify({'error': '请先设置API Key'}), 400
     
     data = request.json or {}
     state.speed = data.get('speed', 3)
-    state.running = True
-    
-    thread = threading.Thread(target=simulation_loop, daemon=True)
-    thread.start()
+    apply_schedule_settings(state, data)
+    try:
+        if not sessions.try_start(state):
+            return jsonify({'error': '模拟已在运行中'}), 400
+    except SessionLimitError as e:
+        return jsonify({'error': str(e)}), 429
+    state.runner = engine.submit(simulation_loop(state))
+    save_checkpoint(state)
+    publish_status(state)
     
     return jsonify({'success': True})
 
-@app.route('/api/simulation/stop', methods=['POST'])
+@route('/api/simulation/stop', methods=['POST'])
 def stop_simulation():
+    state = current_state()
     state.running = False
+    publish_status(state)
     return jsonify({'success': True})
 
-@app.route('/api/simulation/step', methods=['POST'])
+@route('/api/simulation/step', methods=['POST'])
 def step_simulation():
+    state = current_state()
     if state.running:
         return jsonify({'error': '请先暂停自动模拟'}), 400
     
-    result = run_simulation_step()
+    apply_schedule_settings(state, request.get_json(silent=True) or {})
+    result = engine.run(run_simulation_step(state))
     return jsonify({'success': True, 'result': result})
 
-@app.route('/api/simulation/status')
+@route('/api/simulation/status')
 def simulation_status():
-    return jsonify({
-        'running': state.running,
-        'round': state.round,
-        'speed': state.speed,
-        'agent_count': len(state.agents)
+    state = current_state()
+    return jsonify(status_snapshot(state))
+
+@route('/api/stream')
+def stream():
+    """SSE：推送 log_entry / status / metric_data，断线重连时按 Last-Event-ID 续传"""
+    state = current_state()
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('last_event_id', type=int)
+    events = state.events
+    
+    def format_event(event_id, event_type, data):
+        return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    
+    def generate():
+        cursor = last_id
+        yield 'retry: 3000\n\n'
+        if cursor is None:
+            # 新连接：先推送当前状态，客户端据 history_length 补齐历史
+            cursor = events.last_id
+            yield format_event(cursor, 'status', status_snapshot(state))
+        # 会话被回收后结束连接，浏览器按 retry 重连时会重新加载会话
+        while not events.closed:
+            pending = events.wait(cursor)
+            if pending is None:
+                # 缓冲区已无法补齐，推送状态快照让客户端重新同步
+                cursor = events.last_id
+                yield format_event(cursor, 'status', status_snapshot(state))
+            elif not pending:
+                yield ': keepalive\n\n'
+            else:
+                for event_id, event_type, data in pending:
+                    yield format_event(event_id, event_type, data)
+                cursor = pending[-1][0]
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
 
-@app.route('/api/history')
+def stream_json_array(items, batch=200):
+    """把可迭代对象以 JSON 数组形式分块输出，避免在内存中拼出整段历史"""
+    yield '['
+    first = True
+    chunk = []
+    for item in items:
+        chunk.append(json.dumps(item, ensure_ascii=False))
+        if len(chunk) >= batch:
+            yield ('' if first else ',') + ','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ('' if first else ',') + ','.join(chunk)
+    yield ']'
+
+@route('/api/history')
 def get_history():
+    state = current_state()
+    since = request.args.get('since', 0, type=int)
+    return Response(stream_json_array(state.history.iter_range(since)), mimetype='application/json')
+
+@route('/api/history/query')
+def query_history():
+    """按角色、是否含事件、回合范围、时间范围过滤历史，cursor 分页"""
+    state = current_state()
+    has_event = request.args.get('event')
+    entries, next_cursor = state.history.query(
+        agent_id=request.args.get('agent_id'),
+        has_event=None if has_event is None else has_event in ('1', 'true'),
+        round_from=request.args.get('round_from', type=int),
+        round_to=request.args.get('round_to', type=int),
+        time_from=request.args.get('time_from'),
+        time_to=request.args.get('time_to'),
+        cursor=request.args.get('cursor', 0, type=int),
+        limit=max(1, min(request.args.get('limit', 100, type=int), 1000))
+    )
+    return jsonify({'entries': entries, 'next_cursor': next_cursor})
+
+@route('/api/history/search')
+def search_history():
+    """全文搜索历史内容，cursor 分页"""
+    state = current_state()
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({'error': '搜索内容不能为空'}), 400
+    entries, next_cursor = state.history.search(
+        text,
+        cursor=request.args.get('cursor', 0, type=int),
+        limit=max(1, min(request.args.get('limit', 100, type=int), 1000))
+    )
+    return jsonify({'entries': entries, 'next_cursor': next_cursor})
+
+@route('/api/summaries', methods=['GET'])
+def get_summaries():
+    state = current_state()
+    with state.lock:
+        return jsonify({
+            'covered': state.summary_covered,
+            'summaries': list(state.summaries.values())
+        })
+
+@route('/api/graph', methods=['GET'])
+def get_graph():
+    """?since=<version> 只返回该版本之后变化的边；响应中的 version 用于下一次增量查询"""
+    state = current_state()
     since = request.args.get('since', 0, type=int)
-    return jsonify(state.history[since:])
+    with state.lock:
+        changes = state.graph.changes(since)
+        return jsonify({
+            'round': state.round,
+            'nodes': [{'id': a['id'], 'name': a['name']} for a in state.agents],
+            **changes
+        })
 
-@app.route('/api/history/clear', methods=['POST'])
+@route('/api/history/clear', methods=['POST'])
 def clear_history():
-    state.history = []
-    state.round = 0
-    state.metric_data = {m['id']: [] for m in state.metrics}
+    state = current_state()
+    with state.lock:
+        state.history_generation += 1
+        state.history.clear()
+        state.round = 0
+        state.metric_data = {m['id']: [] for m in state.metrics}
+        state.summaries = {}
+        state.summary_covered = 0
+        state.summary_failures = 0
+        rebuild_memory_index(state)
+        state.graph.clear()
+        state.prompts.reset_history([])
+        reset_journal(state)
+    publish_status(state)
     return jsonify({'success': True})
 
-@app.route('/api/event', methods=['POST'])
+@route('/api/event', methods=['POST'])
 def inject_event():
+    state = current_state()
     event = request.json.get('event', '')
     if event:
         state.event_queue.put(event)
         return jsonify({'success': True})
     return jsonify({'error': '事件内容不能为空'}), 400
 
-@app.route('/api/export')
+@route('/api/export')
 def export_data():
-    data = {
-        'world': state.world,
-        'agents': state.agents,
-        'history': state.history,
-        'metrics': state.metrics,
-        'metric_data': state.metric_data,
-        'custom_templates': state.custom_templates,
-        'exported_at': datetime.now().isoformat()
-    }
-    return jsonify(data)
+    state = current_state()
+    # 配置部分在锁内序列化成快照；历史的区间也在锁内确定，之后按区间流式读取（跨内存与磁盘两层）
+    with state.lock:
+        fields = {
+            'world': state.world,
+            'agents': state.agents,
+            'metrics': state.metrics,
+            'metric_data': state.metric_data,
+            'custom_templates': state.custom_templates,
+            'summaries': state.summaries,
+            'summary_covered': state.summary_covered,
+            'exported_at': datetime.now().isoformat()
+        }
+        header = ''.join(
+            f'{json.dumps(key)}: {json.dumps(value, ensure_ascii=False)}, ' for key, value in fields.items()
+        )
+        history = state.history.iter_range(0, len(state.history))
+    
+    def generate():
+        yield '{' + header + '"history": '
+        yield from stream_json_array(history)
+        yield '}'
+    
+    return Response(generate(), mimetype='application/json')
 
-@app.route('/api/import', methods=['POST'])
+@route('/api/import', methods=['POST'])
 def import_data():
+    state = current_state()
     data = request.json
-    if 'world' in data:
-        state.world = data['world']
-    if 'agents' in data:
-        state.agents = data['agents']
-    if 'history' in data:
-        state.history = data['history']
-        state.round = len(data['history'])
-    if 'metrics' in data:
-        state.metrics = data['metrics']
-    if 'metric_data' in data:
-        state.metric_data = data['metric_data']
-    if 'custom_templates' in data:
-        state.custom_templates = data['custom_templates']
+    with state.lock:
+        load_state_data(state, data)
+        reset_journal(state)
+    publish_status(state)
     return jsonify({'success': True, 'message': '数据已导入'})
 
 # ============================================
@@ -1269,6 +4870,9 @@ HTML_TEMPLATE = '''
         }
         
         .log-entry.error { border-left-color: var(--danger); }
+        .log-entry.streaming { opacity: 0.75; border-left-style: dashed; }
+        .log-entry.streaming .log-content::after { content: '▍'; animation: blink 1s step-end infinite; }
+        @keyframes blink { 50% { opacity: 0; } }
         .log-entry.event { border-left-color: var(--warning); background: rgba(255, 217, 61, 0.05); }
         .log-meta { display: flex; align-items: center; gap: 0.75rem; margin-bottom: 0.5rem; font-size: 0.8rem; flex-wrap: wrap; }
         .log-round { color: var(--accent); font-weight: 600; }
@@ -1588,6 +5192,11 @@ HTML_TEMPLATE = '''
                             <div style="font-size: 0.8rem; color: var(--text-secondary);">
                                 <span id="speed-value">3</span> 秒/回合
                             </div>
+                            <div class="sim-sidebar-title" style="margin-top: 1rem;">行动模式</div>
+                            <select class="form-input form-select" id="schedule-mode">
+                                <option value="round_robin">轮流行动</option>
+                                <option value="simultaneous">同时行动</option>
+                            </select>
                         </div>
                         
                         <div class="metrics-panel" id="sim-metrics-panel" style="display: none;">
@@ -1601,6 +5210,7 @@ HTML_TEMPLATE = '''
                             <div class="control-group">
                                 <span class="round-badge">回合 <span id="round-display">0</span></span>
                                 <span class="status-badge status-stopped" id="status-badge">已停止</span>
+                                <span class="round-badge" title="本会话累计输入 / 输出 token">Token <span id="token-display">0 / 0</span></span>
                             </div>
                             <div class="control-group" style="margin-left: auto;">
                                 <button class="btn btn-sm" id="step-btn" onclick="stepSimulation()">⏭️ 单步</button>
@@ -1675,6 +5285,23 @@ HTML_TEMPLATE = '''
                                 <option value="qwen-max">Qwen-Max (最强)</option>
                             </select>
                         </div>
+                        <div class="form-group">
+                            <label class="form-label">LLM后端</label>
+                            <select class="form-input form-select" id="backend-select">
+                                <option value="dashscope">DashScope</option>
+                                <option value="mock">离线模拟（无需API Key）</option>
+                            </select>
+                            <p class="form-hint">离线模拟后端返回合成响应，用于压测和离线演示</p>
+                        </div>
+                        <div class="form-group">
+                            <label class="form-label">输入 Token 预算</label>
+                            <input type="number" class="form-input" id="prompt-token-budget" min="0" step="100">
+                            <p class="form-hint">按时近性与相关性挑选历史填满预算，0 表示固定使用最近20条</p>
+                        </div>
+                        <div class="form-group">
+                            <label class="form-label">输出 Token 上限</label>
+                            <input type="number" class="form-input" id="max-output-tokens" min="1" step="100">
+                        </div>
                         <button class="btn btn-accent" onclick="saveConfig()">💾 保存配置</button>
                     </div>
                     
@@ -1751,7 +5378,17 @@ HTML_TEMPLATE = '''
             historyLength: 0
         };
         
-        let pollInterval = null;
+        // 每个浏览器使用独立会话，所有 API 请求都带上会话ID
+        const sessionId = localStorage.getItem('socialsim_session') || (() => {
+            const id = 's' + Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+            localStorage.setItem('socialsim_session', id);
+            return id;
+        })();
+        
+        let eventSource = null;
+        const streamingEntries = {};
+        let syncing = false;
+        let syncAgain = false;
         let metricsChart = null;
         
         // Toast
@@ -1800,7 +5437,7 @@ HTML_TEMPLATE = '''
         
         // API调用
         async function apiCall(endpoint, method = 'GET', data = null) {
-            const options = { method, headers: { 'Content-Type': 'application/json' } };
+            const options = { method, headers: { 'Content-Type': 'application/json', 'X-Session-Id': sessionId } };
             if (data) options.body = JSON.stringify(data);
             const response = await fetch(endpoint, options);
             return response.json();
@@ -1809,18 +5446,30 @@ HTML_TEMPLATE = '''
         // 配置管理
         async function loadConfig() {
             const config = await apiCall('/api/config');
-            updateApiStatus(config.has_key);
+            updateApiStatus(config.ready);
             document.getElementById('model-select').value = config.model;
+            document.getElementById('backend-select').value = config.backend;
+            document.getElementById('prompt-token-budget').value = config.prompt_token_budget;
+            document.getElementById('max-output-tokens').value = config.max_output_tokens;
+            updateTokenUsage(config.token_usage);
         }
         
         async function saveConfig() {
             const apiKey = document.getElementById('api-key').value;
             const model = document.getElementById('model-select').value;
-            await apiCall('/api/config', 'POST', { api_key: apiKey, model });
-            updateApiStatus(!!apiKey);
+            const backend = document.getElementById('backend-select').value;
+            const prompt_token_budget = parseInt(document.getElementById('prompt-token-budget').value) || 0;
+            const max_output_tokens = parseInt(document.getElementById('max-output-tokens').value) || 2000;
+            await apiCall('/api/config', 'POST', { api_key: apiKey, model, backend, prompt_token_budget, max_output_tokens });
+            updateApiStatus(!!apiKey || backend === 'mock');
             showToast('配置已保存', 'success');
         }
         
+        function updateTokenUsage(usage) {
+            if (!usage) return;
+            document.getElementById('token-display').textContent = `${usage.input_tokens} / ${usage.output_tokens}`;
+        }
+        
         function updateApiStatus(connected) {
             const dot = document.getElementById('api-status-dot');
             const text = document.getElementById('api-status-text');
@@ -2084,6 +5733,13 @@ HTML_TEMPLATE = '''
             showToast('角色已删除', 'success');
         }
         
+        let generatedCount = 0;
+        
+        function updateAgentProgress({ total }) {
+            const btn = document.getElementById('generate-agents-btn');
+            if (btn.disabled) btn.textContent = `🤖 生成中 ${++generatedCount}/${total}`;
+        }
+        
         async function generateAgentsAI() {
             if (!state.world.background) {
                 showToast('请先设置世界背景', 'error');
@@ -2093,6 +5749,7 @@ HTML_TEMPLATE = '''
             const btn = document.getElementById('generate-agents-btn');
             btn.disabled = true;
             btn.textContent = '🤖 生成中...';
+            generatedCount = 0;
             
             try {
                 const result = await apiCall('/api/agents/generate', 'POST', { count: 4 });
@@ -2289,11 +5946,12 @@ HTML_TEMPLATE = '''
         
         async function startSimulation() {
             const speed = parseInt(document.getElementById('speed-slider').value);
-            const result = await apiCall('/api/simulation/start', 'POST', { speed });
+            const schedule_mode = document.getElementById('schedule-mode').value;
+            const result = await apiCall('/api/simulation/start', 'POST', { speed, schedule_mode });
             if (result.error) { showToast(result.error, 'error'); return; }
             state.running = true;
             updateSimulationUI();
-            startPolling();
+            startStream();
             showToast('模拟已启动', 'success');
         }
         
@@ -2301,14 +5959,14 @@ HTML_TEMPLATE = '''
             await apiCall('/api/simulation/stop', 'POST');
             state.running = false;
             updateSimulationUI();
-            stopPolling();
             showToast('模拟已暂停', 'info');
         }
         
         async function stepSimulation() {
-            const result = await apiCall('/api/simulation/step', 'POST');
+            const schedule_mode = document.getElementById('schedule-mode').value;
+            const result = await apiCall('/api/simulation/step', 'POST', { schedule_mode });
             if (result.error) { showToast(result.error, 'error'); return; }
-            await pollHistory();
+            startStream();
         }
         
         function updateSimulationUI() {
@@ -2327,55 +5985,122 @@ HTML_TEMPLATE = '''
             }
         }
         
-        function startPolling() { if (pollInterval) return; pollInterval = setInterval(pollHistory, 1000); }
-        function stopPolling() { if (pollInterval) { clearInterval(pollInterval); pollInterval = null; } }
+        // SSE 推送：新记录、回合变化和指标数据到达时才更新界面
+        function startStream() {
+            if (eventSource) return;
+            eventSource = new EventSource(`/api/stream?session=${encodeURIComponent(sessionId)}`);
+            eventSource.addEventListener('status', e => applyStatus(JSON.parse(e.data)));
+            eventSource.addEventListener('log_entry', e => {
+                const { index, entry } = JSON.parse(e.data);
+                if (index === state.historyLength) appendLogs([entry], index);
+                else if (index > state.historyLength) syncHistory();
+            });
+            eventSource.addEventListener('metric_data', () => updateSimMetrics());
+            eventSource.addEventListener('token', e => appendToken(JSON.parse(e.data)));
+            eventSource.addEventListener('agent_generated', e => updateAgentProgress(JSON.parse(e.data)));
+            eventSource.addEventListener('token_cancel', e => {
+                JSON.parse(e.data).ids.forEach(removeStreamingEntry);
+            });
+        }
+        
+        // 正在生成的回复：按记录 id 累积分片，提交后由 appendLogs 替换
+        function appendToken({ id, round, agent, delta }) {
+            const logsContainer = document.getElementById('sim-logs');
+            let entry = streamingEntries[id];
+            if (!entry) {
+                logsContainer.querySelectorAll('.empty-logs').forEach(el => el.remove());
+                entry = document.createElement('div');
+                entry.className = 'log-entry streaming';
+                entry.innerHTML = `
+                    <div class="log-meta">
+                        <span class="log-round">#${round}</span>
+                        <span class="log-agent">${escapeHtml(agent)}</span>
+                    </div>
+                    <div class="log-content"></div>
+                `;
+                logsContainer.appendChild(entry);
+                streamingEntries[id] = entry;
+            }
+            entry.querySelector('.log-content').textContent += delta;
+            logsContainer.scrollTop = logsContainer.scrollHeight;
+        }
+        
+        function removeStreamingEntry(id) {
+            if (streamingEntries[id]) {
+                streamingEntries[id].remove();
+                delete streamingEntries[id];
+            }
+        }
         
-        async function pollHistory() {
-            const status = await apiCall('/api/simulation/status');
+        function applyStatus(status) {
             state.round = status.round;
             document.getElementById('round-display').textContent = status.round;
-            
-            const history = await apiCall(`/api/history?since=${state.historyLength}`);
-            
-            if (history.length > 0) {
-                const logsContainer = document.getElementById('sim-logs');
-                if (state.historyLength === 0) logsContainer.innerHTML = '';
-                
-                history.forEach(log => {
-                    const entry = document.createElement('div');
-                    entry.className = `log-entry ${log.error ? 'error' : ''} ${log.event ? 'event' : ''}`;
-                    entry.innerHTML = `
-                        <div class="log-meta">
-                            <span class="log-round">#${log.round}</span>
-                            <span class="log-agent">${log.agent}</span>
-                            <span class="log-time">${new Date(log.timestamp).toLocaleTimeString()}</span>
-                        </div>
-                        ${log.event ? `<div class="log-event-tag">⚡ 事件: ${log.event}</div>` : ''}
-                        <div class="log-content">${escapeHtml(log.content)}</div>
-                    `;
-                    logsContainer.appendChild(entry);
-                });
-                
-                state.historyLength += history.length;
-                logsContainer.scrollTop = logsContainer.scrollHeight;
+            updateTokenUsage(status.token_usage);
+            if (status.history_length < state.historyLength) resetLogs();
+            if (status.history_length > state.historyLength) syncHistory();
+            if (status.running !== state.running) {
+                state.running = status.running;
+                updateSimulationUI();
+            }
+        }
+        
+        async function syncHistory() {
+            if (syncing) { syncAgain = true; return; }
+            syncing = true;
+            try {
+                do {
+                    syncAgain = false;
+                    const since = state.historyLength;
+                    const history = await apiCall(`/api/history?since=${since}`);
+                    appendLogs(history, since);
+                } while (syncAgain);
+                await updateSimMetrics();
+            } finally {
+                syncing = false;
             }
+        }
+        
+        function appendLogs(history, startIndex) {
+            // 跳过已经渲染过的记录（SSE 与补齐请求可能有重叠）
+            const fresh = history.slice(Math.max(0, state.historyLength - startIndex));
+            if (fresh.length === 0) return;
             
-            await updateSimMetrics();
+            const logsContainer = document.getElementById('sim-logs');
+            if (state.historyLength === 0) logsContainer.querySelectorAll('.empty-logs').forEach(el => el.remove());
             
-            if (!status.running && state.running) {
-                state.running = false;
-                updateSimulationUI();
-                stopPolling();
-            }
+            fresh.forEach(log => {
+                removeStreamingEntry(log.id);
+                const entry = document.createElement('div');
+                entry.className = `log-entry ${log.error ? 'error' : ''} ${log.event ? 'event' : ''}`;
+                entry.innerHTML = `
+                    <div class="log-meta">
+                        <span class="log-round">#${log.round}</span>
+                        <span class="log-agent">${log.agent}</span>
+                        <span class="log-time">${new Date(log.timestamp).toLocaleTimeString()}</span>
+                    </div>
+                    ${log.event ? `<div class="log-event-tag">⚡ 事件: ${log.event}</div>` : ''}
+                    <div class="log-content">${escapeHtml(log.content)}</div>
+                `;
+                // 已提交的记录排在仍在生成的回复之前
+                logsContainer.insertBefore(entry, logsContainer.querySelector('.log-entry.streaming'));
+            });
+            
+            state.historyLength += fresh.length;
+            logsContainer.scrollTop = logsContainer.scrollHeight;
+        }
+        
+        function resetLogs() {
+            state.historyLength = 0;
+            Object.keys(streamingEntries).forEach(id => delete streamingEntries[id]);
+            document.getElementById('sim-logs').innerHTML = '<div class="empty-logs">点击"开始"或"单步"按钮启动模拟...</div>';
         }
         
         async function clearHistory() {
             if (!confirm('确定要清空所有历史记录吗？')) return;
             await apiCall('/api/history/clear', 'POST');
-            state.historyLength = 0;
+            resetLogs();
             state.round = 0;
             document.getElementById('round-display').textContent = '0';
-            document.getElementById('sim-logs').innerHTML = '<div class="empty-logs">点击"开始"或"单步"按钮启动模拟...</div>';
             await updateSimMetrics();
             showToast('历史已清空', 'success');
         }
@@ -2440,12 +6165,363 @@ HTML_TEMPLATE = '''
         document.getElementById('metric-description').addEventListener('keypress', e => { if (e.key === 'Enter') generateMetric(); });
         
         loadWorld();
+        startStream();
     </script>
 </body>
 </html>
 '''
 
+# ============================================
+# 无界面批量运行
+# ============================================
+def write_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+def load_experiment_data(template=None, input_path=None):
+    """读取 /api/export 导出的文件，或取内置模板的世界与角色"""
+    if input_path:
+        with open(input_path, encoding='utf-8') as f:
+            return json.load(f)
+    if template not in TEMPLATES:
+        raise ValueError(f"未知模板: {template}，可选: {', '.join(TEMPLATES)}")
+    return {k: copy.deepcopy(v) for k, v in TEMPLATES[template].items() if k in ('world', 'agents')}
+
+# 可以在无界面运行与参数扫描中设置的 SimulationState 字段
+EXPERIMENT_FIELDS = (
+    'backend', 'model', 'temperature', 'schedule_mode', 'batch_size', 'max_workers',
+    'prompt_token_budget', 'max_output_tokens', 'memory_recall_k', 'relevant_others',
+    'call_timeout', 'hedge_requests', 'metric_concurrency'
+)
+
+def prepare_headless_state(data, settings, agent_count=None, progress=None):
+    """按设置构建一个独立的、不带持久化日志的会话；agent_count 给出时截断或补生成角色到该数量"""
+    state = SimulationState('headless')
+    # 批量实验需要完整的指标曲线，积压的快照不丢弃
+    state.metric_evaluator = MetricEvaluator(state, max_pending=100000)
+    state.metric_concurrency = 2
+    state.stream_tokens = False
+    for field in EXPERIMENT_FIELDS:
+        if settings.get(field) is not None:
+            setattr(state, field, settings[field])
+    apply_schedule_settings(state, {k: v for k, v in settings.items() if v is not None})
+    if settings.get('mock_latency') is not None:
+        LLM_BACKENDS['mock'].configure(latency=settings['mock_latency'])
+    with state.lock:
+        load_state_data(state, data)
+        if settings.get('metrics'):
+            state.metrics = [{'id': m.get('id') or str(uuid.uuid4()), **m} for m in settings['metrics']]
+            state.metric_data = {m['id']: [] for m in state.metrics}
+    if not llm_ready(state):
+        raise ValueError('当前后端需要 API Key：设置 DASHSCOPE_API_KEY 或使用 mock 后端')
+    
+    if agent_count is None and not state.agents:
+        agent_count = 4
+    missing = 0
+    if agent_count is not None:
+        state.agents = state.agents[:agent_count]
+        missing = agent_count - len(state.agents)
+    if missing > 0:
+        if progress:
+            progress(f"正在为世界生成 {missing} 个角色...")
+        generated = engine.run(generate_agents_for_world(
+            state, state.world, missing, [a['name'] for a in state.agents]
+        ))
+        if not generated:
+            raise ValueError('角色生成失败')
+        state.agents = state.agents + generated
+    state.graph.rebuild(state.history, state.agents)
+    state.prompts.reset(state)
+    wait_memory_index(state)
+    return state
+
+def run_headless_rounds(state, rounds, output_dir, events=(), max_errors=5, progress=None, progress_interval=1.0):
+    """用与界面相同的引擎跑 rounds 个回合，历史逐步追加到 history.jsonl，结束后写出 metrics.json 与 summary.json。
+    events 为 [{'round': N, 'text': ...}]，在产生第 N 回合的那一步之前注入；同时模式下一步覆盖一批回合，
+    落在这一批里的事件合并后一起注入。最后一步只让剩余回合数的角色行动，不会超出 rounds"""
+    os.makedirs(output_dir, exist_ok=True)
+    pending_events = sorted(events, key=lambda e: e['round'])
+    target = state.round + rounds
+    start_round = state.round
+    errors = 0
+    consecutive_errors = 0
+    started = last_report = time.perf_counter()
+    
+    with open(os.path.join(output_dir, 'history.jsonl'), 'w', encoding='utf-8') as history_file:
+        for entry in state.history:
+            history_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        try:
+            while state.round < target:
+                remaining = target - state.round
+                last_round = state.round + min(step_batch_size(state), remaining)
+                due = []
+                while pending_events and pending_events[0]['round'] <= last_round:
+                    due.append(pending_events.pop(0)['text'])
+                if due:
+                    state.event_queue.put('\n'.join(due))
+                before = len(state.history)
+                result = engine.run(run_simulation_step(state, max_batch=remaining))
+                for entry in state.history.iter_range(before, len(state.history)):
+                    history_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                
+                if result is not None and result.get('error'):
+                    errors += 1
+                    consecutive_errors += 1
+                    if consecutive_errors >= max_errors:
+                        if progress:
+                            progress(f"连续 {consecutive_errors} 次调用失败，停止: {result['content']}")
+                        break
+                else:
+                    consecutive_errors = 0
+                
+                now = time.perf_counter()
+                if progress and (now - last_report >= progress_interval or state.round >= target):
+                    last_report = now
+                    done = state.round - start_round
+                    progress(f"回合 {state.round}/{target}  {done / (now - started):.2f} 回合/秒  错误 {errors}")
+        except KeyboardInterrupt:
+            if progress:
+                progress('已中断，正在写出已完成的结果...')
+    
+    # 等后台的指标评估与记忆摘要收尾后再写出
+    engine.run(state.metric_evaluator.join())
+    engine.run(state.summarizer.join())
+    elapsed = time.perf_counter() - started
+    rounds_done = state.round - start_round
+    
+    with state.lock:
+        write_json(os.path.join(output_dir, 'metrics.json'), {
+            'metrics': state.metrics,
+            'metric_data': state.metric_data
+        })
+        summary = {
+            'backend': state.backend,
+            'model': state.model,
+            'schedule_mode': state.schedule_mode,
+            'agents': len(state.agents),
+            'rounds': rounds_done,
+            'final_round': state.round,
+            'elapsed_s': elapsed,
+            'rounds_per_sec': rounds_done / elapsed if elapsed else 0.0,
+            'errors': errors,
+            'metric_snapshots_dropped': state.metric_evaluator.dropped,
+            'token_usage': dict(state.token_usage),
+            'finished_at': datetime.now().isoformat()
+        }
+    write_json(os.path.join(output_dir, 'summary.json'), summary)
+    return summary
+
+def log_progress(message):
+    print(message, file=sys.stderr)
+
+def run_headless(args):
+    """不启动 Web 服务，跑完指定回合数并写出结果"""
+    rate_limiter.configure(requests_per_min=args.requests_per_min, tokens_per_min=args.tokens_per_min)
+    try:
+        data = load_experiment_data(args.template, args.input)
+        state = prepare_headless_state(data, {
+            'backend': args.backend,
+            'model': args.model,
+            'mock_latency': args.mock_latency,
+            'schedule_mode': args.schedule_mode,
+            'batch_size': args.batch_size,
+            'max_workers': args.max_workers
+        }, agent_count=None if data.get('agents') else args.agents, progress=log_progress)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    
+    summary = run_headless_rounds(
+        state, args.rounds, args.output_dir,
+        max_errors=args.max_errors, progress=log_progress, progress_interval=args.progress_interval
+    )
+    summary.update({'template': None if args.input else args.template, 'input': args.input})
+    write_json(os.path.join(args.output_dir, 'summary.json'), summary)
+    state.close()
+    
+    usage = summary['token_usage']
+    log_progress(f"完成 {summary['rounds']} 回合，用时 {summary['elapsed_s']:.1f} 秒"
+                 f"（{summary['rounds_per_sec']:.2f} 回合/秒），LLM 调用 {usage['calls']} 次，"
+                 f"输入/输出 token {usage['input_tokens']}/{usage['output_tokens']}，错误 {summary['errors']} 次")
+    log_progress(f"结果已写入 {args.output_dir}")
+    return summary
+
+# ============================================
+# 参数扫描
+# ============================================
+# 每个变体可以设置的参数：EXPERIMENT_FIELDS 之外还有模板/输入文件、角色数、回合数、
+# 事件时间表、指标定义与模拟后端延迟
+SWEEP_PARAMS = EXPERIMENT_FIELDS + (
+    'template', 'input', 'agent_count', 'rounds', 'events', 'metrics', 'mock_latency'
+)
+
+def sample_param(rng, spec):
+    """随机扫描的取值规格：{"uniform": [a, b]}、{"randint": [a, b]}、{"choice": [...]}"""
+    if 'uniform' in spec:
+        return rng.uniform(*spec['uniform'])
+    if 'randint' in spec:
+        return rng.randint(*spec['randint'])
+    if 'choice' in spec:
+        return rng.choice(spec['choice'])
+    raise ValueError(f"无法识别的取值规格: {spec}")
+
+def expand_sweep(spec):
+    """把实验规格展开为变体列表：base 为公共参数，grid 取笛卡尔积，
+    random 在每个网格点上再随机采样 samples 次，repeats 将每个变体重复多次"""
+    base = dict(spec.get('base', {}))
+    grid = spec.get('grid', {})
+    keys = list(grid)
+    points = [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+    
+    random_spec = spec.get('random')
+    if random_spec:
+        rng = random.Random(random_spec.get('seed'))
+        points = [
+            {**point, **{k: sample_param(rng, v) for k, v in random_spec['params'].items()}}
+            for point in points for _ in range(random_spec.get('samples', 1))
+        ]
+    
+    variants = []
+    for point in points:
+        params = {**base, **point}
+        unknown = set(params) - set(SWEEP_PARAMS)
+        if unknown:
+            raise ValueError(f"不支持的扫描参数: {', '.join(sorted(unknown))}")
+        for repeat in range(spec.get('repeats', 1)):
+            variants.append({**params, 'repeat': repeat})
+    return variants
+
+def init_sweep_worker(slots, requests_per_min=0, tokens_per_min=0):
+    global llm_call_slots
+    llm_call_slots = slots
+    rate_limiter.configure(requests_per_min=requests_per_min, tokens_per_min=tokens_per_min)
+
+def run_sweep_variant(run_id, params, output_dir):
+    """在工作进程中运行一个变体，返回参数、汇总与指标轨迹"""
+    data = load_experiment_data(params.get('template', 'ancient_town'), params.get('input'))
+    state = prepare_headless_state(data, params, agent_count=params.get('agent_count'))
+    try:
+        summary = run_headless_rounds(
+            state, params.get('rounds', 100), os.path.join(output_dir, run_id), events=params.get('events', ())
+        )
+        with state.lock:
+            metric_names = {m['id']: m['name'] for m in state.metrics}
+            trajectories = [
+                (metric_names.get(metric_id, metric_id), point['round'], point['value'])
+                for metric_id, points in state.metric_data.items() for point in points
+            ]
+    finally:
+        state.close()
+    return {'run': run_id, 'params': params, 'summary': summary, 'trajectories': trajectories}
+
+def columnar(rows, columns):
+    return {column: [row.get(column) for row in rows] for column in columns}
+
+def run_sweep(args):
+    """展开实验规格，在进程池中并行运行各变体，汇总为列式 JSON：runs.json 每行一个变体，
+    trajectories.json 每行一个指标数据点。所有工作进程共享 --max-llm-calls 个在途 LLM 调用"""
+    with open(args.sweep, encoding='utf-8') as f:
+        spec = json.load(f)
+    try:
+        variants = expand_sweep(spec)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    os.makedirs(args.output_dir, exist_ok=True)
+    log_progress(f"共 {len(variants)} 个变体，{args.workers} 个工作进程，LLM 并发上限 {args.max_llm_calls}")
+    
+    # 用 spawn 启动工作进程：父进程里已有引擎线程等后台线程，fork 后状态不可靠
+    context = multiprocessing.get_context('spawn')
+    slots = context.BoundedSemaphore(args.max_llm_calls)
+    param_columns = sorted({k for v in variants for k in v if k not in ('events', 'metrics')})
+    run_rows, trajectory_rows = [], []
+    started = time.perf_counter()
+    
+    # 每分钟配额由各工作进程均分，进程内再由限流器按 429 自适应
+    share = lambda quota: max(1, quota // args.workers) if quota else 0
+    limits = (share(args.requests_per_min), share(args.tokens_per_min))
+    
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context,
+                             initializer=init_sweep_worker, initargs=(slots, *limits)) as pool:
+        futures = {
+            pool.submit(run_sweep_variant, f"run-{i:04d}", params, args.output_dir): (f"run-{i:04d}", params)
+            for i, params in enumerate(variants)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            run_id, params = futures[future]
+            row = {'run': run_id, **{k: params.get(k) for k in param_columns}}
+            try:
+                result = future.result()
+            except Exception as e:
+                log_progress(f"[{done}/{len(variants)}] {run_id} 失败: {e}")
+                run_rows.append({**row, 'failed': str(e)})
+                continue
+            summary = result['summary']
+            run_rows.append({
+                **row,
+                'failed': None,
+                'rounds_completed': summary['rounds'],
+                'elapsed_s': summary['elapsed_s'],
+                'rounds_per_sec': summary['rounds_per_sec'],
+                'errors': summary['errors'],
+                'input_tokens': summary['token_usage']['input_tokens'],
+                'output_tokens': summary['token_usage']['output_tokens']
+            })
+            trajectory_rows.extend(
+                {'run': run_id, 'metric': metric, 'round': round_num, 'value': value}
+                for metric, round_num, value in result['trajectories']
+            )
+            log_progress(f"[{done}/{len(variants)}] {run_id} 完成 {summary['rounds']} 回合"
+                         f"（{summary['rounds_per_sec']:.2f} 回合/秒，错误 {summary['errors']} 次）")
+    
+    run_rows.sort(key=lambda row: row['run'])
+    run_columns = ['run'] + param_columns + [
+        'failed', 'rounds_completed', 'elapsed_s', 'rounds_per_sec', 'errors', 'input_tokens', 'output_tokens'
+    ]
+    write_json(os.path.join(args.output_dir, 'runs.json'), columnar(run_rows, run_columns))
+    write_json(os.path.join(args.output_dir, 'trajectories.json'),
+               columnar(trajectory_rows, ['run', 'metric', 'round', 'value']))
+    write_json(os.path.join(args.output_dir, 'spec.json'), spec)
+    log_progress(f"全部完成，用时 {time.perf_counter() - started:.1f} 秒，结果已写入 {args.output_dir}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='SocialSim AI社会模拟平台')
+    parser.add_argument('--headless', action='store_true', help='不启动 Web 服务，直接批量运行模拟')
+    parser.add_argument('--sweep', metavar='SPEC', help='按实验规格文件并行运行参数扫描')
+    parser.add_argument('--port', type=int, default=5000, help='Web 服务端口')
+    headless = parser.add_argument_group('无界面批量运行')
+    headless.add_argument('--template', default='ancient_town', help=f"内置模板: {', '.join(TEMPLATES)}")
+    headless.add_argument('--input', help='从 /api/export 导出的 JSON 文件加载（优先于 --template）')
+    headless.add_argument('--rounds', type=int, default=100, help='运行的回合数')
+    headless.add_argument('--output-dir', default=None, help='输出目录，默认 runs/<时间戳>')
+    headless.add_argument('--backend', choices=sorted(LLM_BACKENDS), help='LLM 后端，默认取 SOCIALSIM_BACKEND')
+    headless.add_argument('--model', help='模型名称')
+    headless.add_argument('--mock-latency', type=float, help='离线模拟后端的合成延迟（秒）')
+    headless.add_argument('--agents', type=int, default=4, help='没有角色时自动生成的角色数')
+    headless.add_argument('--schedule-mode', choices=['round_robin', 'simultaneous'], default='round_robin')
+    headless.add_argument('--batch-size', type=int, default=0, help='同时模式每步行动的角色数，0 表示全部')
+    headless.add_argument('--max-workers', type=int, default=8, help='同时模式下并发 LLM 调用上限')
+    headless.add_argument('--max-errors', type=int, default=5, help='连续失败这么多次后停止')
+    headless.add_argument('--requests-per-min', type=int, default=rate_limiter.requests_per_min,
+                          help='LLM 每分钟请求数配额，0 表示不限；参数扫描时由各工作进程均分')
+    headless.add_argument('--tokens-per-min', type=int, default=rate_limiter.tokens_per_min,
+                          help='LLM 每分钟 token 配额，0 表示不限；参数扫描时由各工作进程均分')
+    headless.add_argument('--progress-interval', type=float, default=1.0, help='进度输出间隔（秒）')
+    sweep = parser.add_argument_group('参数扫描')
+    sweep.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='工作进程数')
+    sweep.add_argument('--max-llm-calls', type=int, default=8, help='所有工作进程共享的在途 LLM 调用上限')
+    args = parser.parse_args(argv)
+    if args.output_dir is None:
+        args.output_dir = os.path.join('runs', datetime.now().strftime('%Y%m%d-%H%M%S'))
+    return args
+
 if __name__ == '__main__':
+    args = parse_args()
+    if args.sweep:
+        run_sweep(args)
+        sys.exit(0)
+    if args.headless:
+        run_headless(args)
+        sys.exit(0)
+    
     print('''
 ╔═══════════════════════════════════════════════════════════╗
 ║     ◈  SocialSim v2.1 - AI社会模拟平台                     ║
@@ -2455,4 +6531,4 @@ if __name__ == '__main__':
 ║     访问 http://localhost:5000 开始使用                    ║
 ╚═══════════════════════════════════════════════════════════╝
     ''')
-    app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
+    create_app().run(host='0.0.0.0', port=args.port, debug=True, threaded=True)
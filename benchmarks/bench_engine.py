@@ -0,0 +1,448 @@
+"""
+SocialSim 引擎与 HTTP API 基准测试
+
+使用离线模拟后端（固定延迟）驱动 run_simulation_step、build_agent_prompt、
+analyze_metrics、/api/history 与 /api/export，按角色数、历史长度、指标数扫描，
+结果以 JSON 输出，便于在版本之间对比回归。
+
+用法：
+    python benchmarks/bench_engine.py --output bench.json
+    python benchmarks/bench_engine.py --quick
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import gc
+import platform
+import resource
+import shutil
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# 持久化日志写到临时目录，不污染工作目录
+BENCH_DATA_DIR = tempfile.mkdtemp(prefix='socialsim-bench-')
+os.environ['SOCIALSIM_DATA_DIR'] = BENCH_DATA_DIR
+
+import SocialSim as sim
+
+state = sim.sessions.get(sim.DEFAULT_SESSION)
+
+FULL_SWEEP = {
+    'agent_counts': [4, 20, 100, 500],
+    'history_lengths': [10, 1000, 10000, 100000],
+    'metric_counts': [1, 5, 20],
+    'recovery_entries': [100000, 1000000],
+}
+
+QUICK_SWEEP = {
+    'agent_counts': [4, 20],
+    'history_lengths': [10, 1000],
+    'metric_counts': [1, 5],
+    'recovery_entries': [10000],
+}
+
+# 打包路径使用的输入 token 预算；会话默认不打包（预算为 0），这里单独测打包的开销
+PACKED_PROMPT_BUDGET = 2500
+
+# ============================================
+# 工具函数
+# ============================================
+def percentiles(samples):
+    ordered = sorted(samples)
+
+    def pick(p):
+        if not ordered:
+            return 0.0
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    return {
+        'p50': pick(50),
+        'p95': pick(95),
+        'p99': pick(99),
+        'mean': sum(ordered) / len(ordered) if ordered else 0.0
+    }
+
+def process_peak_rss_kb():
+    """整个进程生命周期的峰值，只适合放在 meta 里"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 以字节为单位，Linux 以 KB 为单位
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+def proc_rss_kb():
+    """读 /proc/self/status 的 (当前 RSS, 峰值 RSS)，单位 KB；非 Linux 返回 None"""
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['VmRSS'].split()[0]), int(fields['VmHWM'].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def reset_peak_rss():
+    """清零内核记录的峰值（clear_refs 写 5），之后读到的峰值只属于当前基准项"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+class RSSProbe:
+    """单个基准项的内存测量：Linux 上报告本项的峰值及其相对起点的增量，
+    其他平台只能报告进程峰值的增量（之前的基准项已达到的峰值会被掩盖）"""
+
+    def __init__(self):
+        gc.collect()
+        self.resettable = reset_peak_rss()
+        current = proc_rss_kb() if self.resettable else None
+        self.start = current[0] if current else process_peak_rss_kb()
+
+    def result(self):
+        current = proc_rss_kb() if self.resettable else None
+        if current:
+            return {'peak_rss_kb': current[1], 'peak_rss_delta_kb': current[1] - self.start}
+        return {'peak_rss_kb': None, 'peak_rss_delta_kb': process_peak_rss_kb() - self.start}
+
+def make_agents(count):
+    return [{
+        'id': f'agent-{i}',
+        'name': f'角色{i}',
+        'personality': '谨慎而务实的人，说话直接，做事讲究效率，对陌生人保持戒心但乐于帮助邻里。',
+        'goal': '在这个世界中站稳脚跟，争取更多资源',
+        'memory': '刚来到这里不久，对周围的人还不太了解。'
+    } for i in range(count)]
+
+ACTIONS = ['点了点头', '皱了皱眉', '放下手中的活计', '叹了口气', '拍了拍桌子', '望向窗外', '压低声音']
+TOPICS = ['粮食', '税银', '码头', '药材', '盐引', '米价', '水渠', '账本', '婚事', '地契', '商队', '城墙',
+          '瘟疫', '科举', '赌坊', '镖局', '庙会', '铁匠铺', '茶馆', '衙门']
+LINES = ['这件事我们得好好商量一下', '我觉得现在还不是时候', '你说的有道理，我同意', '这样下去可不行',
+         '我早就提醒过你', '先把眼前的难关过了再说', '这里面恐怕另有隐情', '我可以帮你，但有个条件']
+
+def make_history(length, agents, seed=0):
+    """用固定种子从词表组合出内容各异的发言，检索索引的特征分布接近真实对话"""
+    rng = random.Random(seed)
+    history = []
+    for i in range(length):
+        speaker = agents[i % len(agents)]
+        target = agents[rng.randrange(len(agents))]['name']
+        history.append({
+            'id': str(uuid.uuid4()),
+            'round': i + 1,
+            'agent': speaker['name'],
+            'agent_id': speaker['id'],
+            'content': (f'*{rng.choice(ACTIONS)}，看向{target}* "{target}，关于{rng.choice(TOPICS)}和'
+                        f'{rng.choice(TOPICS)}的事，{rng.choice(LINES)}。" (心里盘算着{rng.choice(TOPICS)})'),
+            'timestamp': datetime.now().isoformat(),
+            'event': None
+        })
+    return history
+
+def make_metrics(count):
+    return [{
+        'id': f'metric-{i}',
+        'name': f'指标{i}',
+        'description': f'衡量第{i}项社会动态',
+        'min': 0,
+        'max': 100
+    } for i in range(count)]
+
+def reset_state(agents, history, metrics):
+    with state.lock:
+        state.running = False
+        state.agents = agents
+        state.history.clear()
+        state.history.extend(history)
+        state.round = len(history)
+        state.metrics = metrics
+        state.metric_data = {m['id']: [] for m in metrics}
+        state.world = sim.TEMPLATES['ancient_town']['world']
+        # 预置历史视为已摘要，只让基准期间新产生的历史触发后台摘要
+        state.summaries = {}
+        state.summary_covered = max(0, len(history) - sim.AGENT_PROMPT_HISTORY)
+        sim.rebuild_memory_index(state)
+        state.graph.rebuild(state.history, agents)
+        state.prompts.reset(state)
+    sim.wait_memory_index(state)
+
+# ============================================
+# 基准项
+# ============================================
+def bench_simulation_step(agent_counts, history_lengths, steps):
+    results = []
+    for mode in ('round_robin', 'simultaneous'):
+        state.schedule_mode = mode
+        for count in agent_counts:
+            agents = make_agents(count)
+            for length in history_lengths:
+                probe = RSSProbe()
+                reset_state(agents, make_history(length, agents), [])
+                start_round = state.round
+                latencies = []
+                started = time.perf_counter()
+                for _ in range(steps):
+                    t0 = time.perf_counter()
+                    sim.engine.run(sim.run_simulation_step(state))
+                    latencies.append(time.perf_counter() - t0)
+                elapsed = time.perf_counter() - started
+                rounds = state.round - start_round
+                results.append({
+                    'schedule_mode': mode,
+                    'agents': count,
+                    'history_length': length,
+                    'steps': steps,
+                    'rounds': rounds,
+                    'rounds_per_sec': rounds / elapsed,
+                    'step_latency_s': percentiles(latencies),
+                    **probe.result()
+                })
+    state.schedule_mode = 'round_robin'
+    return results
+
+def bench_prompt_build(agent_counts, history_lengths, iterations):
+    results = []
+    for count in agent_counts:
+        agents = make_agents(count)
+        for length in history_lengths:
+            history = make_history(length, agents)
+            world = sim.TEMPLATES['ancient_town']['world']
+            timings = []
+            for i in range(iterations):
+                agent = agents[i % count]
+                t0 = time.perf_counter()
+                sim.build_system_prompt(world)
+                prompt = sim.build_agent_prompt(agent, agents, history)
+                timings.append(time.perf_counter() - t0)
+
+            # 引擎实际路径：片段缓存，每次迭代追加一条新历史
+            prompts = sim.PromptCache()
+            prompts.reset_history(history)
+            for agent in agents:
+                prompts.agent_prompt(agent, agents)
+            extra = make_history(iterations, agents)
+            cached_timings = []
+            for i in range(iterations):
+                agent = agents[i % count]
+                prompts.append_history(extra[i:i + 1])
+                t0 = time.perf_counter()
+                prompts.system_prompt(world)
+                packed = prompts.agent_prompt(agent, agents, '', PACKED_PROMPT_BUDGET)
+                cached_timings.append(time.perf_counter() - t0)
+            results.append({
+                'agents': count,
+                'history_length': length,
+                'iterations': iterations,
+                'build_time_s': percentiles(timings),
+                'cached_build_time_s': percentiles(cached_timings),
+                'prompt_chars': len(prompt),
+                'prompt_tokens': sim.estimate_tokens(prompt),
+                'packed_prompt_tokens': sim.estimate_tokens(packed)
+            })
+    return results
+
+def bench_memory_recall(agent_counts, history_lengths, iterations):
+    """建立检索索引的耗时，以及一步内为全部行动角色检索相关往事的耗时"""
+    results = []
+    for count in agent_counts:
+        agents = make_agents(count)
+        for length in history_lengths:
+            probe = RSSProbe()
+            history = sim.MemoryHistoryStore()
+            history.extend(make_history(length, agents))
+            index = sim.MemoryIndex()
+            t0 = time.perf_counter()
+            index.add(history.iter_range(0, length))
+            build_time = time.perf_counter() - t0
+            recent = list(history.iter_range(max(0, length - 3), length))
+            timings = []
+            for _ in range(iterations):
+                t0 = time.perf_counter()
+                situation = sim.situation_query(index, recent)
+                queries = [sim.recall_query(index, agent, situation) for agent in agents]
+                index.search_many(queries, 3, length - sim.AGENT_PROMPT_CANDIDATES)
+                timings.append(time.perf_counter() - t0)
+            results.append({
+                'agents': count,
+                'history_length': length,
+                'iterations': iterations,
+                'build_time_s': build_time,
+                'recall_time_s': percentiles(timings),
+                'per_agent_recall_s': percentiles([t / count for t in timings]),
+                'index': index.stats(),
+                **probe.result()
+            })
+    return results
+
+def bench_analyze_metrics(metric_counts, iterations):
+    results = []
+    agents = make_agents(4)
+    for count in metric_counts:
+        reset_state(agents, make_history(100, agents), make_metrics(count))
+        timings = []
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            sim.engine.run(sim.analyze_metrics(state))
+            timings.append(time.perf_counter() - t0)
+        results.append({
+            'metrics': count,
+            'iterations': iterations,
+            'latency_s': percentiles(timings)
+        })
+    return results
+
+def bench_http(history_lengths, iterations):
+    client = sim.create_app().test_client()
+    results = []
+    agents = make_agents(20)
+    for length in history_lengths:
+        reset_state(agents, make_history(length, agents), make_metrics(5))
+        for endpoint in ('/api/history', f'/api/history?since={max(0, length - 20)}', '/api/export'):
+            probe = RSSProbe()
+            timings = []
+            size = 0
+            for _ in range(iterations):
+                t0 = time.perf_counter()
+                response = client.get(endpoint)
+                size = len(response.get_data())
+                timings.append(time.perf_counter() - t0)
+            results.append({
+                'endpoint': endpoint,
+                'history_length': length,
+                'iterations': iterations,
+                'latency_s': percentiles(timings),
+                'response_bytes': size,
+                **probe.result()
+            })
+    return results
+
+def bench_recovery(entry_counts):
+    """写入 N 条日志后，测量由检查点加日志回放重建会话的耗时"""
+    results = []
+    agents = make_agents(20)
+    metrics = make_metrics(5)
+    for count in entry_counts:
+        probe = RSSProbe()
+        directory = os.path.join(BENCH_DATA_DIR, f'recovery-{count}')
+        journal = sim.HistoryJournal(directory)
+        writer = sim.SimulationState('bench', journal)
+        writer.agents = agents
+        writer.metrics = metrics
+        writer.metric_data = {m['id']: [] for m in metrics}
+        sim.save_checkpoint(writer)
+
+        t0 = time.perf_counter()
+        for i, entry in enumerate(make_history(count, agents)):
+            journal.append('log', entry)
+            if (i + 1) % 5 == 0:
+                journal.append('metric', {'metric_id': metrics[0]['id'], 'round': i + 1, 'value': 50.0})
+        journal.close()
+        write_time = time.perf_counter() - t0
+        journal_bytes = sum(
+            os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+        )
+
+        reader = sim.SimulationState('bench', sim.HistoryJournal(directory))
+        t0 = time.perf_counter()
+        sim.restore_state(reader)
+        recovery_time = time.perf_counter() - t0
+        assert len(reader.history) == count
+        reader.journal.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+        # 历史存在 SQLite 文件里时日志按 JOURNAL_COMPACT_EVERY 压缩，恢复只回放最后一个检查点之后的部分
+        history_path = os.path.join(directory, 'history.db')
+        writer = sim.SimulationState('bench', sim.HistoryJournal(directory), sim.SQLiteHistoryStore(history_path))
+        writer.agents = agents
+        writer.metrics = metrics
+        writer.metric_data = {m['id']: [] for m in metrics}
+        sim.save_checkpoint(writer)
+        history = make_history(count, agents)
+        for start in range(0, count, 1000):
+            with writer.lock:
+                chunk = history[start:start + 1000]
+                writer.history.extend(chunk)
+                for entry in chunk:
+                    writer.journal.append('log', entry)
+                sim.maybe_compact_journal(writer)
+        writer.journal.close()
+        writer.history.close()
+        compacted_bytes = sum(
+            os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+            if name.startswith('journal-')
+        )
+
+        reader = sim.SimulationState('bench', sim.HistoryJournal(directory), sim.SQLiteHistoryStore(history_path))
+        t0 = time.perf_counter()
+        sim.restore_state(reader)
+        compacted_recovery_time = time.perf_counter() - t0
+        assert len(reader.history) == count
+
+        results.append({
+            'entries': count,
+            'journal_bytes': journal_bytes,
+            'write_time_s': write_time,
+            'recovery_time_s': recovery_time,
+            'recovered_entries_per_sec': count / recovery_time,
+            'compacted_journal_bytes': compacted_bytes,
+            'compacted_recovery_time_s': compacted_recovery_time,
+            **probe.result()
+        })
+        reader.journal.close()
+        reader.history.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+# ============================================
+# 入口
+# ============================================
+def main():
+    parser = argparse.ArgumentParser(description='SocialSim 引擎基准测试')
+    parser.add_argument('--latency', type=float, default=0.005, help='模拟后端固定延迟（秒）')
+    parser.add_argument('--steps', type=int, default=50, help='每组 run_simulation_step 的步数')
+    parser.add_argument('--iterations', type=int, default=20, help='其余基准项的重复次数')
+    parser.add_argument('--quick', action='store_true', help='使用较小的扫描范围')
+    parser.add_argument('--output', help='结果 JSON 文件路径，默认输出到标准输出')
+    args = parser.parse_args()
+
+    sweep = QUICK_SWEEP if args.quick else FULL_SWEEP
+
+    state.backend = 'mock'
+    sim.LLM_BACKENDS['mock'].configure(latency=args.latency, jitter=0, error_rate=0, seed=0)
+
+    started = time.perf_counter()
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'mock_latency_s': args.latency,
+            'sweep': sweep
+        },
+        'simulation_step': bench_simulation_step(sweep['agent_counts'], sweep['history_lengths'], args.steps),
+        'prompt_build': bench_prompt_build(sweep['agent_counts'], sweep['history_lengths'], args.iterations),
+        'memory_recall': bench_memory_recall(sweep['agent_counts'], sweep['history_lengths'], args.iterations),
+        'analyze_metrics': bench_analyze_metrics(sweep['metric_counts'], args.iterations),
+        'http': bench_http(sweep['history_lengths'], max(1, args.iterations // 4)),
+        'recovery': bench_recovery(sweep['recovery_entries']),
+    }
+    report['meta']['duration_s'] = time.perf_counter() - started
+    report['meta']['process_peak_rss_kb'] = process_peak_rss_kb()
+
+    shutil.rmtree(BENCH_DATA_DIR, ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"结果已写入 {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()